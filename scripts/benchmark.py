@@ -0,0 +1,437 @@
+#!/usr/bin/env python
+"""
+Benchmark suite of Stoxy for regression tracking.
+
+Scenarios are run against the null (Blackhole) and file data stores:
+
+  small            PUT and GET of many small objects
+  large            streaming PUT and GET of a few large objects
+  flat_listing     listing all the children of a container with many children
+  deep_listing     listing every level of a deep hierarchy of containers
+  objectid_lookup  resolving objects by their object ID (cdmi_objectid)
+
+By default only the storage layer is benchmarked: the models and data stores of Stoxy are run in this process,
+in a temporary ZODB (FileStorage), without the HTTP server, authentication and the CDMI views. With --endpoint,
+the same scenarios are run over HTTP against a running server; the containers created there are left in place.
+
+For each scenario, throughput and p50/p99 latency are reported as JSON, on standard output or in the --output
+file, together with the peak RSS of the benchmark process over the whole run (which includes the server in the
+storage mode, but not with --endpoint); a summary is printed on standard error.
+
+Usage: ./bin/python scripts/benchmark.py [--backend null|file ...] [--scenario name ...] [--quick]
+                                         [--endpoint URL --credentials user:password] [--output file]
+
+Without --endpoint ("storage" mode) the CDMI views and the HTTP request path are NOT measured.
+"""
+import argparse
+import io
+import json
+import math
+import os
+import platform
+import random
+import resource
+import shutil
+import sys
+import tempfile
+import time
+
+
+SCENARIOS = ('small', 'large', 'flat_listing', 'deep_listing', 'objectid_lookup')
+BACKENDS = ('null', 'file')
+
+CHUNK_SIZE = 2 ** 20
+COMMIT_EVERY = 1000
+
+
+def backend_metadata(backend, base):
+    """ Metadata of the benchmark containers storing data in the backend """
+    metadata = {'stoxy_backend': backend}
+    if backend == 'null':
+        # data URIs of the null backend must have its protocol, e.g. null+null:///name
+        metadata['stoxy_backend_base_protocol'] = 'null://'
+    elif base is not None:
+        metadata['stoxy_backend_base'] = base
+    return metadata
+
+
+class PatternStream(object):
+    """ Read-only stream of size bytes of a repeated random block, without holding the data in memory """
+
+    def __init__(self, size, block):
+        self.size = size
+        self.block = block
+        self.position = 0
+
+    def __len__(self):
+        return self.size
+
+    def read(self, size=-1):
+        remaining = self.size - self.position
+        if size is None or size < 0:
+            size = remaining
+        size = min(size, remaining, len(self.block))
+        offset = self.position % len(self.block)
+        data = self.block[offset:offset + size]
+        self.position += len(data)
+        return data
+
+    def tell(self):
+        return self.position
+
+    def close(self):
+        pass
+
+
+class StorageTarget(object):
+    """ Stoxy models and data stores in this process, in a temporary ZODB """
+
+    def __init__(self, backend, directory):
+        # imported here, as running over HTTP needs none of these
+        import transaction
+        from grokcore.component.testing import grok
+        from ZODB import DB
+        from ZODB.FileStorage import FileStorage
+        from zope.component import getAdapter
+
+        from stoxy.server.backend.manager import save_data
+        from stoxy.server.model.container import RootStorageContainer
+        from stoxy.server.model.container import StorageContainer
+        from stoxy.server.model.container import iter_child_names
+        from stoxy.server.model.dataobject import DataObject
+        from stoxy.server.model.store import IDataStoreFactory
+
+        for module in ('stoxy.server.model.container', 'stoxy.server.model.dataobject',
+                       'stoxy.server.backend.manager'):
+            grok(module)
+
+        self.transaction = transaction
+        self.getAdapter = getAdapter
+        self.save_data = save_data
+        self.StorageContainer = StorageContainer
+        self.DataObject = DataObject
+        self.IDataStoreFactory = IDataStoreFactory
+        self.iter_child_names = iter_child_names
+
+        data_directory = os.path.join(directory, 'data')
+        os.makedirs(data_directory)
+
+        self.db = DB(FileStorage(os.path.join(directory, 'Data.fs')))
+        self.connection = self.db.open()
+        self.storage = self.connection.root()['storage'] = RootStorageContainer()
+        self.metadata = backend_metadata(backend, data_directory)
+        self.root = StorageContainer(name=u'benchmark', metadata=dict(self.metadata))
+        self.storage.add(self.root)
+        transaction.commit()
+
+    def resolve(self, path):
+        obj = self.root
+        for segment in path:
+            obj = obj[unicode(segment)]
+        return obj
+
+    def _add(self, path):
+        obj = self.DataObject(name=unicode(path[-1]), mimetype=u'application/octet-stream')
+        self.resolve(path[:-1]).add(obj)
+        self.storage.oid_index.add(obj)
+        return obj
+
+    def create_container(self, path):
+        container = self.StorageContainer(name=unicode(path[-1]), metadata=dict(self.metadata))
+        self.resolve(path[:-1]).add(container)
+        self.storage.oid_index.add(container)
+        self.transaction.commit()
+
+    def put(self, path, datastream):
+        obj = self._add(path)
+        self.save_data(self.getAdapter(obj, self.IDataStoreFactory).create(), datastream, 'utf-8')
+        self.transaction.commit()
+
+    def fill(self, path, names):
+        """ Add data objects without data """
+        for n, name in enumerate(names):
+            self._add(path + [name])
+            if n % COMMIT_EVERY == 0:
+                self.transaction.commit()
+        self.transaction.commit()
+
+    def get(self, path):
+        datastream = self.getAdapter(self.resolve(path), self.IDataStoreFactory).create().load()
+        size = 0
+        try:
+            for data in iter(lambda: datastream.read(CHUNK_SIZE), ''):
+                size += len(data)
+        finally:
+            datastream.close()
+        return size
+
+    def list(self, path):
+        return list(self.iter_child_names(self.resolve(path)))
+
+    def oid(self, path):
+        return self.resolve(path).oid
+
+    def get_by_oid(self, oid):
+        return self.storage.oid_index.get(oid).name
+
+    def cold(self):
+        """ Drop cached objects, so that reads load them from the storage """
+        self.connection.cacheMinimize()
+
+    def close(self):
+        self.transaction.abort()
+        self.connection.close()
+        self.db.close()
+
+
+class HttpTarget(object):
+    """ A running Stoxy server """
+
+    def __init__(self, backend, endpoint, credentials, base=None):
+        import requests
+
+        self.endpoint = endpoint.rstrip('/')
+        self.session = requests.Session()
+        self.session.auth = credentials
+        self.metadata = backend_metadata(backend, base)
+        self.root = 'benchmark-%s-%d' % (backend, time.time())
+        self.create_container([])
+
+    def url(self, path):
+        return '/'.join([self.endpoint, self.root] + list(path))
+
+    def request(self, method, url, **kwargs):
+        response = self.session.request(method, url, **kwargs)
+        if response.status_code >= 300:
+            raise RuntimeError('%s %s failed: %s %s' % (method, url, response.status_code, response.text))
+        return response
+
+    def cdmi(self, content_type=None):
+        headers = {'X-CDMI-Specification-Version': '1.0.2'}
+        if content_type is not None:
+            headers['Content-Type'] = content_type
+        return headers
+
+    def create_container(self, path):
+        self.request('PUT', self.url(path) + '/', headers=self.cdmi('application/cdmi-container'),
+                     data=json.dumps({'metadata': self.metadata}))
+
+    def put(self, path, datastream):
+        self.request('PUT', self.url(path), headers={'Content-Type': 'application/octet-stream'},
+                     data=datastream)
+
+    def fill(self, path, names):
+        for name in names:
+            self.put(path + [name], io.BytesIO(''))
+
+    def get(self, path):
+        response = self.request('GET', self.url(path), stream=True)
+        return sum(len(data) for data in response.iter_content(CHUNK_SIZE))
+
+    def list(self, path):
+        return self.request('GET', self.url(path) + '/?children', headers=self.cdmi()).json()['children']
+
+    def oid(self, path):
+        return self.request('GET', self.url(path) + '?objectID', headers=self.cdmi()).json()['objectID']
+
+    def get_by_oid(self, oid):
+        url = '%s/cdmi_objectid/%s?objectName' % (self.endpoint, oid)
+        return self.request('GET', url, headers=self.cdmi()).json()['objectName']
+
+    def cold(self):
+        pass
+
+    def close(self):
+        self.session.close()
+
+
+def percentile(values, p):
+    """ Nearest-rank percentile of sorted values """
+    return values[max(0, int(math.ceil(p / 100.0 * len(values))) - 1)]
+
+
+def peak_rss():
+    """ Peak resident set size of this process in bytes """
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return maxrss if sys.platform == 'darwin' else maxrss * 1024
+
+
+def measure(scenario, backend, op, items):
+    """ Run op on each of the items, timing each call. op returns the number of bytes transferred """
+    latencies = []
+    transferred = 0
+    started = time.time()
+    for item in items:
+        began = time.time()
+        transferred += op(item) or 0
+        latencies.append(time.time() - began)
+    elapsed = time.time() - started
+
+    latencies.sort()
+    result = {'scenario': scenario,
+              'backend': backend,
+              'operations': len(latencies),
+              'seconds': elapsed,
+              'operations_per_second': len(latencies) / elapsed if elapsed else None,
+              'latency_ms': {'p50': percentile(latencies, 50) * 1000,
+                             'p99': percentile(latencies, 99) * 1000,
+                             'max': latencies[-1] * 1000}}
+    if transferred:
+        result['bytes'] = transferred
+        result['bytes_per_second'] = transferred / elapsed if elapsed else None
+    return result
+
+
+def run_small(target, backend, options):
+    size = options.small_size
+    payload = os.urandom(size)
+    names = ['small-%06d' % n for n in xrange(options.small_count)]
+    target.create_container(['small'])
+
+    def put(name):
+        target.put(['small', name], io.BytesIO(payload))
+        return size
+
+    yield measure('small_put', backend, put, names)
+    target.cold()
+    yield measure('small_get', backend, lambda name: target.get(['small', name]), names)
+
+
+def run_large(target, backend, options):
+    size = options.large_size
+    block = os.urandom(CHUNK_SIZE)
+    names = ['large-%03d' % n for n in xrange(options.large_count)]
+    target.create_container(['large'])
+
+    def put(name):
+        target.put(['large', name], PatternStream(size, block))
+        return size
+
+    yield measure('large_put', backend, put, names)
+    target.cold()
+    yield measure('large_get', backend, lambda name: target.get(['large', name]), names)
+
+
+def run_flat_listing(target, backend, options):
+    target.create_container(['flat'])
+    target.fill(['flat'], ['flat-%07d' % n for n in xrange(options.flat_children)])
+    def list_flat(n):
+        target.list(['flat'])
+
+    target.cold()
+    yield measure('flat_listing', backend, list_flat, xrange(options.repeat))
+
+
+def run_deep_listing(target, backend, options):
+    path = ['deep']
+    paths = [list(path)]
+    target.create_container(path)
+    for level in xrange(options.deep_levels):
+        target.fill(path, ['deep-%03d-%03d' % (level, n) for n in xrange(options.deep_children)])
+        path.append('level-%03d' % level)
+        target.create_container(path)
+        paths.append(list(path))
+
+    def walk(n):
+        for path in paths:
+            target.list(path)
+
+    target.cold()
+    yield measure('deep_listing', backend, walk, xrange(options.repeat))
+
+
+def run_objectid_lookup(target, backend, options):
+    names = ['lookup-%07d' % n for n in xrange(options.lookup_objects)]
+    target.create_container(['lookup'])
+    target.fill(['lookup'], names)
+    oids = [target.oid(['lookup', name]) for name in random.sample(names, min(len(names), options.lookups))]
+    def lookup(oid):
+        target.get_by_oid(oid)
+
+    target.cold()
+    yield measure('objectid_lookup', backend, lookup, oids)
+
+
+def summarize(result):
+    line = '%-16s %-5s %8d ops %10.1f ops/s  p50 %9.3f ms  p99 %9.3f ms' % (
+        result['scenario'], result['backend'], result['operations'], result['operations_per_second'] or 0,
+        result['latency_ms']['p50'], result['latency_ms']['p99'])
+    if 'bytes_per_second' in result:
+        line += '  %9.1f MB/s' % ((result['bytes_per_second'] or 0) / 2.0 ** 20)
+    return line
+
+
+def parse_args(args):
+    parser = argparse.ArgumentParser(description='Benchmark suite of Stoxy. By default ("storage" mode) only the '
+                                     'models and data stores are run, in this process: the CDMI views and the '
+                                     'HTTP request path are not measured; use --endpoint to measure them.')
+    parser.add_argument('--backend', action='append', choices=BACKENDS, help='data store (default: all)')
+    parser.add_argument('--scenario', action='append', choices=SCENARIOS, help='scenario (default: all)')
+    parser.add_argument('--quick', action='store_true',
+                        help='a tenth of the default sizes and counts not given explicitly, for smoke tests')
+    parser.add_argument('--output', help='file to write the JSON report to (default: standard output)')
+    parser.add_argument('--seed', type=int, default=0, help='seed of the random choices')
+    parser.add_argument('--endpoint', help='run over HTTP against a running server, measuring the views and '
+                        'the HTTP request path, e.g. http://localhost:8080/storage')
+    parser.add_argument('--credentials', default='john:john', help='user:password for --endpoint')
+    parser.add_argument('--file-base', help='stoxy_backend_base of the containers created with --endpoint')
+    parser.add_argument('--small-count', type=int, default=2000)
+    parser.add_argument('--small-size', type=int, default=4096)
+    parser.add_argument('--large-count', type=int, default=5)
+    parser.add_argument('--large-size', type=int, default=128 * 2 ** 20)
+    parser.add_argument('--flat-children', type=int, default=100000)
+    parser.add_argument('--deep-levels', type=int, default=50)
+    parser.add_argument('--deep-children', type=int, default=20)
+    parser.add_argument('--lookup-objects', type=int, default=20000)
+    parser.add_argument('--lookups', type=int, default=10000)
+    parser.add_argument('--repeat', type=int, default=20, help='repetitions of the listing scenarios')
+
+    if parser.parse_known_args(args)[0].quick:
+        # only the defaults are scaled: values given on the command line are kept
+        parser.set_defaults(**dict((option, max(1, parser.get_default(option) // 10))
+                                   for option in ('small_count', 'large_size', 'flat_children', 'deep_levels',
+                                                  'lookup_objects', 'lookups')))
+    return parser.parse_args(args)
+
+
+def main(args):
+    options = parse_args(args)
+    random.seed(options.seed)
+    report = {'started': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+              'mode': 'http' if options.endpoint else 'storage',
+              'python': platform.python_version(),
+              'platform': platform.platform(),
+              'parameters': dict((k, v) for k, v in vars(options).items() if k != 'credentials'),
+              'results': []}
+
+    for backend in options.backend or BACKENDS:
+        directory = tempfile.mkdtemp(prefix='stoxy-benchmark-')
+        try:
+            if options.endpoint:
+                target = HttpTarget(backend, options.endpoint, tuple(options.credentials.split(':', 1)),
+                                    options.file_base)
+            else:
+                target = StorageTarget(backend, directory)
+            try:
+                for scenario in options.scenario or SCENARIOS:
+                    for result in globals()['run_' + scenario](target, backend, options):
+                        print >> sys.stderr, summarize(result)
+                        report['results'].append(result)
+            finally:
+                target.close()
+        finally:
+            shutil.rmtree(directory)
+
+    # ru_maxrss is the peak of the whole process so far, so it cannot be attributed to single scenarios
+    report['peak_rss_bytes'] = peak_rss()
+    print >> sys.stderr, 'peak rss %d MB' % (report['peak_rss_bytes'] // 2 ** 20)
+    output = json.dumps(report, indent=2, sort_keys=True)
+    if options.output:
+        with open(options.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print output
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
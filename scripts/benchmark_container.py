@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+"""
+Benchmark of StorageContainer operations as the number of children in a flat container grows.
+
+Containers are stored in an in-memory ZODB. For each size, the time per operation of adding,
+looking up and deleting a batch of children, of listing a page of children and the size of the
+container's own persistent record are reported. With --legacy, children are kept in a plain
+PersistentDict, as in containers created by older versions.
+
+Usage: ./bin/python scripts/benchmark_container.py [--legacy] [size ...]
+"""
+import random
+import sys
+import time
+
+import transaction
+
+from persistent.mapping import PersistentDict
+from ZODB import DB
+from ZODB.MappingStorage import MappingStorage
+
+from stoxy.server.model.container import StorageContainer
+from stoxy.server.model.container import child_names
+from stoxy.server.model.dataobject import DataObject
+
+
+DEFAULT_SIZES = (1000, 10000, 100000, 1000000)
+BATCH = 1000
+PAGE = 100
+
+
+def timed(f, count):
+    started = time.time()
+    f()
+    transaction.commit()
+    return (time.time() - started) / count * 10 ** 6
+
+
+def record_size(container):
+    return len(container._p_jar.db().storage.load(container._p_oid, '')[0])
+
+
+def fill(container, begin, end):
+    for n in xrange(begin, end):
+        container.add(DataObject(name=u'object-%08d' % n))
+        if n % 10000 == 0:
+            transaction.commit()
+    transaction.commit()
+
+
+def run(sizes, legacy):
+    db = DB(MappingStorage())
+    root = db.open().root()
+    container = root['container'] = StorageContainer(name=u'benchmark')
+    if legacy:
+        container._items = PersistentDict()
+        container._length = None
+    transaction.commit()
+
+    print '%10s %12s %12s %12s %12s %14s' % ('children', 'add (us)', 'get (us)', 'delete (us)',
+                                            'page (us)', 'record (bytes)')
+    current = 0
+    for size in sizes:
+        fill(container, current, size - BATCH)
+        current = size - BATCH
+
+        names = [u'object-%08d' % n for n in xrange(current, size)]
+        add = timed(lambda: [container.add(DataObject(name=name)) for name in names], BATCH)
+        current = size
+
+        sample = random.sample(xrange(size), BATCH)
+        get = timed(lambda: [container[u'object-%08d' % n] for n in sample], BATCH)
+        page = timed(lambda: child_names(container, size // 2, size // 2 + PAGE), 1)
+        recsize = record_size(container)
+
+        delete = timed(lambda: [container.__delitem__(name) for name in names], BATCH)
+        fill(container, size - BATCH, size)
+
+        print '%10d %12.1f %12.1f %12.1f %12.1f %14d' % (size, add, get, delete, page, recsize)
+
+    db.close()
+
+
+if __name__ == '__main__':
+    args = sys.argv[1:]
+    legacy = '--legacy' in args
+    sizes = [int(arg) for arg in args if arg != '--legacy'] or DEFAULT_SIZES
+    run(sorted(sizes), legacy)
@@ -9,6 +9,8 @@ from opennode.oms.config import gen_config_file_names
 from opennode.oms.model.model import creatable_models
 from opennode.oms.model.model.plugins import IPlugin, PluginInfo
 
+from stoxy.server import metrics
+from stoxy.server.backend import writebehind
 from stoxy.server.model.dataobject import DataObject
 from stoxy.server.model.container import StorageContainer
 
@@ -34,3 +36,6 @@ class StoxyPlugin(PluginInfo):
                                       for cls in [DataObject, StorageContainer])
 
         creatable_models.update(stoxy_creatable_models)
+
+        metrics.start()
+        writebehind.start()
@@ -0,0 +1,390 @@
+"""
+Read-through cache of object data in front of data stores
+"""
+import hashlib
+import io
+import logging
+import os
+import tempfile
+import threading
+
+from collections import OrderedDict
+
+from grokcore.component import implements
+
+from opennode.oms.config import get_config
+
+from stoxy.server.common import get_stream_size
+from stoxy.server.model.store import IDataStore
+
+
+log = logging.getLogger(__name__)
+
+DEFAULT_MEMORY_MAX_OBJECT_SIZE = 64 * 1024
+
+
+class MemoryCache(object):
+    """
+    LRU cache of object data within a budget of `size` bytes. Objects larger than `max_object_size`
+    bytes are never cached. Entries are keyed by tuples starting with the URI of the data, so that all
+    the entries of a URI can be invalidated at once.
+    """
+
+    def __init__(self, size, max_object_size):
+        self.size = size
+        self.max_object_size = max_object_size
+        self.used = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._keys_by_uri = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            data = self._entries.pop(key, None)
+            if data is None:
+                self.misses += 1
+                return None
+            self._entries[key] = data
+            self.hits += 1
+            return data
+
+    def put(self, key, data):
+        if len(data) > self.max_object_size or len(data) > self.size:
+            return
+
+        with self._lock:
+            self._remove(key)
+            while self._entries and self.used + len(data) > self.size:
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+            self._entries[key] = data
+            self._keys_by_uri.setdefault(key[0], set()).add(key)
+            self.used += len(data)
+
+    def invalidate(self, uri):
+        with self._lock:
+            for key in list(self._keys_by_uri.get(uri, ())):
+                self._remove(key)
+
+    def _remove(self, key):
+        data = self._entries.pop(key, None)
+        if data is None:
+            return
+        self.used -= len(data)
+        keys = self._keys_by_uri[key[0]]
+        keys.discard(key)
+        if not keys:
+            del self._keys_by_uri[key[0]]
+
+    def stats(self):
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                    'objects': len(self._entries), 'bytes': self.used, 'size': self.size}
+
+
+_memory_cache = None
+_memory_cache_lock = threading.Lock()
+
+
+def get_memory_cache():
+    """ Return the memory cache or None if it is disabled """
+    global _memory_cache
+    with _memory_cache_lock:
+        if _memory_cache is None:
+            config = get_config()
+            size = config.getint('cache', 'memory_size', 0)
+            if size <= 0:
+                return None
+            _memory_cache = MemoryCache(size, config.getint('cache', 'memory_max_object_size',
+                                                            DEFAULT_MEMORY_MAX_OBJECT_SIZE))
+        return _memory_cache
+
+
+class DiskCacheEntry(object):
+
+    def __init__(self, path, etag, size):
+        self.path = path
+        self.etag = etag
+        self.size = size
+        self.hits = 0
+
+    def open(self):
+        return open(self.path, 'rb')
+
+
+class DiskCache(object):
+    """
+    Cache of object data in local files within a budget of `size` bytes, for remote backends. Each
+    entry is stored with the ETag of the data in its file name, so that it can be validated with the
+    backend and survives restarts. Entries are evicted least recently ('lru') or least frequently
+    ('lfu') used first. Files are filled under a temporary name, by a CacheFillingStream while the data
+    is served, and renamed into place when complete.
+    """
+
+    def __init__(self, directory, size, max_object_size, policy='lru'):
+        self.directory = directory
+        self.size = size
+        self.max_object_size = max_object_size
+        self.policy = policy
+        self.used = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._load()
+
+    def _name(self, key):
+        return hashlib.sha1(key.encode('utf-8') if isinstance(key, unicode) else key).hexdigest()
+
+    def _load(self):
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+
+        files = []
+        for filename in os.listdir(self.directory):
+            path = os.path.join(self.directory, filename)
+            name, sep, etag = filename.partition('.')
+            if not sep or name.startswith('tmp'):
+                # unfinished fill
+                os.unlink(path)
+                continue
+            st = os.stat(path)
+            files.append((st.st_atime, name, path, etag.decode('hex'), st.st_size))
+
+        for atime, name, path, etag, size in sorted(files):
+            self._entries[name] = DiskCacheEntry(path, etag, size)
+            self.used += size
+
+        log.info('Disk cache in %s: %d objects, %d bytes', self.directory, len(self._entries), self.used)
+
+    def lookup(self, key):
+        """ Return the entry of the key or None. The entry may still have to be validated with the
+        backend: the lookup is counted once the entry is served (record_hit) or not (record_miss) """
+        with self._lock:
+            return self._entries.get(self._name(key))
+
+    def record_hit(self, key):
+        with self._lock:
+            entry = self._entries.pop(self._name(key), None)
+            if entry is not None:
+                self._entries[self._name(key)] = entry
+                entry.hits += 1
+            self.hits += 1
+
+    def record_miss(self):
+        with self._lock:
+            self.misses += 1
+
+    def add(self, key, etag, temp_path):
+        """ Make the filled temporary file in the cache directory the entry of the key. Returns the entry """
+        name = self._name(key)
+        entry = DiskCacheEntry(os.path.join(self.directory, '%s.%s' % (name, etag.encode('hex'))),
+                               etag, os.path.getsize(temp_path))
+
+        with self._lock:
+            current = self._entries.get(name)
+            if current is not None and current.etag == etag:
+                # filled concurrently by another request
+                os.unlink(temp_path)
+                return current
+
+            self._remove(name)
+            while self._entries and self.used + entry.size > self.size:
+                self._remove(self._victim())
+                self.evictions += 1
+            os.rename(temp_path, entry.path)
+            self._entries[name] = entry
+            self.used += entry.size
+
+        return entry
+
+    def _victim(self):
+        if self.policy == 'lfu':
+            # least hits, the least recently used of them on ties
+            victim, lowest = None, None
+            for name, entry in self._entries.iteritems():
+                if lowest is None or entry.hits < lowest:
+                    victim, lowest = name, entry.hits
+            return victim
+        return next(iter(self._entries))
+
+    def remove(self, key):
+        with self._lock:
+            self._remove(self._name(key))
+
+    def _remove(self, name):
+        entry = self._entries.pop(name, None)
+        if entry is None:
+            return
+        self.used -= entry.size
+        try:
+            os.unlink(entry.path)
+        except OSError as e:
+            log.warning('Could not remove cached file %s: %s', entry.path, e)
+
+    def stats(self):
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                    'objects': len(self._entries), 'bytes': self.used, 'size': self.size}
+
+
+class CacheFillingStream(object):
+    """
+    Passes the data of a stream through to its reader while writing it to a temporary file of a disk
+    cache. The file becomes the entry of the key once all of the data was read; it is discarded if the
+    stream is closed or seeks before that, or if reading fails.
+    """
+
+    def __init__(self, cache, key, etag, datastream):
+        self.cache = cache
+        self.key = key
+        self.etag = etag
+        self.datastream = datastream
+        self.size = datastream.size
+        self.written = 0
+        fd, self.temp_path = tempfile.mkstemp(prefix='tmp', dir=cache.directory)
+        self.file = os.fdopen(fd, 'wb')
+
+    def read(self, size=-1):
+        try:
+            data = self.datastream.read(size)
+        except Exception:
+            self._discard()
+            raise
+
+        if self.file is not None and data:
+            try:
+                self.file.write(data)
+            except (IOError, OSError) as e:
+                log.warning('Could not cache %s: %s', self.key, e)
+                self._discard()
+            else:
+                self.written += len(data)
+                if self.written >= self.size:
+                    self._finish()
+        return data
+
+    def tell(self):
+        return self.datastream.tell()
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence != os.SEEK_SET or offset != self.datastream.tell():
+            # the skipped data would be missing from the cached copy
+            self._discard()
+        self.datastream.seek(offset, whence)
+
+    def close(self):
+        self._discard()
+        self.datastream.close()
+
+    @property
+    def closed(self):
+        return self.datastream.closed
+
+    def _finish(self):
+        f, self.file = self.file, None
+        try:
+            f.close()
+            if self.written == self.size:
+                self.cache.add(self.key, self.etag, self.temp_path)
+                return
+        except (IOError, OSError) as e:
+            log.warning('Could not cache %s: %s', self.key, e)
+        self._unlink()
+
+    def _discard(self):
+        if self.file is not None:
+            f, self.file = self.file, None
+            f.close()
+            self._unlink()
+
+    def _unlink(self):
+        try:
+            os.unlink(self.temp_path)
+        except OSError:
+            pass
+
+
+_disk_cache = None
+_disk_cache_lock = threading.Lock()
+
+
+def get_disk_cache():
+    """ Return the disk cache of remote backends or None if it is disabled """
+    global _disk_cache
+    with _disk_cache_lock:
+        if _disk_cache is None:
+            config = get_config()
+            size = config.getint('cache', 'disk_size', 0)
+            if size <= 0:
+                return None
+            _disk_cache = DiskCache(config.getstring('cache', 'disk_directory', '/tmp/stoxy-cache'), size,
+                                    config.getint('cache', 'disk_max_object_size', size // 10),
+                                    config.getstring('cache', 'disk_policy', 'lru'))
+        return _disk_cache
+
+
+class CachingDataStore(object):
+    """
+    Read-through cache wrapper of a data store. Loaded data of small objects is kept in the cache and
+    served from memory until the object is saved, deleted or modified. Entries are specific to the
+    credentials they were loaded with, so backends still authorize every token at least once.
+    """
+    implements(IDataStore)
+
+    def __init__(self, store, cache):
+        self.store = store
+        self.cache = cache
+        obj = store.context
+        self.uri = obj.value
+        self.key_base = (obj.value, obj.oid, obj.version)
+
+    @property
+    def context(self):
+        return self.store.context
+
+    def save(self, datastream, encoding, credentials=None):
+        self.cache.invalidate(self.uri)
+        try:
+            return self.store.save(datastream, encoding, credentials)
+        finally:
+            self.cache.invalidate(self.uri)
+
+    def load(self, credentials=None):
+        key = self.key_base + (credentials, )
+        data = self.cache.get(key)
+        if data is not None:
+            return io.BytesIO(data)
+
+        datastream = self.store.load(credentials)
+        size = get_stream_size(datastream)
+        if size is None or size > self.cache.max_object_size:
+            return datastream
+
+        try:
+            data = datastream.read()
+        finally:
+            datastream.close()
+        self.cache.put(key, data)
+        return io.BytesIO(data)
+
+    def delete(self, credentials=None):
+        try:
+            return self.store.delete(credentials)
+        finally:
+            self.cache.invalidate(self.uri)
+
+    def copy(self, target, credentials=None):
+        self.cache.invalidate(target.context.value)
+        return self.store.copy(getattr(target, 'store', target), credentials)
+
+    def move(self, target, credentials=None):
+        self.cache.invalidate(target.context.value)
+        try:
+            return self.store.move(getattr(target, 'store', target), credentials)
+        finally:
+            self.cache.invalidate(self.uri)
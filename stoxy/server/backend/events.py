@@ -2,6 +2,7 @@ import logging
 
 from grokcore.component import subscribe
 
+from opennode.oms.model.model.events import IModelCreatedEvent
 from opennode.oms.model.model.events import IModelDeletedEvent
 from zope.component import getAdapter
 
@@ -13,14 +14,26 @@ from stoxy.server.model import store
 log = logging.getLogger(__name__)
 
 
+@subscribe(container.StorageContainer, IModelCreatedEvent)
+def handle_container_create(model, event):
+    container.index_object(model)
+
+
+@subscribe(dataobject.DataObject, IModelCreatedEvent)
+def handle_dataobject_create(model, event):
+    container.index_object(model)
+
+
 @subscribe(container.StorageContainer, IModelDeletedEvent)
 def handle_container_delete(model, event):
     log.debug('Deleting container: "%s"' % model)
+    container.unindex_object(model)
 
 
 @subscribe(dataobject.DataObject, IModelDeletedEvent)
 def handle_dataobject_delete(model, event):
     log.debug('Deleting object: "%s"' % model)
+    container.unindex_object(model)
     #storemgr = getAdapter(model, store.IDataStoreFactory).create()
     # TODO: passing credentials for the deletion operation is not clear atm if it's initiated via ssh
     #storemgr.delete(None)
@@ -1,23 +1,107 @@
 """
 Module for data managers tasked with storage of CDMI object data
 """
-import base64
+import errno
+import hashlib
 import logging
 import os
+import shutil
 import StringIO
 
+from base64 import b64encode
+
+import transaction
+
 from grokcore.component import implements, name, Adapter, context
 from zope.component import getAdapter
 
 from opennode.oms.config import get_config
+from opennode.oms.endpoint.httprest.root import BadRequest
 
+from stoxy.server.model.container import get_storage_root
+from stoxy.server.model.container import iter_storage
 from stoxy.server.model.dataobject import IDataObject
-from stoxy.server.model.store import IDataStore, IDataStoreFactory
+from stoxy.server.backend import writebehind
+from stoxy.server.backend.cache import CachingDataStore
+from stoxy.server.backend.cache import get_memory_cache
+from stoxy.server.backend.threadpool import defer_to_backend
+from stoxy.server.metrics import instrument
+from stoxy.server.model.store import IAsyncDataStore, IDataStore, IDataStoreFactory
+from stoxy.server.common import Base64DecodingStream
+from stoxy.server.common import HashingStream
+from stoxy.server.common import normalize_hash_algorithm
 from stoxy.server.common import parse_uri
 
 
 log = logging.getLogger(__name__)
 
+DEFAULT_BLOCK_SIZE = 1024 * 1024
+
+
+FSYNC_POLICIES = ('none', 'file', 'file+dir')
+FILE_LAYOUTS = ('flat', 'sharded')
+
+
+def get_file_layout(container):
+    """ Layout of the files of the data objects of a container below its base path: as requested by its
+    stoxy_backend_layout metadata or the configured default """
+    layout = (container.metadata or {}).get('stoxy_backend_layout') or \
+        get_config().getstring('store', 'file_layout', 'sharded')
+    if layout not in FILE_LAYOUTS:
+        log.warning('Unknown file layout %s of %s, using "sharded"', layout, container)
+        return 'sharded'
+    return layout
+
+
+def file_path(base, oid, name, layout):
+    """
+    Path of the data of an object below the base path. In the flat layout files are named after the objects,
+    all in the base directory. In the sharded layout they are named by object ID and fanned out to two levels
+    of 256 directories each by a hash of the ID, which keeps directories small and names unique.
+    """
+    if layout == 'flat':
+        return '%s/%s' % (base, name)
+    digest = hashlib.md5(oid.encode('utf-8')).hexdigest()
+    return '%s/%s/%s/%s' % (base, digest[:2], digest[2:4], oid)
+
+
+def ensure_directory(path, sync=False):
+    """ Create the directory and its missing parents. With sync, the parent of each created directory is
+    synced too, so that the new directories survive a crash """
+    missing = []
+    path = os.path.normpath(path)
+    while path and not os.path.isdir(path):
+        missing.append(path)
+        path = os.path.dirname(path)
+
+    for directory in reversed(missing):
+        try:
+            os.mkdir(directory)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        else:
+            if sync:
+                fsync_directory(os.path.dirname(directory) or os.curdir)
+
+
+def get_fsync_policy():
+    """ What the file backend syncs to disk before a save completes: nothing, the data of the file or also
+    its directory entry, as configured in the [store] section """
+    policy = get_config().getstring('store', 'fsync', 'none')
+    if policy not in FSYNC_POLICIES:
+        log.warning('Unknown fsync policy %s, using "none"', policy)
+        return 'none'
+    return policy
+
+
+def fsync_directory(path):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
 
 class FileStore(Adapter):
     implements(IDataStore)
@@ -28,16 +112,33 @@ class FileStore(Adapter):
         protocol, schema, host, path = parse_uri(self.context.value)
         assert protocol == 'file', protocol
         assert path, path
-        b = 6 * 1024
+        block_size = get_config().getint('store', 'block_size', DEFAULT_BLOCK_SIZE)
+
+        fsync = get_fsync_policy()
+
+        if encoding == 'base64':
+            datastream = Base64DecodingStream(datastream)
+
+        # data is written to a temporary file renamed over the object's file once complete: readers see
+        # either the old or the new data, and copies sharing the old file as hard links keep it
+        temp_path = os.path.join(os.path.dirname(path), '.%s.%s.tmp' % (os.path.basename(path),
+                                                                        os.urandom(6).encode('hex')))
         log.debug('Writing file: "%s"' % path)
-        with open(path, 'wb') as f:
-            d = datastream.read(b)
-            if encoding == 'base64':
-                d = base64.b64decode(d)
-            f.write(d)
-            while len(d) == b and not datastream.closed:
-                d = datastream.read(b)
-                f.write(d)
+        ensure_directory(os.path.dirname(path), sync=fsync == 'file+dir')
+        fd = os.open(temp_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0666)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                shutil.copyfileobj(datastream, f, block_size)
+                if fsync != 'none':
+                    f.flush()
+                    os.fsync(f.fileno())
+            os.rename(temp_path, path)
+        except Exception:
+            os.unlink(temp_path)
+            raise
+
+        if fsync == 'file+dir':
+            fsync_directory(os.path.dirname(path))
 
     def load(self, credentials=None):
         protocol, schema, host, path = parse_uri(self.context.value)
@@ -52,6 +153,39 @@ class FileStore(Adapter):
         log.debug('Unlinking "%s"' % path)
         os.unlink(path)
 
+    def _paths(self, target):
+        paths = []
+        for obj in (self.context, target.context):
+            protocol, schema, host, path = parse_uri(obj.value)
+            assert protocol == 'file', protocol
+            assert path, path
+            paths.append(path)
+        return paths
+
+    def copy(self, target, credentials=None):
+        source_path, target_path = self._paths(target)
+        log.debug('Linking "%s" to "%s"' % (source_path, target_path))
+        ensure_directory(os.path.dirname(target_path))
+        try:
+            os.link(source_path, target_path)
+        except OSError as e:
+            if e.errno not in (errno.EXDEV, errno.EPERM, errno.EEXIST, errno.EMLINK):
+                raise
+            return False
+        return True
+
+    def move(self, target, credentials=None):
+        source_path, target_path = self._paths(target)
+        log.debug('Renaming "%s" to "%s"' % (source_path, target_path))
+        ensure_directory(os.path.dirname(target_path))
+        try:
+            os.rename(source_path, target_path)
+        except OSError as e:
+            if e.errno != errno.EXDEV:
+                raise
+            return False
+        return True
+
 
 class Blackhole(Adapter):
     implements(IDataStore)
@@ -75,6 +209,104 @@ class Blackhole(Adapter):
         assert protocol == 'null', protocol
         assert path, path
 
+    def copy(self, target, credentials=None):
+        return True
+
+    def move(self, target, credentials=None):
+        return True
+
+
+class AsyncDataStore(object):
+    """ Runs the blocking operations of a data store in the thread pool of its backend """
+    implements(IAsyncDataStore)
+
+    def __init__(self, store, backend):
+        self.store = store
+        self.backend = backend
+
+    def save(self, datastream, encoding, credentials=None):
+        return defer_to_backend(self.backend, self.store.save, datastream, encoding, credentials)
+
+    def load(self, credentials=None):
+        return defer_to_backend(self.backend, self.store.load, credentials)
+
+    def delete(self, credentials=None):
+        return defer_to_backend(self.backend, self.store.delete, credentials)
+
+
+def get_hash_algorithm(obj):
+    """ Hash algorithm for the value of a data object: the one requested in its cdmi_value_hash metadata
+    or the configured default """
+    requested = (obj.metadata or {}).get('cdmi_value_hash')
+    algorithm = normalize_hash_algorithm(requested)
+
+    if algorithm is None:
+        if requested is not None:
+            log.warning('Unsupported hash algorithm %s requested for %s' % (requested, obj))
+        algorithm = normalize_hash_algorithm(get_config().getstring('store', 'hash_algorithm', 'md5'))
+
+    return algorithm
+
+
+def save_data(store, datastream, encoding, credentials=None, content_md5=None):
+    """
+    Save data of the data object of the store, hashing it as it is written. The digest is recorded on
+    the data object. If content_md5 (base64 encoded, as in the Content-MD5 header) is given, the MD5
+    of the data must match it.
+    """
+    obj = store.context
+    algorithm = get_hash_algorithm(obj)
+    algorithms = set(filter(None, [algorithm, 'md5' if content_md5 is not None else None]))
+
+    if encoding == 'base64':
+        datastream = Base64DecodingStream(datastream)
+
+    datastream = HashingStream(datastream, algorithms)
+    store.save(datastream, 'utf-8', credentials)
+
+    if content_md5 is not None and b64encode(datastream.digest('md5')) != content_md5.strip():
+        raise BadRequest('Content-MD5 of %s does not match the received data' % obj.name)
+
+    obj.hash_algorithm = algorithm
+    obj.value_hash = datastream.hexdigest(algorithm) if algorithm is not None else None
+    obj.touch()
+
+
+def transfer_data(source, target, credentials=None, move=False):
+    """
+    Copy or move the data of the source data object to the target one. Within a backend the native
+    primitives of the backend are used; otherwise, or when they cannot be used, the data is streamed
+    from the source to the target in blocks.
+    """
+    source_backend = getAdapter(source, IDataStoreFactory).get_backend()
+    target_backend = getAdapter(target, IDataStoreFactory).get_backend()
+
+    if source.value == target.value:
+        log.debug('Data of %s is already stored at %s' % (source, target.value))
+        target.hash_algorithm = source.hash_algorithm
+        target.value_hash = source.value_hash
+        return
+
+    source_store = instrument(getAdapter(source, IDataStore, source_backend), source_backend)
+    target_store = instrument(getAdapter(target, IDataStore, target_backend), target_backend)
+
+    if source_backend == target_backend:
+        native = source_store.move if move else source_store.copy
+        if native(target_store, credentials):
+            target.hash_algorithm = source.hash_algorithm
+            target.value_hash = source.value_hash
+            return
+
+    log.debug('Streaming data from %s to %s' % (source.value, target.value))
+    datastream = source_store.load(credentials)
+    try:
+        save_data(target_store, datastream, 'utf-8', credentials)
+    finally:
+        datastream.close()
+
+    if move:
+        source_store.delete(credentials)
+
 
 class DataStoreFactory(Adapter):
     implements(IDataStoreFactory)
@@ -92,17 +324,84 @@ class DataStoreFactory(Adapter):
         else:
             backend_base = parent_md.get('stoxy_backend_base',
                                          get_config().getstring('store', 'file_base_path', '/tmp'))
-            path = '%s/%s' % (backend_base, object_.name)
+            path = file_path(backend_base, object_.oid, object_.name, get_file_layout(object_.__parent__))
             uri = 'file+%s://%s' % (backend, path)
 
         log.debug('Constructed internal uri %s' % uri)
         return (uri, backend)
 
-    def create(self):
+    def get_backend(self):
         if self.context.value:
             protocol, schema, host, path = parse_uri(self.context.value)
         else:
             uri, protocol = self.make_uri(self.context)
             self.context.value = uri
 
-        return getAdapter(self.context, IDataStore, protocol)
+        return protocol
+
+    def _create(self, backend):
+        store = instrument(getAdapter(self.context, IDataStore, backend), backend)
+        if self.context.completion_status == writebehind.PROCESSING:
+            spool = writebehind.get_write_behind_queue().spool(self.context, self.context.version)
+            store = writebehind.WriteBehindDataStore(store, spool)
+        cache = get_memory_cache()
+        return CachingDataStore(store, cache) if cache is not None else store
+
+    def create(self):
+        return self._create(self.get_backend())
+
+    def create_async(self):
+        backend = self.get_backend()
+        return AsyncDataStore(self._create(backend), backend)
+
+
+def migrate_file_layout(container=None):
+    """
+    Relocate the files of the data objects of the file backend below the given container (the storage root by
+    default) to the layout of their containers, e.g. from the flat layout of older versions to the sharded one.
+    Must be run inside a transaction: files are linked at their new paths first and their old paths are removed
+    only once the transaction commits (or the new ones, if it fails). Returns the number of relocated objects.
+    """
+    relocated = []
+
+    for obj in iter_storage(get_storage_root() if container is None else container):
+        if not IDataObject.providedBy(obj) or not obj.value:
+            continue
+
+        protocol, schema, host, path = parse_uri(obj.value)
+        if protocol != 'file':
+            continue
+
+        uri, backend = getAdapter(obj, IDataStoreFactory).make_uri(obj)
+        new_path = parse_uri(uri)[3]
+        if backend != 'file' or new_path == path:
+            continue
+
+        if not os.path.exists(path):
+            log.warning('Data of %s is missing at %s, not relocated', obj, path)
+            continue
+
+        ensure_directory(os.path.dirname(new_path))
+        if os.path.exists(new_path):
+            # left by an earlier run that did not commit
+            os.unlink(new_path)
+        try:
+            os.link(path, new_path)
+        except OSError as e:
+            if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK):
+                raise
+            shutil.copyfile(path, new_path)
+
+        log.debug('Relocated data of %s from %s to %s', obj, path, new_path)
+        obj.value = uri
+        relocated.append((path, new_path))
+
+    def cleanup(success):
+        for path in set(old if success else new for old, new in relocated):
+            try:
+                os.unlink(path)
+            except OSError as e:
+                log.warning('Could not remove %s: %s', path, e)
+
+    transaction.get().addAfterCommitHook(cleanup)
+    return len(relocated)
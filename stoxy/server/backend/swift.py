@@ -1,14 +1,27 @@
 """
 OpenStack Swift data manager implementation using python-swiftclient
 """
+import hashlib
+import json
 import logging
-import StringIO
+import os
+import tempfile
+import threading
+import time
+
+from contextlib import contextmanager
+from urllib import quote
 
 from swiftclient import client
 from grokcore.component import implements, name, Adapter, context
 
+from opennode.oms.config import get_config
 from opennode.oms.endpoint.httprest.root import BadRequest
 
+from stoxy.server.backend.cache import CacheFillingStream
+from stoxy.server.backend.cache import get_disk_cache
+from stoxy.server.common import Base64DecodingStream
+from stoxy.server.common import get_stream_size
 from stoxy.server.common import parse_uri
 from stoxy.server.model.dataobject import IDataObject
 from stoxy.server.model.store import IDataStore
@@ -16,6 +29,370 @@ from stoxy.server.model.store import IDataStore
 
 log = logging.getLogger(__name__)
 
+DEFAULT_SEGMENT_SIZE = 2 ** 30
+BLOCK_SIZE = 2 ** 20
+
+
+def split_swift_uri(uri):
+    """ Split an internal Swift object URI into the storage URL, Swift container and object name """
+    protocol, schema, host, path = parse_uri(uri)
+    segments = path.lstrip('/').split('/')
+
+    if len(segments) >= 4:
+        # /<version>/<account>/<container>/<object>
+        base, container, objname = segments[:2], segments[2], '/'.join(segments[3:])
+    else:
+        base, container, objname = segments[:-2], segments[-2], segments[-1]
+
+    return '%s:%s/%s' % (schema, host, '/'.join(base)), container, objname
+
+
+def quote_path(*segments):
+    return quote('/'.join(segment.encode('utf-8') if isinstance(segment, unicode) else segment
+                          for segment in segments))
+
+
+def is_large_object(url, token, container, objname, http_conn):
+    """ Whether the Swift object is the manifest of a Static Large Object """
+    headers = client.head_object(url, token, container, objname, http_conn=http_conn)
+    return headers.get('x-static-large-object', '').lower() == 'true'
+
+
+def large_object_segments(url, token, container, objname, http_conn):
+    """ Containers and names of the segments of a Static Large Object, empty if the object does not exist
+    or is not a large object """
+    try:
+        if not is_large_object(url, token, container, objname, http_conn):
+            return []
+        headers, body = client.get_object(url, token, container, objname,
+                                          query_string='multipart-manifest=get', http_conn=http_conn)
+    except client.ClientException as e:
+        if e.http_status == 404:
+            return []
+        raise
+    return [tuple(segment['name'].lstrip('/').split('/', 1)) for segment in json.loads(body)]
+
+
+def delete_segments(url, token, segments):
+    """ Delete the segments of a replaced large object, logging the ones that could not be removed """
+    for segment_container, segment in segments:
+        try:
+            with get_connection_pool().connection(url, token) as http_conn:
+                client.delete_object(url, token, segment_container, segment, http_conn=http_conn)
+        except Exception as e:
+            log.warning('Could not remove segment %s of a replaced large object: %s', segment, e)
+
+
+def delete_large_object(url, token, container, objname, http_conn):
+    """
+    Delete a Static Large Object together with its segments. Swift reports the deletion of the segments in
+    the body of the response, like a bulk delete, and answers 200 even if some of them failed: failures are
+    raised as a ClientException.
+    """
+    parsed, conn = http_conn
+    path = '%s%s?multipart-manifest=delete' % (parsed.path, quote_path('', container, objname))
+    conn.request('DELETE', path, '', {'X-Auth-Token': token, 'Accept': 'application/json'})
+    response = conn.getresponse()
+    body = response.read()
+
+    if response.status < 200 or response.status >= 300:
+        raise client.ClientException('Object DELETE failed', http_status=response.status,
+                                     http_reason=response.reason, http_response_content=body)
+
+    try:
+        result = json.loads(body) if body else {}
+    except ValueError:
+        raise client.ClientException('Unexpected response to the deletion of a large object',
+                                     http_status=response.status, http_response_content=body)
+
+    status = result.get('Response Status', '200 OK')
+    errors = result.get('Errors')
+    if errors or not status.startswith('2'):
+        raise client.ClientException('Deleting large object %s failed: %s %s' % (objname, status, errors),
+                                     http_status=int(status.split()[0]), http_response_content=body)
+
+
+def close_connection(http_conn):
+    parsed, conn = http_conn
+    close = getattr(conn, 'close', None)
+    if close is not None:
+        close()
+
+
+class SwiftConnectionPool(object):
+    """
+    Keep-alive connections to Swift, shared between requests and kept per (storage URL, token).
+    At most `size` idle connections are kept per key; connections idle for longer than
+    `idle_timeout` seconds are closed.
+    """
+
+    def __init__(self, size, idle_timeout):
+        self.size = size
+        self.idle_timeout = idle_timeout
+        self._idle = {}
+        self._lock = threading.Lock()
+
+    def _evict(self, now):
+        for key, connections in self._idle.items():
+            stale = [http_conn for last_used, http_conn in connections
+                     if now - last_used > self.idle_timeout]
+            for http_conn in stale:
+                close_connection(http_conn)
+            connections[:] = [(last_used, http_conn) for last_used, http_conn in connections
+                              if now - last_used <= self.idle_timeout]
+            if not connections:
+                del self._idle[key]
+
+    def acquire(self, url, token):
+        with self._lock:
+            self._evict(time.time())
+            connections = self._idle.get((url, token))
+            if connections:
+                return connections.pop()[1]
+
+        log.debug('Opening a new connection to %s', url)
+        return client.http_connection(url)
+
+    def release(self, url, token, http_conn):
+        with self._lock:
+            connections = self._idle.setdefault((url, token), [])
+            if len(connections) < self.size:
+                connections.append((time.time(), http_conn))
+                return
+
+        close_connection(http_conn)
+
+    @contextmanager
+    def connection(self, url, token):
+        http_conn = self.acquire(url, token)
+        try:
+            yield http_conn
+        except Exception:
+            # the state of the connection is unknown, do not reuse it
+            close_connection(http_conn)
+            raise
+        else:
+            self.release(url, token, http_conn)
+
+
+_connection_pool = None
+_connection_pool_lock = threading.Lock()
+
+
+def get_connection_pool():
+    global _connection_pool
+    with _connection_pool_lock:
+        if _connection_pool is None:
+            config = get_config()
+            _connection_pool = SwiftConnectionPool(config.getint('swift', 'connection_pool_size', 10),
+                                                   config.getint('swift', 'connection_idle_timeout', 60))
+        return _connection_pool
+
+
+class SwiftObjectStream(object):
+    """
+    Read-only file-like access to a Swift object body, streamed as it is received. Holds a pooled
+    connection until the body is exhausted or the stream is closed. Seeking is supported forward:
+    short gaps are skipped by reading, longer ones by requesting the rest of the object as a range.
+    """
+    MAX_SKIP = 2 ** 20
+
+    def __init__(self, url, token, container, objname, chunk_size, headers=None):
+        self.url = url
+        self.token = token
+        self.container = container
+        self.objname = objname
+        self.chunk_size = chunk_size
+        self.closed = False
+        self.size = None
+        self.etag = None
+        self._http_conn = None
+        self._open(0, headers)
+
+    def _open(self, offset, headers=None):
+        self._http_conn = get_connection_pool().acquire(self.url, self.token)
+        headers = dict(headers or {})
+        if offset:
+            headers['Range'] = 'bytes=%d-' % offset
+        try:
+            response, body = client.get_object(self.url, self.token, self.container, self.objname,
+                                               http_conn=self._http_conn, resp_chunk_size=self.chunk_size,
+                                               headers=headers)
+        except Exception:
+            self._discard()
+            raise
+
+        if self.size is None:
+            self.size = int(response['content-length']) if 'content-length' in response else None
+            self.etag = response.get('etag')
+
+        self._chunks = iter(body)
+        self._buffer = ''
+        self._position = offset
+        self._exhausted = False
+
+    def _discard(self):
+        if self._http_conn is not None:
+            close_connection(self._http_conn)
+            self._http_conn = None
+
+    def _release(self):
+        if self._http_conn is not None:
+            get_connection_pool().release(self.url, self.token, self._http_conn)
+            self._http_conn = None
+
+    def _fill(self, size):
+        while not self._exhausted and (size < 0 or len(self._buffer) < size):
+            try:
+                self._buffer += next(self._chunks)
+            except StopIteration:
+                self._exhausted = True
+                self._release()
+            except Exception:
+                self._discard()
+                raise
+
+    def read(self, size=-1):
+        if size is None:
+            size = -1
+        self._fill(size)
+        if size < 0:
+            size = len(self._buffer)
+        data, self._buffer = self._buffer[:size], self._buffer[size:]
+        self._position += len(data)
+        return data
+
+    def tell(self):
+        return self._position
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            offset += self._position
+        elif whence == os.SEEK_END:
+            offset += self.size
+
+        if offset < self._position:
+            raise IOError('Swift object streams cannot seek backwards')
+
+        if self.size is not None and offset >= self.size:
+            self._discard()
+            self._buffer = ''
+            self._position = offset
+            self._exhausted = True
+        elif offset - self._position <= max(self.MAX_SKIP, len(self._buffer)):
+            while self._position < offset and self.read(min(offset - self._position, self.chunk_size)):
+                pass
+        else:
+            self._discard()
+            self._open(offset)
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            # an unfinished response cannot be reused for further requests
+            self._discard()
+
+
+def spool_segment(datastream, segment_size):
+    """ Copy up to segment_size bytes of datastream to a temporary file. Returns the file, size and MD5 """
+    segment = tempfile.SpooledTemporaryFile(max_size=BLOCK_SIZE)
+    md5 = hashlib.md5()
+    size = 0
+
+    while size < segment_size:
+        data = datastream.read(min(BLOCK_SIZE, segment_size - size))
+        if not data:
+            break
+        segment.write(data)
+        md5.update(data)
+        size += len(data)
+
+    segment.seek(0)
+    return segment, size, md5.hexdigest()
+
+
+class SegmentedUpload(object):
+    """
+    Uploads an object as a Swift Static Large Object: segments are stored in the
+    '<container>_segments' container by a bounded number of concurrent workers and
+    are then referenced by a manifest stored under the object name.
+    """
+
+    def __init__(self, url, token, container, objname, workers):
+        self.url = url
+        self.token = token
+        self.container = container
+        self.objname = objname
+        self.segment_container = '%s_segments' % container
+        self.segment_prefix = '%s/%f' % (objname, time.time())
+        self.segments = []
+        self.errors = []
+        self._slots = threading.BoundedSemaphore(workers)
+        self._lock = threading.Lock()
+        self._threads = []
+
+        with get_connection_pool().connection(url, token) as http_conn:
+            client.put_container(url, token, self.segment_container, http_conn=http_conn)
+
+    def add_segment(self, segment, size, etag):
+        """ Start uploading the next segment, blocking while all the workers are busy """
+        self._slots.acquire()
+
+        if self.errors:
+            self._slots.release()
+            segment.close()
+            return
+
+        index = len(self._threads)
+        thread = threading.Thread(target=self._upload_segment, args=(index, segment, size, etag),
+                                  name='swift-segment-%s-%d' % (self.objname, index))
+        self._threads.append(thread)
+        thread.start()
+
+    def _upload_segment(self, index, segment, size, etag):
+        segment_name = '%s/%08d' % (self.segment_prefix, index)
+        try:
+            with get_connection_pool().connection(self.url, self.token) as http_conn:
+                client.put_object(self.url, self.token, self.segment_container, segment_name,
+                                  contents=segment, content_length=size, etag=etag, http_conn=http_conn)
+            with self._lock:
+                self.segments.append((index, segment_name, etag, size))
+        except Exception as e:
+            log.error('Uploading segment %s of Swift object %s failed: %s', index, self.objname, e)
+            with self._lock:
+                self.errors.append(e)
+        finally:
+            segment.close()
+            self._slots.release()
+
+    def finish(self):
+        for thread in self._threads:
+            thread.join()
+
+        if self.errors:
+            self.abort()
+            raise self.errors[0]
+
+        manifest = [{'path': '/%s/%s' % (self.segment_container, segment_name), 'etag': etag,
+                     'size_bytes': size}
+                    for index, segment_name, etag, size in sorted(self.segments)]
+
+        with get_connection_pool().connection(self.url, self.token) as http_conn:
+            client.put_object(self.url, self.token, self.container, self.objname,
+                              contents=json.dumps(manifest), query_string='multipart-manifest=put',
+                              http_conn=http_conn)
+
+        log.debug('Swift object %s saved as %d segments', self.objname, len(manifest))
+
+    def abort(self):
+        for index, segment, etag, size in self.segments:
+            try:
+                with get_connection_pool().connection(self.url, self.token) as http_conn:
+                    client.delete_object(self.url, self.token, self.segment_container, segment,
+                                         http_conn=http_conn)
+            except Exception as e:
+                log.warning('Could not remove segment %s of a failed upload: %s', segment, e)
+
 
 class SwiftStore(Adapter):
     implements(IDataStore)
@@ -27,27 +404,163 @@ class SwiftStore(Adapter):
             raise BadRequest('Swift backend requires credentials in x-auth-token headers')
 
         log.debug('Saving Swift object %s' % self.context.value)
-        protocol, schema, host, path = parse_uri(self.context.value)
-        uri = "%s:%s%s" % (schema, host, path)
-        client.put_object(uri, credentials, contents=datastream)
+        url, container, objname = split_swift_uri(self.context.value)
+        segment_size = get_config().getint('swift', 'segment_size', DEFAULT_SEGMENT_SIZE)
+
+        if encoding == 'base64':
+            datastream = Base64DecodingStream(datastream)
+
+        with get_connection_pool().connection(url, credentials) as http_conn:
+            # the segments of an overwritten large object are not referenced by anything afterwards
+            old_segments = large_object_segments(url, credentials, container, objname, http_conn)
+
+        size = get_stream_size(datastream)
+        if size is not None and size - datastream.tell() <= segment_size:
+            with get_connection_pool().connection(url, credentials) as http_conn:
+                client.put_object(url, credentials, container, objname, contents=datastream,
+                                  content_length=size - datastream.tell(), http_conn=http_conn)
+        else:
+            self._save_segmented(datastream, url, credentials, container, objname, segment_size)
+
+        delete_segments(url, credentials, old_segments)
         log.debug('Swift object "%s" saved' % self.context.value)
+        self._uncache(self.context.value)
+
+    def _uncache(self, uri):
+        cache = get_disk_cache()
+        if cache is not None:
+            cache.remove(uri)
+
+    def _save_segmented(self, datastream, url, credentials, container, objname, segment_size):
+        """ Save an object of unknown or large size, splitting it if it is larger than segment_size """
+        segment, size, etag = spool_segment(datastream, segment_size)
+
+        if size < segment_size:
+            with get_connection_pool().connection(url, credentials) as http_conn:
+                client.put_object(url, credentials, container, objname, contents=segment,
+                                  content_length=size, etag=etag, http_conn=http_conn)
+            segment.close()
+            return
+
+        upload = SegmentedUpload(url, credentials, container, objname,
+                                 get_config().getint('swift', 'segment_workers', 4))
+        while size:
+            upload.add_segment(segment, size, etag)
+            if size < segment_size or upload.errors:
+                break
+            segment, size, etag = spool_segment(datastream, segment_size)
+        else:
+            segment.close()
+
+        upload.finish()
 
     def load(self, credentials):
         if credentials is None:
             raise BadRequest('Swift backend requires credentials in x-auth-token headers')
 
         log.debug('Loading Swift object %s' % self.context.value)
-        protocol, schema, host, path = parse_uri(self.context.value)
-        uri = "%s:%s" % (schema, host)
-        base_path, objname = path.split('/', 1)
-        response, contents = client.get_object(uri, credentials, base_path, objname)
-        return StringIO.StringIO(contents)
+        url, container, objname = split_swift_uri(self.context.value)
+        chunk_size = get_config().getint('swift', 'chunk_size', 2 ** 16)
+
+        cache = get_disk_cache()
+        if cache is None:
+            return SwiftObjectStream(url, credentials, container, objname, chunk_size)
+
+        return self._load_cached(cache, url, credentials, container, objname, chunk_size)
+
+    def _load_cached(self, cache, url, credentials, container, objname, chunk_size):
+        """ Serve the object from the disk cache if Swift confirms that its ETag is still current,
+        otherwise fill the cache with it while it is streamed """
+        key = self.context.value
+        entry = cache.lookup(key)
+        headers = {'If-None-Match': '"%s"' % entry.etag.strip('"')} if entry is not None else None
+
+        try:
+            datastream = SwiftObjectStream(url, credentials, container, objname, chunk_size, headers=headers)
+        except client.ClientException as e:
+            if entry is None or e.http_status != 304:
+                raise
+            try:
+                cached = entry.open()
+            except IOError:
+                # evicted or replaced meanwhile
+                log.debug('Cached copy of %s is gone, loading it again', key)
+                cache.record_miss()
+                return SwiftObjectStream(url, credentials, container, objname, chunk_size)
+            cache.record_hit(key)
+            return cached
+
+        # no cached copy or a stale one
+        cache.record_miss()
+        if datastream.size is None or datastream.size > cache.max_object_size or not datastream.etag:
+            return datastream
+
+        log.debug('Caching Swift object %s' % key)
+        try:
+            return CacheFillingStream(cache, key, datastream.etag, datastream)
+        except (IOError, OSError) as e:
+            log.warning('Could not cache %s: %s', key, e)
+            return datastream
+
+    def _locations(self, target, credentials):
+        """ Swift URL, container and name of the object and of the target, or None if the target is in a
+        different account or cluster and cannot be copied to on the server """
+        if credentials is None:
+            raise BadRequest('Swift backend requires credentials in x-auth-token headers')
+
+        url, container, objname = split_swift_uri(self.context.value)
+        target_url, target_container, target_objname = split_swift_uri(target.context.value)
+        if url != target_url:
+            return None
+        return url, container, objname, target_container, target_objname
+
+    def copy(self, target, credentials):
+        locations = self._locations(target, credentials)
+        if locations is None:
+            return False
+
+        url, container, objname, target_container, target_objname = locations
+        with get_connection_pool().connection(url, credentials) as http_conn:
+            if is_large_object(url, credentials, container, objname, http_conn):
+                # a server-side copy of a manifest concatenates the segments into a single object, which
+                # fails above 5 GB: the data is streamed into a new large object instead
+                return False
+
+            log.debug('Copying Swift object %s to %s' % (self.context.value, target.context.value))
+            self._uncache(target.context.value)
+            # server-side copy, equivalent to the COPY verb
+            client.put_object(url, credentials, target_container, target_objname, contents='',
+                              content_length=0, headers={'X-Copy-From': quote_path('', container, objname)},
+                              http_conn=http_conn)
+        return True
+
+    def move(self, target, credentials):
+        locations = self._locations(target, credentials)
+        if locations is None:
+            return False
+
+        url, container, objname, target_container, target_objname = locations
+        log.debug('Moving Swift object %s to %s' % (self.context.value, target.context.value))
+        self._uncache(target.context.value)
+        with get_connection_pool().connection(url, credentials) as http_conn:
+            # the manifest of a large object is moved by itself and keeps referencing the same segments
+            large = is_large_object(url, credentials, container, objname, http_conn)
+            client.put_object(url, credentials, target_container, target_objname, contents='',
+                              content_length=0, headers={'X-Copy-From': quote_path('', container, objname)},
+                              query_string='multipart-manifest=get' if large else None, http_conn=http_conn)
+            client.delete_object(url, credentials, container, objname, http_conn=http_conn)
+        self._uncache(self.context.value)
+        return True
 
     def delete(self, credentials):
         if credentials is None:
             raise BadRequest('Swift backend requires credentials in x-auth-token headers')
 
         log.debug('Deleting Swift object %s' % self.context.value)
-        protocol, schema, host, path = parse_uri(self.context.value)
-        uri = "%s:%s%s" % (schema, host, path)
-        client.delete_object(uri, credentials, path)
+        url, container, objname = split_swift_uri(self.context.value)
+        with get_connection_pool().connection(url, credentials) as http_conn:
+            if is_large_object(url, credentials, container, objname, http_conn):
+                delete_large_object(url, credentials, container, objname, http_conn)
+            else:
+                client.delete_object(url, credentials, container, objname, http_conn=http_conn)
+        self._uncache(self.context.value)
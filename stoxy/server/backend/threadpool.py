@@ -0,0 +1,77 @@
+"""
+Bounded thread pools for blocking data store operations, one pool per backend
+"""
+import functools
+import logging
+import threading
+
+from twisted.internet import reactor
+from twisted.internet import threads
+from twisted.python.threadpool import ThreadPool
+
+from opennode.oms.config import get_config
+
+
+log = logging.getLogger(__name__)
+
+DEFAULT_POOL_SIZE = 10
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def get_threadpool(backend):
+    """ Return the thread pool of the backend, starting it on first use """
+    with _pools_lock:
+        pool = _pools.get(backend)
+        if pool is None:
+            size = get_config().getint('threadpool', backend, DEFAULT_POOL_SIZE)
+            log.debug('Starting a pool of %d threads for the "%s" backend', size, backend)
+            pool = ThreadPool(minthreads=0, maxthreads=size, name='stoxy-%s' % backend)
+            pool.start()
+            reactor.callFromThread(reactor.addSystemEventTrigger, 'during', 'shutdown', pool.stop)
+            _pools[backend] = pool
+        return pool
+
+
+def pool_stats():
+    """ Return the numbers of working, started and maximum threads and of queued calls of the pool of
+    each backend """
+    with _pools_lock:
+        pools = dict(_pools)
+
+    stats = {}
+    for backend, pool in pools.items():
+        queue = getattr(pool, 'q', None)
+        stats[backend] = {'working': len(pool.working), 'threads': len(pool.threads), 'max': pool.max,
+                          'queued': queue.qsize() if queue is not None else 0}
+    return stats
+
+
+def defer_to_backend(backend, f, *args, **kwargs):
+    """ Run f in the thread pool of the backend. Returns a Deferred firing with the result of f """
+    return threads.deferToThreadPool(reactor, get_threadpool(backend), f, *args, **kwargs)
+
+
+def call_in_backends(calls):
+    """ Run (backend, f, args) calls concurrently, each in the thread pool of its backend, and wait for
+    all of them to finish. Blocks, so must not be called from the reactor thread. Returns a list of
+    (success, result) pairs in the order of calls; the result of a failed call is a Failure """
+    results = [None] * len(calls)
+    remaining = [len(calls)]
+    finished = threading.Condition()
+
+    def on_result(index, success, result):
+        with finished:
+            results[index] = (success, result)
+            remaining[0] -= 1
+            finished.notify()
+
+    for index, (backend, f, args) in enumerate(calls):
+        get_threadpool(backend).callInThreadWithCallback(functools.partial(on_result, index), f, *args)
+
+    with finished:
+        while remaining[0]:
+            finished.wait()
+
+    return results
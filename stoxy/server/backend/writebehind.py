@@ -0,0 +1,263 @@
+"""
+Write-behind of data objects: data is spooled to local disk, the request is acknowledged and the data
+is uploaded to the backend of the object in the background
+"""
+import logging
+import os
+import shutil
+import tempfile
+import threading
+
+from grokcore.component import implements
+from twisted.internet import defer
+from twisted.internet import reactor
+from zope.component import getAdapter
+
+from opennode.oms.config import get_config
+from opennode.oms.endpoint.httprest.root import BadRequest
+from opennode.oms.zodb import db
+
+from stoxy.server.backend.threadpool import defer_to_backend
+from stoxy.server.metrics import instrument
+from stoxy.server.metrics import time_commit
+from stoxy.server.model.container import get_object_by_oid
+from stoxy.server.model.store import IDataStore
+from stoxy.server.model.store import IDataStoreFactory
+
+
+log = logging.getLogger(__name__)
+
+BLOCK_SIZE = 2 ** 20
+
+PROCESSING = 'Processing'
+COMPLETE = 'Complete'
+
+
+def is_write_behind(container):
+    """ Whether data objects of the container are written behind, as requested by its metadata """
+    value = (getattr(container, 'metadata', None) or {}).get('stoxy_write_behind', '')
+    return unicode(value).lower() in (u'1', u'yes', u'true', u'on')
+
+
+class SpoolStore(object):
+    """ Data store of the spooled data of a data object waiting to be uploaded """
+    implements(IDataStore)
+
+    def __init__(self, context, path):
+        self.context = context
+        self.path = path
+
+    def save(self, datastream, encoding, credentials=None):
+        fd, temp_path = tempfile.mkstemp(prefix='tmp', dir=os.path.dirname(self.path))
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                shutil.copyfileobj(datastream, f, BLOCK_SIZE)
+            os.rename(temp_path, self.path)
+        except Exception:
+            os.unlink(temp_path)
+            raise
+
+    def load(self, credentials=None):
+        return open(self.path, 'rb')
+
+    def delete(self, credentials=None):
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+
+class WriteBehindDataStore(object):
+    """ Data store of a data object whose data may still be waiting to be uploaded: reads are served
+    from the spooled data until the upload is done """
+    implements(IDataStore)
+
+    def __init__(self, store, spool):
+        self.store = store
+        self.spool = spool
+
+    @property
+    def context(self):
+        return self.store.context
+
+    def save(self, datastream, encoding, credentials=None):
+        self.spool.delete()
+        return self.store.save(datastream, encoding, credentials)
+
+    def load(self, credentials=None):
+        try:
+            return self.spool.load(credentials)
+        except IOError:
+            return self.store.load(credentials)
+
+    def delete(self, credentials=None):
+        spooled = os.path.exists(self.spool.path)
+        self.spool.delete()
+        try:
+            self.store.delete(credentials)
+        except Exception as e:
+            if not spooled:
+                raise
+            log.debug('Data of %s was not uploaded yet: %s', self.context, e)
+
+    def copy(self, target, credentials=None):
+        # the data may not be in the backend yet
+        return False
+
+    def move(self, target, credentials=None):
+        return False
+
+
+class WriteBehindQueue(object):
+    """
+    Uploads spooled data in the background, at most `workers` at a time. Failed uploads are retried
+    after exponentially growing delays, up to `max_retries` times; the completion status of the data
+    object then reports the error.
+    """
+
+    def __init__(self, directory, workers, max_retries, retry_delay, max_retry_delay):
+        self.directory = directory
+        self.max_retries = max_retries
+        self.retry_delay = retry_delay
+        self.max_retry_delay = max_retry_delay
+        self.semaphore = defer.DeferredSemaphore(workers)
+        self.pending = 0
+
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def spool_path(self, oid, version):
+        # each version has its own file: an upload only removes the data it has uploaded
+        return os.path.join(self.directory, '%s.%d' % (oid, version))
+
+    def spool(self, obj, version):
+        """ Data store of the spooled data of the given version of the object """
+        return SpoolStore(obj, self.spool_path(obj.oid, version))
+
+    def resume(self):
+        """ Enqueue uploads of data spooled before a restart. Credentials of the original requests are
+        not kept, so only backends that do not require them can complete these uploads """
+        for filename in os.listdir(self.directory):
+            if filename.startswith('tmp'):
+                os.unlink(os.path.join(self.directory, filename))
+                continue
+            oid, _, version = filename.rpartition('.')
+            if not oid or not version.isdigit():
+                log.warning('Ignoring unknown file %s in the spool directory', filename)
+                continue
+            log.info('Resuming the upload of spooled data of %s, version %s', oid, version)
+            self.enqueue(oid, int(version), None)
+
+    def enqueue(self, oid, version, credentials):
+        """ Upload the spooled data of the object, unless it was modified after the given version """
+        self.pending += 1
+        self._schedule(oid, version, credentials, 0)
+
+    def _schedule(self, oid, version, credentials, attempt):
+        d = self.semaphore.run(self._upload, oid, version, credentials)
+        d.addCallbacks(self._uploaded, self._failed, callbackArgs=(oid, ),
+                       errbackArgs=(oid, version, credentials, attempt))
+
+    @defer.inlineCallbacks
+    def _upload(self, oid, version, credentials):
+        spool_path = self.spool_path(oid, version)
+        job = yield get_upload_job(oid, version, spool_path)
+        if job is None:
+            log.debug('Upload of %s is no longer needed', oid)
+            remove_spooled(spool_path)
+            defer.returnValue(None)
+
+        backend, store, location = job
+        yield defer_to_backend(backend, upload_spooled, store, spool_path, credentials)
+        orphaned = yield finish_upload(oid, version, COMPLETE, location)
+        remove_spooled(spool_path)
+        log.debug('Upload of %s, version %s finished', oid, version)
+        if orphaned:
+            log.info('%s was deleted during its upload, removing the uploaded data', oid)
+            try:
+                yield defer_to_backend(backend, store.delete, credentials)
+            except Exception as e:
+                log.warning('Could not remove uploaded data of deleted %s: %s', oid, e)
+
+    def _uploaded(self, r, oid):
+        self.pending -= 1
+
+    def _failed(self, f, oid, version, credentials, attempt):
+        if f.check(BadRequest) or attempt >= self.max_retries:
+            self.pending -= 1
+            log.error('Upload of %s failed, giving up: %s: %s', oid, type(f.value).__name__, f.value)
+            d = finish_upload(oid, version, 'Error: %s' % f.value)
+            d.addErrback(self._status_failed, oid)
+            return
+
+        delay = min(self.retry_delay * 2 ** attempt, self.max_retry_delay)
+        log.warning('Upload of %s failed, retrying in %s seconds: %s: %s',
+                    oid, delay, type(f.value).__name__, f.value)
+        reactor.callLater(delay, self._schedule, oid, version, credentials, attempt + 1)
+
+    def _status_failed(self, f, oid):
+        log.error('Could not record the failed upload of %s: %s: %s', oid, type(f.value).__name__, f.value)
+
+
+@db.ro_transact
+def get_upload_job(oid, version, spool_path):
+    """ Return the backend, data store and location (container OID, name and data URI) of the object
+    to upload, or None if it was deleted or modified since """
+    obj = get_object_by_oid(oid)
+    if obj is None or obj.version != version or not os.path.exists(spool_path):
+        return None
+
+    factory = getAdapter(obj, IDataStoreFactory)
+    backend = factory.get_backend()
+    location = (obj.__parent__.oid, obj.__name__, obj.value)
+    return backend, instrument(getAdapter(obj, IDataStore, backend), backend), location
+
+
+def upload_spooled(store, spool_path, credentials):
+    with open(spool_path, 'rb') as datastream:
+        store.save(datastream, 'utf-8', credentials)
+
+
+def remove_spooled(spool_path):
+    if os.path.exists(spool_path):
+        os.unlink(spool_path)
+
+
+@db.transact
+def finish_upload(oid, version, status, location=None):
+    """ Record the completion status of an upload. Returns True if the uploaded data is orphaned: the
+    object was deleted during the upload and no other object has taken over the location of its data """
+    time_commit()
+    obj = get_object_by_oid(oid)
+    if obj is None:
+        return location is not None and not is_location_in_use(*location)
+    if obj.version == version:
+        obj.completion_status = status
+    return False
+
+
+def is_location_in_use(container_oid, name, uri):
+    """ Whether the data at uri is that of the object of the given name in the container """
+    container = get_object_by_oid(container_oid)
+    obj = container[name] if container is not None else None
+    return getattr(obj, 'value', None) == uri
+
+
+_queue = None
+_queue_lock = threading.Lock()
+
+
+def get_write_behind_queue():
+    global _queue
+    with _queue_lock:
+        if _queue is None:
+            config = get_config()
+            _queue = WriteBehindQueue(config.getstring('write_behind', 'spool_directory', '/tmp/stoxy-spool'),
+                                      config.getint('write_behind', 'workers', 2),
+                                      config.getint('write_behind', 'max_retries', 10),
+                                      config.getint('write_behind', 'retry_delay', 1),
+                                      config.getint('write_behind', 'max_retry_delay', 300))
+        return _queue
+
+
+def start():
+    """ Create the write-behind queue and resume the uploads of data spooled before a restart """
+    reactor.callWhenRunning(get_write_behind_queue().resume)
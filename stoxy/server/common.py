@@ -13,10 +13,12 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 ##
+import hashlib
+import os
 import re
 import struct
-from base64 import b64encode, b16encode
-from uuid import uuid4
+from base64 import b64decode, b64encode, b16encode
+from email.utils import mktime_tz, parsedate_tz
 
 
 CDMI_VERSION = '1.0.1'
@@ -25,6 +27,45 @@ BASE16_SIZE_MULTIPLIER = 2
 OBJECTID_MAX_BYTES = 40
 OBJECTID_MIN_BYTES = 24
 
+UUID_SIZE = 16
+GUID_SIZE = 8 + UUID_SIZE  # minimum sensible size: metadata + sizeof long
+
+_guid_headers = {}
+_crc16_words = None
+
+
+def _guid_header(entnumber):
+    """ Return the header of GUIDs of the enterprise number with a zero CRC and the CRC state after it """
+    header = _guid_headers.get(entnumber)
+    if header is None:
+        # first byte must be 0, so that when it's converted to network byte order,
+        # first byte will be left zero too
+        header = struct.pack('!LBBH', entnumber & 0x00FFFFFF, 0, GUID_SIZE, 0)
+        header = _guid_headers[entnumber] = (header, crc16(header))
+    return header
+
+
+def generate_guids(count, entnumber=0x00FFFFFF):
+    """
+    Generate count GUIDs at once, as specified by generate_guid. Random data of all the GUIDs is read
+    in one call and the CRC of the constant header is only computed once.
+    """
+    header, header_crc = _guid_header(entnumber)
+    prefix = header[:6]
+
+    uids = bytearray(os.urandom(UUID_SIZE * count))
+    for offset in xrange(0, len(uids), UUID_SIZE):
+        # random UUIDs (RFC 4122 version 4) as generated by uuid4
+        uids[offset + 6] = (uids[offset + 6] & 0x0F) | 0x40
+        uids[offset + 8] = (uids[offset + 8] & 0x3F) | 0x80
+    uids = str(uids)
+
+    guids = []
+    for offset in xrange(0, len(uids), UUID_SIZE):
+        uid = uids[offset:offset + UUID_SIZE]
+        guids.append(prefix + struct.pack('!H', crc16(uid, header_crc)) + uid)
+    return guids
+
 
 def generate_guid(entnumber=0x00FFFFFF):
     """
@@ -32,17 +73,7 @@ def generate_guid(entnumber=0x00FFFFFF):
     entnumber -- Enterprise number, as assigned by IANA:
     http://www.iana.org/assignments/enterprise-numbers
     """
-    # first byte must be 0, so that when it's converted to network byte order,
-    # first byte will be left zero too
-    if entnumber > 0x00FFFFFF:
-        entnumber &= 0x00FFFFFF
-
-    uid = uuid4().bytes
-    size = 8 + len(uid)  # minimum sensible size: metadata + sizeof long
-    guid = struct.pack('!LBBH', entnumber, 0, size, 0)
-    crcStr = struct.pack('!H', crc16(guid + uid))
-    guid_final = guid[:6] + crcStr + uid
-    return guid_final
+    return generate_guids(1, entnumber)[0]
 
 
 def generate_guid_b64(entnumber=0x00FFFFFF):
@@ -60,7 +91,60 @@ def generate_guid_b16(entnumber=0x00FFFFFF):
     return b16encode(generate_guid(entnumber))
 
 
-def crc16(s):
+def generate_guids_b16(count, entnumber=0x00FFFFFF):
+    """ Generate count Base16 encoded GUIDs at once """
+    return [b16encode(guid) for guid in generate_guids(count, entnumber)]
+
+
+CRC16_TABLE = (0x0000, 0xC0C1, 0xC181, 0x0140, 0xC301, 0x03C0, 0x0280,
+               0xC241, 0xC601, 0x06C0, 0x0780, 0xC741, 0x0500, 0xC5C1, 0xC481,
+               0x0440, 0xCC01, 0x0CC0, 0x0D80, 0xCD41, 0x0F00, 0xCFC1, 0xCE81,
+               0x0E40, 0x0A00, 0xCAC1, 0xCB81, 0x0B40, 0xC901, 0x09C0, 0x0880,
+               0xC841, 0xD801, 0x18C0, 0x1980, 0xD941, 0x1B00, 0xDBC1, 0xDA81,
+               0x1A40, 0x1E00, 0xDEC1, 0xDF81, 0x1F40, 0xDD01, 0x1DC0, 0x1C80,
+               0xDC41, 0x1400, 0xD4C1, 0xD581, 0x1540, 0xD701, 0x17C0, 0x1680,
+               0xD641, 0xD201, 0x12C0, 0x1380, 0xD341, 0x1100, 0xD1C1, 0xD081,
+               0x1040, 0xF001, 0x30C0, 0x3180, 0xF141, 0x3300, 0xF3C1, 0xF281,
+               0x3240, 0x3600, 0xF6C1, 0xF781, 0x3740, 0xF501, 0x35C0, 0x3480,
+               0xF441, 0x3C00, 0xFCC1, 0xFD81, 0x3D40, 0xFF01, 0x3FC0, 0x3E80,
+               0xFE41, 0xFA01, 0x3AC0, 0x3B80, 0xFB41, 0x3900, 0xF9C1, 0xF881,
+               0x3840, 0x2800, 0xE8C1, 0xE981, 0x2940, 0xEB01, 0x2BC0, 0x2A80,
+               0xEA41, 0xEE01, 0x2EC0, 0x2F80, 0xEF41, 0x2D00, 0xEDC1, 0xEC81,
+               0x2C40, 0xE401, 0x24C0, 0x2580, 0xE541, 0x2700, 0xE7C1, 0xE681,
+               0x2640, 0x2200, 0xE2C1, 0xE381, 0x2340, 0xE101, 0x21C0, 0x2080,
+               0xE041, 0xA001, 0x60C0, 0x6180, 0xA141, 0x6300, 0xA3C1, 0xA281,
+               0x6240, 0x6600, 0xA6C1, 0xA781, 0x6740, 0xA501, 0x65C0, 0x6480,
+               0xA441, 0x6C00, 0xACC1, 0xAD81, 0x6D40, 0xAF01, 0x6FC0, 0x6E80,
+               0xAE41, 0xAA01, 0x6AC0, 0x6B80, 0xAB41, 0x6900, 0xA9C1, 0xA881,
+               0x6840, 0x7800, 0xB8C1, 0xB981, 0x7940, 0xBB01, 0x7BC0, 0x7A80,
+               0xBA41, 0xBE01, 0x7EC0, 0x7F80, 0xBF41, 0x7D00, 0xBDC1, 0xBC81,
+               0x7C40, 0xB401, 0x74C0, 0x7580, 0xB541, 0x7700, 0xB7C1, 0xB681,
+               0x7640, 0x7200, 0xB2C1, 0xB381, 0x7340, 0xB101, 0x71C0, 0x7080,
+               0xB041, 0x5000, 0x90C1, 0x9181, 0x5140, 0x9301, 0x53C0, 0x5280,
+               0x9241, 0x9601, 0x56C0, 0x5780, 0x9741, 0x5500, 0x95C1, 0x9481,
+               0x5440, 0x9C01, 0x5CC0, 0x5D80, 0x9D41, 0x5F00, 0x9FC1, 0x9E81,
+               0x5E40, 0x5A00, 0x9AC1, 0x9B81, 0x5B40, 0x9901, 0x59C0, 0x5880,
+               0x9841, 0x8801, 0x48C0, 0x4980, 0x8941, 0x4B00, 0x8BC1, 0x8A81,
+               0x4A40, 0x4E00, 0x8EC1, 0x8F81, 0x4F40, 0x8D01, 0x4DC0, 0x4C80,
+               0x8C41, 0x4400, 0x84C1, 0x8581, 0x4540, 0x8701, 0x47C0, 0x4680,
+               0x8641, 0x8201, 0x42C0, 0x4380, 0x8341, 0x4100, 0x81C1, 0x8081,
+               0x4040)
+
+
+def _crc16_word_table():
+    """ Table of CRC-16 steps over two bytes at once, indexed by the CRC state XORed with a
+    little-endian 16-bit word. Built on first use """
+    global _crc16_words
+    if _crc16_words is None:
+        words = []
+        for x in xrange(0x10000):
+            crc = (x >> 8) ^ CRC16_TABLE[x & 0xff]
+            words.append((crc >> 8) ^ CRC16_TABLE[crc & 0xff])
+        _crc16_words = words
+    return _crc16_words
+
+
+def crc16(s, crc=0x0000):
     """
     CRC-16 implementation as mandated by CDMI standard:
     Width: 16,
@@ -70,45 +154,16 @@ def crc16(s):
     RefOut: True,
     XorOut: 0x0000
     Check: 0xBB3D
+
+    crc -- CRC state to continue from, e.g. the CRC of preceding data
     """
-    crcValue = 0x0000
-    crc16tab = (0x0000, 0xC0C1, 0xC181, 0x0140, 0xC301, 0x03C0, 0x0280,
-                0xC241, 0xC601, 0x06C0, 0x0780, 0xC741, 0x0500, 0xC5C1, 0xC481,
-                0x0440, 0xCC01, 0x0CC0, 0x0D80, 0xCD41, 0x0F00, 0xCFC1, 0xCE81,
-                0x0E40, 0x0A00, 0xCAC1, 0xCB81, 0x0B40, 0xC901, 0x09C0, 0x0880,
-                0xC841, 0xD801, 0x18C0, 0x1980, 0xD941, 0x1B00, 0xDBC1, 0xDA81,
-                0x1A40, 0x1E00, 0xDEC1, 0xDF81, 0x1F40, 0xDD01, 0x1DC0, 0x1C80,
-                0xDC41, 0x1400, 0xD4C1, 0xD581, 0x1540, 0xD701, 0x17C0, 0x1680,
-                0xD641, 0xD201, 0x12C0, 0x1380, 0xD341, 0x1100, 0xD1C1, 0xD081,
-                0x1040, 0xF001, 0x30C0, 0x3180, 0xF141, 0x3300, 0xF3C1, 0xF281,
-                0x3240, 0x3600, 0xF6C1, 0xF781, 0x3740, 0xF501, 0x35C0, 0x3480,
-                0xF441, 0x3C00, 0xFCC1, 0xFD81, 0x3D40, 0xFF01, 0x3FC0, 0x3E80,
-                0xFE41, 0xFA01, 0x3AC0, 0x3B80, 0xFB41, 0x3900, 0xF9C1, 0xF881,
-                0x3840, 0x2800, 0xE8C1, 0xE981, 0x2940, 0xEB01, 0x2BC0, 0x2A80,
-                0xEA41, 0xEE01, 0x2EC0, 0x2F80, 0xEF41, 0x2D00, 0xEDC1, 0xEC81,
-                0x2C40, 0xE401, 0x24C0, 0x2580, 0xE541, 0x2700, 0xE7C1, 0xE681,
-                0x2640, 0x2200, 0xE2C1, 0xE381, 0x2340, 0xE101, 0x21C0, 0x2080,
-                0xE041, 0xA001, 0x60C0, 0x6180, 0xA141, 0x6300, 0xA3C1, 0xA281,
-                0x6240, 0x6600, 0xA6C1, 0xA781, 0x6740, 0xA501, 0x65C0, 0x6480,
-                0xA441, 0x6C00, 0xACC1, 0xAD81, 0x6D40, 0xAF01, 0x6FC0, 0x6E80,
-                0xAE41, 0xAA01, 0x6AC0, 0x6B80, 0xAB41, 0x6900, 0xA9C1, 0xA881,
-                0x6840, 0x7800, 0xB8C1, 0xB981, 0x7940, 0xBB01, 0x7BC0, 0x7A80,
-                0xBA41, 0xBE01, 0x7EC0, 0x7F80, 0xBF41, 0x7D00, 0xBDC1, 0xBC81,
-                0x7C40, 0xB401, 0x74C0, 0x7580, 0xB541, 0x7700, 0xB7C1, 0xB681,
-                0x7640, 0x7200, 0xB2C1, 0xB381, 0x7340, 0xB101, 0x71C0, 0x7080,
-                0xB041, 0x5000, 0x90C1, 0x9181, 0x5140, 0x9301, 0x53C0, 0x5280,
-                0x9241, 0x9601, 0x56C0, 0x5780, 0x9741, 0x5500, 0x95C1, 0x9481,
-                0x5440, 0x9C01, 0x5CC0, 0x5D80, 0x9D41, 0x5F00, 0x9FC1, 0x9E81,
-                0x5E40, 0x5A00, 0x9AC1, 0x9B81, 0x5B40, 0x9901, 0x59C0, 0x5880,
-                0x9841, 0x8801, 0x48C0, 0x4980, 0x8941, 0x4B00, 0x8BC1, 0x8A81,
-                0x4A40, 0x4E00, 0x8EC1, 0x8F81, 0x4F40, 0x8D01, 0x4DC0, 0x4C80,
-                0x8C41, 0x4400, 0x84C1, 0x8581, 0x4540, 0x8701, 0x47C0, 0x4680,
-                0x8641, 0x8201, 0x42C0, 0x4380, 0x8341, 0x4100, 0x81C1, 0x8081,
-                0x4040)
-    for ch in s:
-        tmp = crcValue ^ (ord(ch))
-        crcValue = (crcValue >> 8) ^ crc16tab[(tmp & 0xff)]
-    return crcValue
+    words = _crc16_word_table()
+    count = len(s) // 2
+    for word in struct.unpack('<%dH' % count, s[:count * 2]):
+        crc = words[crc ^ word]
+    if len(s) % 2:
+        crc = (crc >> 8) ^ CRC16_TABLE[(crc ^ ord(s[-1])) & 0xff]
+    return crc
 
 
 URI_RE = re.compile(r'^(([^:/?#\+]+)\+([^:/?#]+):)?(//([^/?#]*))?([^?#]*)(\?([^#]*))?(#(.*))?')
@@ -120,3 +175,215 @@ def parse_uri(uri):
     if not match:
         return
     return match.group(2, 3, 4, 6)
+
+
+# requests for more ranges are answered with the whole representation
+MAX_BYTE_RANGES = 100
+
+
+def parse_byte_ranges(header, size, max_ranges=MAX_BYTE_RANGES):
+    """
+    Parse a Range header (RFC 7233) against a representation of the given size.
+    Returns a sorted list of non-overlapping (first, last) inclusive byte positions, overlapping and
+    adjacent ranges being coalesced, an empty list if no range is satisfiable, or None if the header
+    is invalid or asks for more than max_ranges ranges (RFC 7233, section 6.1) and must be ignored.
+    """
+    unit, sep, specs = header.partition('=')
+    if not sep or unit.strip().lower() != 'bytes':
+        return None
+
+    specs = [spec.strip() for spec in specs.split(',') if spec.strip()]
+    if len(specs) > max_ranges:
+        return None
+
+    ranges = []
+    for spec in specs:
+        first, sep, last = (part.strip() for part in spec.partition('-'))
+        if not sep or not (first or last) or not (first or '0').isdigit() or not (last or '0').isdigit():
+            return None
+
+        if not first:
+            # suffix range: the last N bytes
+            length = int(last)
+            if length > 0 and size > 0:
+                ranges.append((max(0, size - length), size - 1))
+            continue
+
+        first = int(first)
+        if last and int(last) < first:
+            return None
+        last = int(last) if last else size - 1
+        if first < size:
+            ranges.append((first, min(last, size - 1)))
+
+    merged = []
+    for first, last in sorted(ranges):
+        if merged and first <= merged[-1][1] + 1:
+            merged[-1] = (merged[-1][0], max(last, merged[-1][1]))
+        else:
+            merged.append((first, last))
+    return merged
+
+
+ETAG_RE = re.compile(r'\*|(?:W/)?"[^"]*"')
+
+
+def parse_http_date(value):
+    """ Parse an HTTP date into a timestamp. Returns None if the value is missing or invalid """
+    parsed = parsedate_tz(value) if value else None
+    return mktime_tz(parsed) if parsed else None
+
+
+def check_preconditions(method, get_header, etags, mtime):
+    """
+    Evaluate the conditional headers of a request (RFC 7232), read with get_header, against the
+    current strong (quoted) entity tags and modification time of the resource; etags is empty if the
+    resource does not exist. Returns 304 or 412 if the request must not be processed, otherwise None.
+    """
+    if_match = get_header('If-Match')
+    if if_match is not None:
+        # strong comparison: weak tags never match
+        tags = ETAG_RE.findall(if_match)
+        if not etags or not ('*' in tags or set(tags) & set(etags)):
+            return 412
+    else:
+        unmodified_since = parse_http_date(get_header('If-Unmodified-Since'))
+        if unmodified_since is not None and mtime is not None and int(mtime) > unmodified_since:
+            return 412
+
+    if_none_match = get_header('If-None-Match')
+    if if_none_match is not None:
+        # weak comparison
+        tags = [tag[2:] if tag.startswith('W/') else tag for tag in ETAG_RE.findall(if_none_match)]
+        if etags and ('*' in tags or set(tags) & set(etags)):
+            return 304 if method in ('GET', 'HEAD') else 412
+    elif method in ('GET', 'HEAD'):
+        modified_since = parse_http_date(get_header('If-Modified-Since'))
+        if modified_since is not None and mtime is not None and int(mtime) <= modified_since:
+            return 304
+
+    return None
+
+
+def get_stream_size(datastream):
+    """ Size of the data in a file-like object or None if it cannot be determined without reading it """
+    size = getattr(datastream, 'size', None)
+    if size is not None:
+        return size
+
+    if hasattr(datastream, 'fileno'):
+        try:
+            return os.fstat(datastream.fileno()).st_size
+        except (AttributeError, IOError, OSError):
+            pass
+
+    if hasattr(datastream, 'seek') and hasattr(datastream, 'tell'):
+        position = datastream.tell()
+        datastream.seek(0, os.SEEK_END)
+        size = datastream.tell()
+        datastream.seek(position)
+        return size
+
+
+class Base64DecodingStream(object):
+    """
+    Read-only file-like wrapper that incrementally decodes a base64-encoded stream.
+    Reads do not have to be aligned to base64 quanta: undecoded characters and decoded bytes
+    beyond the requested size are carried over to the next read, so that reads return at most
+    the requested number of bytes. Whitespace (e.g. line breaks of MIME-style base64) is ignored.
+    """
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.closed = False
+        self._pending = ''
+        self._decoded = ''
+        self._eof = False
+
+    def _read_encoded(self, size):
+        chunk = self.stream.read(size)
+        if isinstance(chunk, unicode):
+            chunk = chunk.encode('ascii')
+        return chunk
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            encoded = self._pending + self._read_encoded(-1).translate(None, ' \t\r\n')
+            self._pending = ''
+            self._eof = True
+            data, self._decoded = self._decoded + self._decode(encoded), ''
+            return data
+
+        while len(self._decoded) < size and (self._pending or not self._eof):
+            # base64 encodes every 3 bytes as 4 characters
+            encoded_size = max(4, (size - len(self._decoded) + 2) // 3 * 4)
+
+            while not self._eof and len(self._pending) < encoded_size:
+                chunk = self._read_encoded(encoded_size)
+                if not chunk:
+                    self._eof = True
+                self._pending += chunk.translate(None, ' \t\r\n')
+
+            if self._eof:
+                split = len(self._pending)
+            else:
+                split = min(encoded_size, len(self._pending) // 4 * 4)
+
+            encoded, self._pending = self._pending[:split], self._pending[split:]
+            self._decoded += self._decode(encoded)
+
+        data, self._decoded = self._decoded[:size], self._decoded[size:]
+        return data
+
+    def _decode(self, encoded):
+        try:
+            return b64decode(encoded)
+        except TypeError as e:
+            raise ValueError('Invalid base64 data: %s' % e)
+
+    def close(self):
+        self.closed = True
+        self.stream.close()
+
+
+def normalize_hash_algorithm(name):
+    """ Convert a CDMI hash algorithm name (e.g. 'SHA256' or 'SHA-256') to a hashlib one. Returns None
+    if the algorithm is not supported """
+    algorithm = name.lower().replace('-', '') if isinstance(name, basestring) else None
+    try:
+        hashlib.new(algorithm)
+    except (TypeError, ValueError):
+        return None
+    return algorithm
+
+
+class HashingStream(object):
+    """
+    Read-only file-like wrapper computing digests of the data as it is read from the wrapped stream,
+    so that data can be hashed while it is being stored, without a second pass.
+    """
+
+    def __init__(self, stream, algorithms):
+        self.stream = stream
+        self.closed = False
+        self.size = get_stream_size(stream)
+        self.hashes = dict((algorithm, hashlib.new(algorithm)) for algorithm in algorithms)
+
+    def read(self, size=-1):
+        data = self.stream.read(size)
+        for h in self.hashes.itervalues():
+            h.update(data)
+        return data
+
+    def tell(self):
+        return self.stream.tell()
+
+    def digest(self, algorithm):
+        return self.hashes[algorithm].digest()
+
+    def hexdigest(self, algorithm):
+        return self.hashes[algorithm].hexdigest()
+
+    def close(self):
+        self.closed = True
+        self.stream.close()
@@ -15,14 +15,14 @@ system = {
     "cdmi_ctime": True,
     "cdmi_atime": True,
     "cdmi_mtime": True,
-    "cdmi_hash": False,
+    "cdmi_hash": True,
     "cdmi_acl": True,
 }
 
 dataobject = {
 
     "cdmi_read_value": True,
-    "cdmi_read_value_range": False,
+    "cdmi_read_value_range": True,
     "cdmi_read_metadata": True,
     "cdmi_modify_value": True,
     "cdmi_modify_value_range": False,
@@ -43,14 +43,16 @@ mq = {
 
 container = {
     "cdmi_list_children": True,
-    "cdmi_list_children_range": False,
+    "cdmi_list_children_range": True,
     "cdmi_read_metadata": True,
     "cdmi_modify_metadata": True,
     "cdmi_snapshot": False,
     "cdmi_create_dataobject": True,
-    "cdmi_post_dataobject": False,
+    "cdmi_post_dataobject": True,
     "cdmi_create_container": True,
     "cdmi_delete_container": True,
-    "cdmi_move_container": False,
-    "cdmi_copy_container": False,
+    "cdmi_move_container": True,
+    "cdmi_copy_container": True,
+    "cdmi_move_dataobject": True,
+    "cdmi_copy_dataobject": True,
 }
@@ -0,0 +1,255 @@
+"""
+Incremental parser for CDMI request bodies with potentially large string fields (e.g. data object 'value')
+"""
+import json
+import re
+
+
+CHUNK_SIZE = 2 ** 16
+
+_NON_WHITESPACE_RE = re.compile(r'[^ \t\r\n]')
+_STRING_SPECIAL_RE = re.compile(r'["\\]')
+_STRUCTURE_RE = re.compile(r'["{}\[\]]')
+_LITERAL_END_RE = re.compile(r'[ \t\r\n,}\]]')
+_ESCAPE_RE = re.compile(r'\\u[dD][89abAB][0-9a-fA-F]{2}\\u[0-9a-fA-F]{4}|\\u[0-9a-fA-F]{4}|\\[^u]')
+_HIGH_SURROGATE_RE = re.compile(r'\\u[dD][89abAB][0-9a-fA-F]{2}$')
+
+_SIMPLE_ESCAPES = {'"': '"', '\\': '\\', '/': '/', 'b': '\b', 'f': '\f', 'n': '\n', 'r': '\r', 't': '\t'}
+
+
+def _unescape(match):
+    escape = match.group()
+    if escape[1] == 'u':
+        return json.loads('"%s"' % escape).encode('utf-8')
+    try:
+        return _SIMPLE_ESCAPES[escape[1]]
+    except KeyError:
+        raise ValueError('Invalid escape sequence in JSON string: %r' % escape)
+
+
+class JsonStringReader(object):
+    """
+    Read-only file-like object returning the UTF-8 encoded content of a JSON string located
+    between the start and end offsets of a seekable file. Escape sequences are decoded as the
+    data is read, so the string is never held in memory as a whole.
+    """
+
+    def __init__(self, fileobj, start, end):
+        self.fileobj = fileobj
+        self.start = start
+        self.end = end
+        self.position = start
+        self.closed = False
+        self._pending = ''
+
+    def _read_raw(self, size):
+        if size is None or size < 0:
+            size = self.end - self.position
+        size = min(size, self.end - self.position)
+        if size <= 0:
+            return ''
+        self.fileobj.seek(self.position)
+        data = self.fileobj.read(size)
+        self.position += len(data)
+        return data
+
+    def read(self, size=-1):
+        data = self._pending + self._read_raw(size)
+        self._pending = ''
+
+        while data:
+            eof = self.position >= self.end
+            complete, self._pending = self._split_complete(data, eof)
+
+            if complete:
+                if '\\' not in complete:
+                    return complete
+                return _ESCAPE_RE.sub(_unescape, complete)
+
+            data = self._pending + self._read_raw(max(size, 12))
+            self._pending = ''
+
+        return ''
+
+    def _split_complete(self, data, eof):
+        """ Split off a trailing escape sequence that may continue in the next chunk """
+        if eof or '\\' not in data[-12:]:
+            return data, ''
+
+        last_match = None
+        for last_match in _ESCAPE_RE.finditer(data):
+            pass
+
+        last_end = last_match.end() if last_match is not None else 0
+        split = data.find('\\', last_end)
+        if split == -1:
+            split = len(data)
+
+        # a high surrogate must be decoded together with the low surrogate following it
+        if (last_match is not None and last_match.end() == split
+                and _HIGH_SURROGATE_RE.match(last_match.group())):
+            split = last_match.start()
+
+        # the longest incomplete sequence is a surrogate pair missing its last digit
+        if len(data) - split > 11:
+            raise ValueError('Invalid escape sequence in JSON string')
+
+        return data[:split], data[split:]
+
+    def close(self):
+        self.closed = True
+
+
+class CdmiObjectParser(object):
+    """
+    Parses a JSON object from a seekable file. Fields are decoded with json, except for string
+    values of the streamed fields: those are only located in the file and returned as
+    JsonStringReader objects, keeping the memory use bounded whatever their size.
+    """
+
+    def __init__(self, fileobj, streamed_fields=('value',), chunk_size=CHUNK_SIZE):
+        self.fileobj = fileobj
+        self.streamed_fields = streamed_fields
+        self.chunk_size = chunk_size
+        self.buffer = ''
+        self.pos = 0
+        self.offset = fileobj.tell()
+
+    def _fill(self):
+        chunk = self.fileobj.read(self.chunk_size)
+        if not chunk:
+            return False
+        self.offset += self.pos
+        self.buffer = self.buffer[self.pos:] + chunk
+        self.pos = 0
+        return True
+
+    def _peek(self):
+        while self.pos >= len(self.buffer):
+            if not self._fill():
+                raise ValueError('Unexpected end of JSON input')
+        return self.buffer[self.pos]
+
+    def _expect(self, char):
+        if self._skip_whitespace() != char:
+            raise ValueError('Expected "%s" at offset %d' % (char, self.offset + self.pos))
+        self.pos += 1
+
+    def _skip_whitespace(self):
+        while True:
+            match = _NON_WHITESPACE_RE.search(self.buffer, self.pos)
+            if match:
+                self.pos = match.start()
+                return self.buffer[self.pos]
+            self.pos = len(self.buffer)
+            if not self._fill():
+                return None
+
+    def _scan_string(self, capture=True):
+        """ Scan a string starting at the current position. Returns its start and end offsets and
+        raw content if captured """
+        self._expect('"')
+        start = self.offset + self.pos
+        parts = []
+
+        while True:
+            match = _STRING_SPECIAL_RE.search(self.buffer, self.pos)
+
+            if match is None:
+                if capture:
+                    parts.append(self.buffer[self.pos:])
+                self.pos = len(self.buffer)
+                if not self._fill():
+                    raise ValueError('Unterminated JSON string')
+                continue
+
+            if capture:
+                parts.append(self.buffer[self.pos:match.start()])
+
+            if match.group() == '"':
+                end = self.offset + match.start()
+                self.pos = match.end()
+                return start, end, ''.join(parts)
+
+            self.pos = match.end()
+            escaped = self._peek()
+            self.pos += 1
+            if capture:
+                parts.append('\\' + escaped)
+
+    def _scan_value(self):
+        """ Return the raw text of the value starting at the current position """
+        char = self._skip_whitespace()
+
+        if char == '"':
+            return '"%s"' % self._scan_string()[2]
+
+        if char in ('{', '['):
+            parts = []
+            depth = 0
+            while True:
+                match = _STRUCTURE_RE.search(self.buffer, self.pos)
+                if match is None:
+                    parts.append(self.buffer[self.pos:])
+                    self.pos = len(self.buffer)
+                    if not self._fill():
+                        raise ValueError('Unterminated JSON value')
+                    continue
+
+                parts.append(self.buffer[self.pos:match.start()])
+                self.pos = match.start()
+
+                if match.group() == '"':
+                    parts.append('"%s"' % self._scan_string()[2])
+                    continue
+
+                parts.append(match.group())
+                self.pos = match.end()
+                depth += 1 if match.group() in ('{', '[') else -1
+                if depth == 0:
+                    return ''.join(parts)
+
+        if char is None:
+            raise ValueError('Unexpected end of JSON input')
+
+        parts = []
+        while True:
+            match = _LITERAL_END_RE.search(self.buffer, self.pos)
+            if match:
+                parts.append(self.buffer[self.pos:match.start()])
+                self.pos = match.start()
+                return ''.join(parts)
+            parts.append(self.buffer[self.pos:])
+            self.pos = len(self.buffer)
+            if not self._fill():
+                return ''.join(parts)
+
+    def parse(self):
+        data = {}
+        self._expect('{')
+
+        if self._skip_whitespace() == '}':
+            self.pos += 1
+            return data
+
+        while True:
+            key = json.loads('"%s"' % self._scan_string()[2])
+            self._expect(':')
+
+            if key in self.streamed_fields and self._skip_whitespace() == '"':
+                start, end, _ = self._scan_string(capture=False)
+                data[key] = JsonStringReader(self.fileobj, start, end)
+            else:
+                data[key] = json.loads(self._scan_value())
+
+            char = self._skip_whitespace()
+            self.pos += 1
+            if char == '}':
+                break
+            if char != ',':
+                raise ValueError('Expected "," or "}" at offset %d' % (self.offset + self.pos - 1))
+
+        if self._skip_whitespace() is not None:
+            raise ValueError('Extra data after the JSON object at offset %d' % (self.offset + self.pos))
+
+        return data
@@ -3,26 +3,32 @@ import functools
 import json
 import logging
 import io
-import StringIO
+import uuid
+
+from itertools import islice
 
 from grokcore.component import Adapter
 from grokcore.component import implements
 from grokcore.component import context
 from twisted.web.server import NOT_DONE_YET
 from twisted.internet import defer
-from twisted.internet.interfaces import IPullProducer
+from twisted.internet.interfaces import IPushProducer
+from twisted.web import http
 from zope.authentication.interfaces import IAuthentication
 from zope.component import getUtility
 from zope.component import getAdapter
 from zope.component import handle
 from zope.component import queryAdapter
 
+from opennode.oms.config import get_config
 from opennode.oms.endpoint.httprest.base import IHttpRestView
 from opennode.oms.endpoint.httprest.base import HttpRestView
 from opennode.oms.endpoint.httprest.base import IHttpRestSubViewFactory
 from opennode.oms.endpoint.httprest.root import BadRequest
+from opennode.oms.endpoint.httprest.root import Forbidden
 from opennode.oms.endpoint.httprest.root import NotFound
 from opennode.oms.log import UserLogger
+from opennode.oms.model.model.events import ModelCreatedEvent
 from opennode.oms.model.model.events import ModelDeletedEvent
 from opennode.oms.model.model.byname import ByNameContainer
 from opennode.oms.model.model.actions import ActionsContainer
@@ -31,7 +37,18 @@ from opennode.oms.util import JsonSetEncoder
 from opennode.oms.zodb import db
 
 from stoxy.server import common
+from stoxy.server import metrics
+from stoxy.server.backend.manager import save_data
+from stoxy.server.backend.manager import transfer_data
+from stoxy.server.backend.threadpool import call_in_backends
+from stoxy.server.backend.writebehind import COMPLETE
+from stoxy.server.backend.writebehind import PROCESSING
+from stoxy.server.backend.writebehind import get_write_behind_queue
+from stoxy.server.backend.writebehind import is_write_behind
+from stoxy.server.backend.threadpool import defer_to_backend
 from stoxy.server.endpoint.cdmi import current_capabilities
+from stoxy.server.endpoint.cdmi.parser import CdmiObjectParser
+from stoxy.server.endpoint.cdmi.parser import JsonStringReader
 from stoxy.server.model.capability import ISystemCapability
 from stoxy.server.model.capability import SystemCapability
 from stoxy.server.model.container import IStorageContainer
@@ -40,6 +57,11 @@ from stoxy.server.model.container import IRootContainer
 from stoxy.server.model.container import RootStorageContainer
 from stoxy.server.model.container import StorageContainer
 from stoxy.server.model.container import ObjectIdContainer
+from stoxy.server.model.container import child_count
+from stoxy.server.model.container import child_names
+from stoxy.server.model.container import get_object_by_oid
+from stoxy.server.model.container import iter_child_names
+from stoxy.server.model.container import resolve_path
 from stoxy.server.model.dataobject import DataObject
 from stoxy.server.model.dataobject import IDataObject
 from stoxy.server.model.form import CdmiObjectValidatorFactory
@@ -49,18 +71,114 @@ from stoxy.server.model.store import IDataStoreFactory
 log = logging.getLogger(__name__)
 
 
+class PreconditionFailed(Exception):
+    """ The object was modified by another request after the conditional headers were evaluated """
+
+
 def response_headers(f):
     @functools.wraps(f)
     def _wrapper_for_render_method(self, request, *args, **kw):
         self.set_response_headers(request)
+        if metrics.enabled():
+            metrics.time_request(request)
         return f(self, request, *args, **kw)
     return _wrapper_for_render_method
 
 
+def children_range(begin, count):
+    """ CDMI childrenrange of count children starting at begin; ranges are inclusive """
+    return '%d-%d' % (begin, begin + count - 1) if count else ''
+
+
+@db.ro_transact
+def fetch_child_names(oid, after, limit):
+    return list(islice(iter_child_names(get_object_by_oid(oid), after), limit))
+
+
+class ChildrenListingProducer(object):
+    """
+    Streams names of the children of a container as the items of a JSON list, closing the enclosing
+    JSON document. Names are fetched in batches, each in its own read-only transaction, and the
+    listing is never materialised as a whole.
+    """
+    implements(IPushProducer)
+
+    def __init__(self, oid, batch_size):
+        self.oid = oid
+        self.batch_size = batch_size
+
+    def beginProducing(self, header, consumer):
+        self.consumer = consumer
+        self.deferred = deferred = defer.Deferred()
+        self.count = 0
+        self.last = None
+        self.paused = False
+        self.fetching = False
+        self.stopped = False
+        self.consumer.registerProducer(self, True)
+        self.consumer.write(header)
+        self._fetchNext()
+        return deferred
+
+    def _fetchNext(self):
+        self.fetching = True
+        d = fetch_child_names(self.oid, self.last, self.batch_size)
+        d.addCallbacks(self._gotNames, self._fetchFailed)
+
+    def _gotNames(self, names):
+        self.fetching = False
+
+        if self.stopped:
+            return
+
+        if not names:
+            self.consumer.write('], "childrenrange": "%s"}' % children_range(0, self.count))
+            self.consumer.unregisterProducer()
+            if self.deferred:
+                self.deferred.callback(self.count)
+                self.deferred = None
+            self.consumer.finish()
+            return
+
+        self.consumer.write((', ' if self.count else '') + ', '.join(json.dumps(name) for name in names))
+        self.count += len(names)
+        self.last = names[-1]
+
+        if not self.paused:
+            self._fetchNext()
+
+    def _fetchFailed(self, failure):
+        self.fetching = False
+
+        if self.stopped:
+            return
+
+        self.consumer.unregisterProducer()
+        self.consumer.transport.loseConnection()
+        if self.deferred:
+            self.deferred.errback(failure)
+            self.deferred = None
+
+    def pauseProducing(self):
+        self.paused = True
+
+    def resumeProducing(self):
+        self.paused = False
+        if not self.fetching and not self.stopped:
+            self._fetchNext()
+
+    def stopProducing(self):
+        self.stopped = True
+
+
 class DataStreamProducer(object):
-    implements(IPullProducer)
+    """ Streams a range of a data stream to a consumer. Blocking reads run in the backend's thread pool """
+    implements(IPushProducer)
     MAX_CHUNK = 2 ** 16
 
+    def __init__(self, backend):
+        self.backend = backend
+
     def beginSendingData(self, datastream, consumer, begin=0, end=None):
         self.consumer = consumer
         self.datastream = datastream
@@ -68,13 +186,52 @@ class DataStreamProducer(object):
         self.end = end
         self.deferred = deferred = defer.Deferred()
         self.lastSent = ''
-        self.consumer.registerProducer(self, False)
+        self.paused = False
+        self.reading = False
+        self.stopped = False
+        self.consumer.registerProducer(self, True)
+        self._readNext()
         return deferred
 
-    def resumeProducing(self):
-        if self.datastream.tell() >= self.end:
-            log.debug('Finished writing data! %s->%s:%s' % (self.datastream.tell(), self.begin, self.end))
-            self.datastream = None
+    def writeData(self, data):
+        self.consumer.write(data)
+
+    def nextRange(self):
+        """ Called when the current range is exhausted. Return True if another range follows """
+        return False
+
+    def finishData(self):
+        pass
+
+    def _read(self):
+        if self.datastream.tell() < self.begin:
+            self.datastream.seek(self.begin)
+
+        size = self.MAX_CHUNK
+        if self.end is not None:
+            size = min(size, max(0, self.end - self.datastream.tell()))
+
+        return self.datastream.read(size) if size else ''
+
+    def _readNext(self):
+        self.reading = True
+        d = defer_to_backend(self.backend, self._read)
+        d.addCallbacks(self._gotData, self._readFailed)
+
+    def _gotData(self, data):
+        self.reading = False
+
+        if self.stopped:
+            self.datastream.close()
+            return
+
+        if data:
+            self.writeData(data)
+            self.lastSent = data[-1:]
+        elif not self.nextRange():
+            log.debug('Finished writing data! %s:%s' % (self.begin, self.end))
+            self.datastream.close()
+            self.finishData()
             self.consumer.unregisterProducer()
             if self.deferred:
                 self.deferred.callback(self.lastSent)
@@ -82,17 +239,96 @@ class DataStreamProducer(object):
             self.consumer.finish()
             return
 
-        if self.datastream.tell() < self.begin:
-            self.datastream.seek(self.begin)
+        if not self.paused:
+            self._readNext()
 
-        data = self.datastream.read(min(self.MAX_CHUNK,
-                                        max(0, self.end - self.datastream.tell()
-                                            if self.end else self.MAX_CHUNK)))
-        self.consumer.write(data)
-        self.lastSent = data[-1:]
+    def _readFailed(self, failure):
+        self.reading = False
+        self.datastream.close()
+
+        if self.stopped:
+            return
+
+        # the response is already partially sent: dropping the connection is the only way to signal the error
+        self.consumer.unregisterProducer()
+        self.consumer.transport.loseConnection()
+        if self.deferred:
+            self.deferred.errback(failure)
+            self.deferred = None
+
+    def pauseProducing(self):
+        self.paused = True
+
+    def resumeProducing(self):
+        self.paused = False
+        if not self.reading and not self.stopped:
+            self._readNext()
 
     def stopProducing(self):
-        self.datastream.close()
+        self.stopped = True
+        if not self.reading:
+            self.datastream.close()
+
+
+class Base64ValueProducer(DataStreamProducer):
+    """ Streams a data stream base64-encoded, enclosed between a header and a footer (e.g. a JSON document) """
+    # a multiple of 3 bytes encodes without padding
+    MAX_CHUNK = 3 * 2 ** 14
+
+    def __init__(self, backend, header, footer):
+        super(Base64ValueProducer, self).__init__(backend)
+        self.header = header
+        self.footer = footer
+        self.pending = ''
+
+    def beginSendingData(self, datastream, consumer, begin=0, end=None):
+        consumer.write(self.header)
+        return super(Base64ValueProducer, self).beginSendingData(datastream, consumer, begin, end)
+
+    def writeData(self, data):
+        # short reads are not aligned to 3 bytes: keep the remainder for the next chunk
+        data = self.pending + data
+        split = len(data) - len(data) % 3
+        self.pending = data[split:]
+        if split:
+            self.consumer.write(base64.b64encode(data[:split]))
+
+    def finishData(self):
+        self.consumer.write(base64.b64encode(self.pending) + self.footer)
+        self.pending = ''
+
+
+class MultipartRangeProducer(DataStreamProducer):
+    """ Streams several ranges of a data stream as a multipart/byteranges body (RFC 7233, appendix A) """
+
+    def __init__(self, backend, ranges, size, content_type):
+        super(MultipartRangeProducer, self).__init__(backend)
+        self.boundary = uuid.uuid4().hex
+        # ranges as (part header, begin, end) with an exclusive end
+        self.parts = [('\r\n--%s\r\nContent-Type: %s\r\nContent-Range: bytes %d-%d/%d\r\n\r\n'
+                       % (self.boundary, content_type, first, last, size), first, last + 1)
+                      for first, last in ranges]
+        self.trailer = '\r\n--%s--\r\n' % self.boundary
+
+    @property
+    def content_length(self):
+        return sum(len(header) + end - begin for header, begin, end in self.parts) + len(self.trailer)
+
+    def beginSendingData(self, datastream, consumer):
+        self.remaining_parts = list(self.parts)
+        header, begin, end = self.remaining_parts.pop(0)
+        consumer.write(header)
+        return super(MultipartRangeProducer, self).beginSendingData(datastream, consumer, begin, end)
+
+    def nextRange(self):
+        if not self.remaining_parts:
+            return False
+        header, self.begin, self.end = self.remaining_parts.pop(0)
+        self.consumer.write(header)
+        return True
+
+    def finishData(self):
+        self.consumer.write(self.trailer)
 
 
 class CdmiView(HttpRestView):
@@ -118,30 +354,17 @@ class CdmiView(HttpRestView):
         return super(CdmiView, self).render_OPTIONS(request)
 
     def render_object(self, obj, request, render_value):
-        """Render an object into JSON. If render_value is True, render load and render also the content"""
+        """Render an object into JSON. If render_value is True, render also the transfer encoding of the value"""
         return json.dumps(self.object_to_dict(obj, request, render_value=render_value), cls=JsonSetEncoder)
 
     def get_additional_data(self, obj, attrs=None):
         return {}
 
-    def object_to_dict(self, obj, request, attrs={}, render_value=True):
+    def object_to_dict(self, obj, request, attrs={}, render_value=True, render_children=True):
 
         def filter_attr(attr, attrs):
             return attrs is None or len(attrs) == 0 or attr in attrs.keys()
 
-        def get_data(obj, begin=0, end=None):
-            datastream = self.load_object(obj, request.getHeader('X-Auth-Token'))
-
-            if datastream.tell() < begin:
-                datastream.seek(begin)
-
-            if isinstance(end, int):
-                data = datastream.read(end - begin)
-            else:
-                data = datastream.read()
-
-            return base64.b64encode(data)
-
         def object_data_generator(obj, attrs=dict()):
             yield ('objectType', lambda: self.object_type_map[obj.type])
             yield ('objectID', lambda: obj.oid)
@@ -151,31 +374,36 @@ class CdmiView(HttpRestView):
                                         if (not IRootContainer.providedBy(obj)
                                             and not ISystemCapability.providedBy(obj))
                                         else None))
-            yield ('completionStatus', lambda: 'Complete')  # TODO: report errors / incomplete status
+            yield ('completionStatus', lambda: getattr(obj, 'completion_status', 'Complete'))
 
             if IStorageContainer.providedBy(obj) or IDataObject.providedBy(obj):
-                yield ('metadata', lambda: dict(obj.metadata))
+                yield ('metadata', lambda: self.object_metadata(obj))
 
             if isinstance(obj, ObjectIdContainer):
-                yield ('children', lambda: [(child.oid if IInStorageContainer.providedBy(child)
-                                             else child.__name__) for child in obj.listcontent()])
-                yield ('childrenrange', lambda: '0-%d' % len(obj.listcontent()))
-            elif IStorageContainer.providedBy(obj):
-                yield ('children', lambda: [(child.name if IDataObject.providedBy(child)
-                                             else child.__name__) for child in obj.listcontent()])
-                yield ('childrenrange', lambda: '0-%d' % len(obj.listcontent()))
-            elif IDataObject.providedBy(obj) and render_value:
-                # NOTE: 'value' attribute name is mandated by the specification
-                if 'value' in attrs:
-                    begin, end = (int(v) for v in attrs['value'])
+                if 'children' in attrs:
+                    # NOTE: CDMI children ranges are inclusive
+                    begin, last = attrs['children']
+                    children = obj.list_oids(begin, last + 1)
+                    yield ('children', lambda: children)
+                    yield ('childrenrange', lambda: children_range(begin, len(children)))
                 else:
-                    begin = 0
-                    end = None
-                yield ('value', lambda: get_data(obj, begin=begin, end=end))
+                    yield ('children', lambda: obj.list_oids())
+                    yield ('childrenrange', lambda: children_range(0, len(obj)))
+            elif IStorageContainer.providedBy(obj) and render_children:
+                if 'children' in attrs:
+                    begin, last = attrs['children']
+                    children = child_names(obj, begin, last + 1)
+                    yield ('children', lambda: children)
+                    yield ('childrenrange', lambda: children_range(begin, len(children)))
+                else:
+                    yield ('children', lambda: child_names(obj))
+                    yield ('childrenrange', lambda: children_range(0, child_count(obj)))
+            elif IDataObject.providedBy(obj) and render_value:
+                # the value itself is never rendered here: it is streamed by handle_cdmi_value_get
                 yield ('valuetransferencoding', lambda: 'base64')
             elif ISystemCapability.providedBy(obj):
                 yield ('children', lambda: [])
-                yield ('childrenrange', lambda: '0-0'),
+                yield ('childrenrange', lambda: children_range(0, 0))
                 yield ('capabilities', lambda: current_capabilities.system)
 
         # filter for requested attributes
@@ -187,6 +415,33 @@ class CdmiView(HttpRestView):
         data.update(self.get_additional_data(obj, attrs=attrs))
         return data
 
+    def object_metadata(self, obj):
+        """ User metadata of the object together with the storage system metadata """
+        metadata = dict(obj.metadata)
+        if IDataObject.providedBy(obj) and obj.value_hash is not None:
+            metadata['cdmi_hash'] = obj.value_hash
+        return metadata
+
+    def entity_tag(self, obj, cdmi):
+        """ Strong validator of the CDMI representation or of the value of a data object """
+        if cdmi or obj.value_hash is None:
+            return '"%s.%d%s"' % (obj.oid, obj.version, '.cdmi' if cdmi else '')
+        return '"%s"' % obj.value_hash
+
+    def check_preconditions(self, request, obj, cdmi):
+        """ Set the validators of a data object and evaluate conditional headers against them.
+        Returns 304 or 412 if the request must not be processed, otherwise None """
+        if obj is None:
+            return common.check_preconditions(request.method, request.getHeader, [], None)
+
+        request.setHeader('ETag', self.entity_tag(obj, cdmi))
+        if obj.mtime is not None:
+            request.setHeader('Last-Modified', http.datetimeToString(obj.mtime))
+
+        # either representation can be used to update an object
+        etags = [self.entity_tag(obj, cdmi), self.entity_tag(obj, not cdmi)]
+        return common.check_preconditions(request.method, request.getHeader, etags, obj.mtime)
+
     def get_principal(self, request):
         interaction = request.interaction
 
@@ -198,11 +453,15 @@ class CdmiView(HttpRestView):
 
     def parse_args_to_filter_attrs(self, args):
         for key, val in args.iteritems():
-            if key == 'value':
-                values = map(int, val)
+            if key in ('value', 'children'):
+                # accept both ?value=1&value=6 and ?value=1-6
+                try:
+                    values = [int(v) for item in val for v in item.split('-')]
+                except ValueError:
+                    raise BadRequest('Invalid %s range: %s' % (key, ', '.join(val)))
                 begin = min(values)
                 end = max(values)
-                yield ('value', [begin, end])
+                yield (key, [begin, end])
             elif key == 'metadata':
                 yield ('metadata', val)
             else:
@@ -211,22 +470,89 @@ class CdmiView(HttpRestView):
     def handle_noncdmi_get(self, request):
         log.debug('Processing request as non-CDMI')
         request.setHeader('Content-Type', self.context.mimetype.encode('ascii'))
+        request.setHeader('Accept-Ranges', 'bytes')
+
+        # XXX: It should not be the only option to get authentication credentials
+        storemgr = getAdapter(self.context, IDataStoreFactory).create_async()
+        d = storemgr.load(request.getHeader('X-Auth-Token'))
+        d.addCallback(self.send_data, request, storemgr.backend)
+        d.addCallbacks(lambda r: log.debug('Finished sending data'),
+                       self.handle_load_error, errbackArgs=(request,))
+
+        return NOT_DONE_YET
+
+    def send_data(self, datastream, request, backend):
+        """ Send the data stream as the response body, honouring the Range header (RFC 7233) """
+        size = common.get_stream_size(datastream)
         byterange = request.getHeader('Range')
+        ranges = None
+
+        if byterange is not None and size is not None:
+            ranges = common.parse_byte_ranges(byterange, size, get_config().getint('store', 'max_byte_ranges',
+                                                                                  common.MAX_BYTE_RANGES))
+            log.debug('Getting ranges %s of "%s"' % (ranges, byterange))
+
+        if ranges is None:
+            if size is not None:
+                request.setHeader('Content-Length', str(size))
+            return DataStreamProducer(backend).beginSendingData(datastream, request)
+
+        if not ranges:
+            datastream.close()
+            request.setResponseCode(416)
+            request.setHeader('Content-Range', 'bytes */%d' % size)
+            request.setHeader('Content-Length', '0')
+            request.finish()
+            return
 
-        begin = 0
-        end = None
+        request.setResponseCode(206)
 
-        if byterange is not None:
-            begin, end = map(int, byterange.split('-'))
-            log.debug('Getting range %d:%d' % (begin, end))
+        if len(ranges) == 1:
+            first, last = ranges[0]
+            request.setHeader('Content-Range', 'bytes %d-%d/%d' % (first, last, size))
+            request.setHeader('Content-Length', str(last - first + 1))
+            return DataStreamProducer(backend).beginSendingData(datastream, request, first, last + 1)
 
-        # XXX: It should not be the only option to get authentication credentials
-        datastream = self.load_object(self.context, request.getHeader('X-Auth-Token'))
-        d = DataStreamProducer().beginSendingData(datastream, request, begin, end)
-        d.addBoth(lambda r: log.debug('Finished sending data'))
+        producer = MultipartRangeProducer(backend, ranges, size, self.context.mimetype.encode('ascii'))
+        request.setHeader('Content-Type', 'multipart/byteranges; boundary=%s' % producer.boundary)
+        request.setHeader('Content-Length', str(producer.content_length))
+        return producer.beginSendingData(datastream, request)
+
+    def handle_cdmi_value_get(self, request, attrs):
+        """ Render a data object with its value streamed as base64, without buffering the whole value """
+        begin, end = attrs['value'] if attrs.get('value') else (0, None)
+
+        data = self.object_to_dict(self.context, request, attrs=attrs)
+
+        # NOTE: 'value' attribute name is mandated by the specification
+        document = json.dumps(data, cls=JsonSetEncoder)
+        header = '%s%s"value": "' % (document[:-1], ', ' if data else '')
+
+        storemgr = getAdapter(self.context, IDataStoreFactory).create_async()
+        d = storemgr.load(request.getHeader('X-Auth-Token'))
+        d.addCallback(lambda datastream: Base64ValueProducer(storemgr.backend, header, '"}')
+                      .beginSendingData(datastream, request, begin, end))
+        d.addCallbacks(lambda r: log.debug('Finished sending data'),
+                       self.handle_load_error, errbackArgs=(request,))
+
+        return NOT_DONE_YET
+
+    def handle_children_streaming(self, request, attrs):
+        """ Render a container with its children listing streamed in batches """
+        data = self.object_to_dict(self.context, request, attrs=attrs, render_children=False)
+        document = json.dumps(data, cls=JsonSetEncoder)
+        header = '%s%s"children": [' % (document[:-1], ', ' if data else '')
+
+        d = ChildrenListingProducer(self.context.oid, self.listing_batch_size).beginProducing(header, request)
+        d.addCallbacks(lambda count: log.debug('Finished sending %d children', count),
+                       self.handle_load_error, errbackArgs=(request,))
 
         return NOT_DONE_YET
 
+    @property
+    def listing_batch_size(self):
+        return get_config().getint('store', 'listing_batch_size', 1000)
+
     def _parse_and_validate_data(self, request):
         try:
             data = json.load(request.content)
@@ -240,28 +566,78 @@ class CdmiView(HttpRestView):
 
         return data
 
-    def store_object(self, obj, datastream, encoding, credentials, **kwargs):
-        storemgr = getAdapter(obj, IDataStoreFactory).create()
-        storemgr.save(datastream, encoding, credentials, **kwargs)
+    def _parse_object_data(self, request):
+        """ Parse a data object request body, returning the value as a stream read lazily from the body """
+        try:
+            data = CdmiObjectParser(request.content).parse()
+        except ValueError as e:
+            log.error('Request content could not be parsed as a JSON dictionary: %s', e)
+            raise BadRequest("Input data could not be parsed")
+
+        value = data.get('value')
+
+        if value is None:
+            dstream = io.BytesIO()
+        elif isinstance(value, JsonStringReader):
+            dstream = value
+        else:
+            log.error('Value of the data object was not a string:\n%s', value)
+            raise BadRequest("Value of the data object must be a string")
 
-    def load_object(self, obj, credentials, **kwargs):
+        return data, dstream
+
+    def store_object(self, obj, datastream, encoding, credentials, content_md5=None):
         storemgr = getAdapter(obj, IDataStoreFactory).create()
-        return storemgr.load(credentials, **kwargs)
+        save_data(storemgr, datastream, encoding, credentials, content_md5=content_md5)
+        if obj.completion_status != COMPLETE:
+            obj.completion_status = COMPLETE
 
     @db.transact
-    def handle_success(self, r, request, obj, principal, update, dstream, encoding):
+    def handle_success(self, r, request, obj, principal, update, dstream, encoding, expected_version=None):
+        metrics.time_commit()
+        if expected_version is not None:
+            # the conditional headers were evaluated outside of the transaction: a concurrent update may
+            # have been committed meanwhile. The request has been applied to obj, so the stored object is
+            # compared; updates committed concurrently with this transaction conflict on commit.
+            stored = get_object_by_oid(obj.oid)
+            if stored is None or stored.version != expected_version:
+                raise PreconditionFailed('%s was modified by another request' % obj.name)
+
         if not update:
             obj.__owner__ = principal
             self.context.add(obj)
+            handle(obj, ModelCreatedEvent(self.context))
 
-        if IDataObject.providedBy(obj):
+        spooled = False
+        if IDataObject.providedBy(obj) and is_write_behind(obj.__parent__):
+            self.spool_object(obj, dstream, encoding, content_md5=request.getHeader('Content-MD5'))
+            spooled = True
+        elif IDataObject.providedBy(obj):
             # XXX this is a hack and it doesn't feel the extraction should
             # happen here. But cannot come up with smarter ideas at the moment
             credentials = request.getHeader('X-Auth-Token')
-            self.store_object(obj, dstream, encoding, credentials)
+            self.store_object(obj, dstream, encoding, credentials,
+                              content_md5=request.getHeader('Content-MD5'))
 
         self.add_log_event(principal, '%s of %s (%s) via CDMI was successful' %
                            ('Creation' if not update else 'Update', obj.name, obj.__name__))
+        return spooled
+
+    def spool_object(self, obj, datastream, encoding, content_md5=None):
+        """ Spool data of the object to local disk, to be uploaded to its backend in the background """
+        getAdapter(obj, IDataStoreFactory).get_backend()
+        # save_data records the next version of the object once the data is saved
+        spool = get_write_behind_queue().spool(obj, obj.version + 1)
+        try:
+            save_data(spool, datastream, encoding, content_md5=content_md5)
+        except Exception:
+            spool.delete()
+            raise
+        obj.completion_status = PROCESSING
+
+    def schedule_upload(self, spooled, request, obj):
+        if spooled:
+            get_write_behind_queue().enqueue(obj.oid, obj.version, request.getHeader('X-Auth-Token'))
 
     def handle_error(self, f, request, obj, principal, update):
         f.trap(Exception)
@@ -287,6 +663,8 @@ class CdmiView(HttpRestView):
             return
         except BadRequest:
             request.setResponseCode(400)
+        except PreconditionFailed:
+            request.setResponseCode(412)
         except Exception:
             log.debug('Error debugging info', exc_info=True)
             request.setResponseCode(500)
@@ -294,12 +672,33 @@ class CdmiView(HttpRestView):
         request.write(json.dumps({'errorMessage': str(f.value)}))
         request.finish()
 
+    def handle_load_error(self, f, request):
+        if request.finished or request.startedWriting:
+            log.error('Sending data of %s failed after the response was started: %s: %s',
+                      self.context, type(f.value).__name__, f.value)
+            return
+
+        log.error('Loading data of %s failed: %s: %s', self.context, type(f.value).__name__, f.value)
+
+        if f.check(BadRequest):
+            request.setResponseCode(400)
+        else:
+            log.debug('Error debugging info: %s', f.getTraceback())
+            request.setResponseCode(500)
+
+        request.setHeader('Content-Type', 'application/json')
+        request.write(json.dumps({'errorMessage': str(f.value)}))
+        request.finish()
+
     def finish_response(self, r, request, obj, noncdmi=False, render_value=True):
         if request.finished:  # Should not be triggered at all
             log.error('Connection lost: cannot render resulting object. '
                       'Modifications were saved. %s', request)
             return
 
+        if IDataObject.providedBy(obj):
+            request.setHeader('ETag', self.entity_tag(obj, not noncdmi))
+
         if not noncdmi:
             request.write(self.render_object(obj, request, render_value=render_value))
 
@@ -312,10 +711,24 @@ class CdmiView(HttpRestView):
 
         cdmi = request.getHeader('X-CDMI-Specification-Version')
 
+        if IDataObject.providedBy(self.context):
+            # answered without touching the backend
+            status = self.check_preconditions(request, self.context, bool(cdmi))
+            if status is not None:
+                request.setResponseCode(status)
+                request.finish()
+                return NOT_DONE_YET
+
         if cdmi or not IDataObject.providedBy(self.context):
             request.setHeader('Content-Type', self.object_type_map[self.context.type])
             log.debug('Received arguments: %s', request.args)
             attrs = dict(self.parse_args_to_filter_attrs(request.args))
+            if IDataObject.providedBy(self.context) and (not attrs or 'value' in attrs):
+                return self.handle_cdmi_value_get(request, attrs)
+            # listings larger than a batch are streamed
+            if (IStorageContainer.providedBy(self.context) and not attrs and
+                    child_names(self.context, self.listing_batch_size, self.listing_batch_size + 1)):
+                return self.handle_children_streaming(request, attrs)
             return self.object_to_dict(self.context, request, attrs=attrs)
         else:
             return self.handle_noncdmi_get(request)
@@ -325,32 +738,31 @@ class CdmiView(HttpRestView):
         existing_object = self.context if not hasattr(request, 'unresolved_path') else None
 
         requested_type = request.getHeader('content-type')
-        content_length = request.getHeader('content-length')
 
         if requested_type is None:
             log.error('content-type not found in %s', request.getAllHeaders())
             raise BadRequest('No Content-Type specified')
 
-        data = {}
-        noncdmi = False
+        expected_version = None
+        if existing_object is None or IDataObject.providedBy(existing_object):
+            # evaluated before the object is modified by applying the request
+            status = self.check_preconditions(request, existing_object,
+                                              requested_type in self.object_constructor_map)
+            if status is not None:
+                request.setResponseCode(status)
+                request.finish()
+                return NOT_DONE_YET
 
-        if requested_type not in self.object_constructor_map.keys():
-            noncdmi = True
-            dstream = request.content
-            data[u'content_length'] = content_length
-            data[u'mimetype'] = requested_type
-            data[u'value'] = None
-            # set to a 'correct' one - the only supported via CDMI
-            requested_type = 'application/cdmi-object'
-        elif requested_type == 'application/cdmi-object':
-            data = self._parse_and_validate_data(request)
-            dstream = StringIO.StringIO(data.get('value', ''))
-            data[u'value'] = None
-        elif requested_type == 'application/cdmi-container':
-            dstream = io.BytesIO()
-            data = self._parse_and_validate_data(request)
-        else:
-            raise BadRequest('Cannot handle PUT for the request object type %s' % requested_type)
+            if existing_object is not None and any(request.getHeader(header) is not None for header in
+                                                   ('If-Match', 'If-None-Match', 'If-Unmodified-Since')):
+                # checked again in the write transaction
+                expected_version = existing_object.version
+
+        data, dstream, requested_type, noncdmi = self._parse_request_data(request, requested_type)
+
+        for operation in (u'copy', u'move'):
+            if operation in data:
+                return self.handle_copy_or_move(request, operation, data, requested_type, existing_object)
 
         if existing_object:
             data[u'name'] = unicode(parse_path(request.path)[-1])
@@ -370,17 +782,376 @@ class CdmiView(HttpRestView):
             return form.error_dict()
 
         result_object = getattr(form, action)()
+        return self.save_object(request, result_object, existing_object, dstream,
+                                data.get(u'valuetransferencoding', 'utf-8'), noncdmi,
+                                expected_version=expected_version)
+
+    def _parse_request_data(self, request, requested_type):
+        """ Parse the body of a request to create or update an object. Returns the object data, the
+        value stream, the CDMI object type and whether the value is the plain body (non-CDMI) """
+        if requested_type not in self.object_constructor_map.keys():
+            data = {}
+            data[u'content_length'] = request.getHeader('content-length')
+            data[u'mimetype'] = requested_type
+            data[u'value'] = None
+            # set to a 'correct' one - the only supported via CDMI
+            return data, request.content, 'application/cdmi-object', True
+        elif requested_type == 'application/cdmi-object':
+            data, dstream = self._parse_object_data(request)
+            data[u'value'] = None
+            return data, dstream, requested_type, False
+        elif requested_type == 'application/cdmi-container':
+            return self._parse_and_validate_data(request), io.BytesIO(), requested_type, False
+        else:
+            raise BadRequest('Cannot handle %s for the request object type %s' % (request.method, requested_type))
 
+    def save_object(self, request, obj, existing_object, dstream, encoding, noncdmi, expected_version=None):
+        """ Add a created object to the container or commit an update, storing the value of a data
+        object, and render the response. A conditional update fails if the version of the stored object
+        is no longer expected_version """
         principal = self.get_principal(request)
-        d = self.handle_success(None, request, result_object, principal, existing_object, dstream,
-                                data.get(u'valuetransferencoding', 'utf-8'))
+        d = self.handle_success(None, request, obj, principal, existing_object, dstream, encoding,
+                                expected_version)
         connection_lost = request.notifyFinish()
         connection_lost.addBoth(lambda r: d.cancel())
-        d.addCallback(self.finish_response, request, result_object, noncdmi, render_value=False)
-        d.addErrback(self.handle_error, request, result_object, principal, existing_object)
+        d.addCallback(self.schedule_upload, request, obj)
+        d.addCallback(self.finish_response, request, obj, noncdmi, render_value=False)
+        d.addErrback(self.handle_error, request, obj, principal, existing_object)
+
+        return NOT_DONE_YET
+
+    def handle_copy_or_move(self, request, operation, data, requested_type, existing_object):
+        """ Create an object as a copy of an existing one, or move an existing one to a new name """
+        if existing_object:
+            raise BadRequest('Objects can only be copied or moved to new names')
+
+        source_path = data[operation]
+        source = resolve_path(source_path) if isinstance(source_path, basestring) else None
+        if source is None:
+            raise BadRequest('Source object %s of the %s was not found' % (source_path, operation))
+
+        if not self.may_transfer(request, operation, source):
+            raise Forbidden('Not allowed to %s %s' % (operation, source_path))
+
+        if not isinstance(source, self.object_constructor_map[requested_type]):
+            raise BadRequest('Source object %s is not of the requested type %s' % (source_path, requested_type))
+
+        parent = self.context
+        while parent is not None:
+            if parent is source:
+                raise BadRequest('Cannot %s a container into itself' % operation)
+            parent = getattr(parent, '__parent__', None)
+
+        metadata = data.get(u'metadata')
+        if metadata is not None and not isinstance(metadata, dict):
+            raise BadRequest('Metadata must be a dictionary')
+
+        name = unicode(request.unresolved_path)
+        principal = self.get_principal(request)
+        request.setHeader('content-type', requested_type)
+
+        d = self.handle_transfer(request, operation, source, name, metadata, principal)
+        d.addCallback(lambda obj: self.finish_response(None, request, obj, render_value=False))
+        d.addErrback(self.handle_operation_error, request, principal,
+                     '%s of %s to %s' % (operation.capitalize(), source_path, name))
+
+        return NOT_DONE_YET
+
+    def may_transfer(self, request, operation, source):
+        """ Copying requires the source to be viewable, moving also to be removable from its container """
+        interaction = request.interaction
+        if not interaction.checkPermission('view', source):
+            return False
+        if operation == u'move':
+            return (interaction.checkPermission('delete', source) and
+                    interaction.checkPermission('modify', source.__parent__))
+        return True
+
+    @db.transact
+    def handle_transfer(self, request, operation, source, name, metadata, principal):
+        metrics.time_commit()
+        credentials = request.getHeader('X-Auth-Token')
+
+        if operation == u'move':
+            obj = self.move_object(source, name, credentials)
+        else:
+            obj = self.copy_object(source, self.context, name, principal, credentials)
+
+        if metadata is not None:
+            obj.metadata = metadata
+
+        if IDataObject.providedBy(obj):
+            obj.touch()
+
+        self.add_log_event(principal, '%s of %s to %s (%s) via CDMI was successful' %
+                           (operation.capitalize(), source.name, obj.name, obj.oid))
+        return obj
+
+    def check_transferable(self, obj):
+        if IDataObject.providedBy(obj) and obj.completion_status == PROCESSING:
+            raise BadRequest('Data of %s is still being written' % obj.name)
+
+    def move_object(self, obj, name, credentials):
+        """ Relink the object under the new name. Data of a data object is moved only if its location
+        depends on the name or on the container """
+        self.check_transferable(obj)
+        old_parent = obj.__parent__
+        old_value = getattr(obj, 'value', None)
+
+        del old_parent[obj.__name__]
+        obj.__parent__ = None
+        obj.__name__ = name
+        self.context.add(obj)
+
+        if IDataObject.providedBy(obj):
+            obj.value = None
+            getAdapter(obj, IDataStoreFactory).get_backend()
+            if obj.value != old_value:
+                source = DataObject(oid=obj.oid, name=obj.name, mimetype=obj.mimetype, value=old_value)
+                source.hash_algorithm, source.value_hash = obj.hash_algorithm, obj.value_hash
+                transfer_data(source, obj, credentials, move=True)
+
+        return obj
+
+    def copy_object(self, source, container, name, principal, credentials):
+        """ Recursively copy the source object into the container under the given name """
+        self.check_transferable(source)
+        if IStorageContainer.providedBy(source):
+            obj = StorageContainer(name=name, metadata=dict(source.metadata))
+        else:
+            obj = DataObject(name=name, mimetype=source.mimetype, metadata=dict(source.metadata),
+                             content_length=source.content_length)
+
+        obj.__owner__ = principal
+        container.add(obj)
+        handle(obj, ModelCreatedEvent(container))
+
+        if IDataObject.providedBy(obj):
+            transfer_data(source, obj, credentials)
+        else:
+            for child in source.listcontent():
+                if IStorageContainer.providedBy(child) or IDataObject.providedBy(child):
+                    self.copy_object(child, obj, child.__name__, principal, credentials)
+
+        return obj
+
+    batch_content_types = ('application/json', 'application/x-ndjson')
+
+    def _parse_batch(self, request, content_type):
+        """ Parse a batch of object descriptors: a JSON list or newline delimited JSON objects """
+        try:
+            if content_type == 'application/x-ndjson':
+                descriptors = [json.loads(line) for line in request.content if line.strip()]
+            else:
+                descriptors = json.load(request.content)
+        except ValueError as e:
+            log.error('Batch could not be parsed as JSON: %s', e)
+            raise BadRequest("Input data could not be parsed")
+
+        if not isinstance(descriptors, list) or not all(isinstance(d, dict) for d in descriptors):
+            log.error('Batch was not a list of dictionaries')
+            raise BadRequest("Input data must be a list of dictionaries")
+
+        max_objects = get_config().getint('store', 'batch_max_objects', 10000)
+        if len(descriptors) > max_objects:
+            raise BadRequest('Batches are limited to %d objects' % max_objects)
+
+        return descriptors
+
+    def _build_batch(self, descriptors):
+        """ Validate object descriptors and create the objects. Returns lists of (object, datastream,
+        encoding) triples and of errors """
+        objects = []
+        errors = []
+        names = set()
+        # object IDs of the whole batch are generated at once
+        oids = iter(common.generate_guids_b16(len(descriptors)))
+
+        for index, descriptor in enumerate(descriptors):
+            data = dict(descriptor)
+            requested_type = data.pop(u'objectType', 'application/cdmi-object')
+            name = data.get(u'name')
+            value = data.pop(u'value', None)
+
+            def error(errors_):
+                errors.append({'index': index, 'name': name, 'errors': errors_})
+
+            if requested_type not in self.object_constructor_map:
+                error({'objectType': 'Cannot handle the object type %s' % requested_type})
+                continue
+
+            if not isinstance(name, basestring) or not name or '/' in name:
+                error({'name': 'A name without slashes is required'})
+                continue
+
+            if name in names or self.context[name] is not None:
+                error({'name': 'An object with this name already exists'})
+                continue
+            names.add(name)
+
+            if value is not None and not isinstance(value, basestring):
+                error({'value': 'Value of the data object must be a string'})
+                continue
+
+            requested_class = self.object_constructor_map[requested_type]
+            data[u'name'] = unicode(name)
+            data[u'oid'] = unicode(next(oids))
+            if requested_class is DataObject:
+                data[u'value'] = None
+
+            form = CdmiObjectValidatorFactory.get_creator(requested_class, data)
+            if form.errors:
+                error(form.error_dict())
+                continue
+
+            if isinstance(value, unicode):
+                value = value.encode('utf-8')
+            objects.append((form.create(), io.BytesIO(value or ''),
+                            data.get(u'valuetransferencoding', 'utf-8')))
+
+        return objects, errors
+
+    @db.transact
+    def handle_batch(self, request, objects, principal):
+        """ Add all the objects of a batch and save their data concurrently in a single transaction.
+        Returns the data objects whose data was spooled, to be uploaded once the transaction commits """
+        metrics.time_commit()
+        credentials = request.getHeader('X-Auth-Token')
+        saves = []
+        spooled = []
+
+        try:
+            for obj, dstream, encoding in objects:
+                obj.__owner__ = principal
+                self.context.add(obj)
+                handle(obj, ModelCreatedEvent(self.context))
+
+                if IDataObject.providedBy(obj) and is_write_behind(self.context):
+                    self.spool_object(obj, dstream, encoding)
+                    spooled.append(obj)
+                elif IDataObject.providedBy(obj):
+                    factory = getAdapter(obj, IDataStoreFactory)
+                    saves.append((factory.get_backend(), factory.create(), dstream, encoding))
+        except Exception:
+            self.remove_spooled(spooled)
+            raise
+
+
+        results = call_in_backends([(backend, save_data, (store, dstream, encoding, credentials))
+                                    for backend, store, dstream, encoding in saves])
+        failures = [result for success, result in results if not success]
+
+        if failures:
+            # the transaction is aborted: remove the data that did get saved
+            for (backend, store, dstream, encoding), (success, result) in zip(saves, results):
+                if success:
+                    try:
+                        store.delete(credentials)
+                    except Exception as e:
+                        log.warning('Could not remove data of %s from a failed batch: %s', store.context, e)
+            self.remove_spooled(spooled)
+            failures[0].raiseException()
+
+        self.add_log_event(principal, 'Creation of %d objects in %s via CDMI batch was successful' %
+                           (len(objects), self.context.name))
+        return spooled
+
+    def remove_spooled(self, objects):
+        for obj in objects:
+            try:
+                get_write_behind_queue().spool(obj, obj.version).delete()
+            except Exception as e:
+                log.warning('Could not remove spooled data of %s from a failed batch: %s', obj, e)
+
+    def schedule_batch_uploads(self, spooled, request):
+        for obj in spooled:
+            self.schedule_upload(True, request, obj)
+
+    def handle_operation_error(self, f, request, principal, operation):
+        """ Report failure of an operation on several objects, described by operation """
+        if request.finished:
+            log.error('Connection lost: cannot return error message to the client. %s', request)
+            return
+
+        self.add_log_event(principal, '%s via CDMI failed: %s: %s' %
+                           (operation, type(f.value).__name__, f.value))
+        log.error('%s via CDMI failed: %s: %s', operation, type(f.value).__name__, f.value)
+
+        if f.check(BadRequest):
+            request.setResponseCode(400)
+        else:
+            log.debug('Error debugging info: %s', f.getTraceback())
+            request.setResponseCode(500)
+
+        request.write(json.dumps({'errorMessage': str(f.value)}))
+        request.finish()
+
+    def finish_batch_response(self, r, request, objects):
+        if request.finished:
+            log.error('Connection lost: cannot render the created objects. '
+                      'Modifications were saved. %s', request)
+            return
+
+        request.write(json.dumps({'objects': [{'objectName': obj.name, 'objectID': obj.oid}
+                                              for obj, dstream, encoding in objects]}))
+        request.finish()
+
+    @response_headers
+    def render_post(self, request):
+        content_type = (request.getHeader('content-type') or '').split(';')[0].strip()
+
+        if not IStorageContainer.providedBy(self.context):
+            raise BadRequest('Cannot handle POST for the request object type %s' % content_type)
+
+        if content_type not in self.batch_content_types:
+            return self.handle_post_object(request, content_type)
+
+        objects, errors = self._build_batch(self._parse_batch(request, content_type))
+
+        if errors:
+            log.error('Validation of a batch failed (%s):\n%s', request, errors)
+            request.setResponseCode(BadRequest.status_code)
+            return {'errors': errors}
+
+        request.setHeader('content-type', 'application/json')
+        principal = self.get_principal(request)
+        d = self.handle_batch(request, objects, principal)
+        d.addCallback(self.schedule_batch_uploads, request)
+        d.addCallback(self.finish_batch_response, request, objects)
+        d.addErrback(self.handle_operation_error, request, principal,
+                     'Creation of %d objects in %s via batch' % (len(objects), self.context.name))
 
         return NOT_DONE_YET
 
+    def handle_post_object(self, request, content_type):
+        """ Create a data object whose object ID is assigned by the server and also used as its name,
+        so that clients need not agree on names """
+        if not content_type:
+            log.error('content-type not found in %s', request.getAllHeaders())
+            raise BadRequest('No Content-Type specified')
+
+        data, dstream, requested_type, noncdmi = self._parse_request_data(request, content_type)
+        if requested_type != 'application/cdmi-object' or u'copy' in data or u'move' in data:
+            raise BadRequest('Only data objects with a value can be created with POST')
+
+        oid = unicode(common.generate_guid_b16())
+        data[u'oid'] = oid
+        data[u'name'] = oid
+        form = CdmiObjectValidatorFactory.get_creator(DataObject, data)
+
+        if form.errors:
+            log.error('Validation failed: %s (%s):\n%s', form, request, form.errors)
+            request.setResponseCode(BadRequest.status_code)
+            return form.error_dict()
+
+        request.setResponseCode(http.CREATED)
+        request.setHeader('Location', '%s/%s' % (request.path.rstrip('/'), oid))
+        if not noncdmi:
+            request.setHeader('content-type', requested_type)
+
+        return self.save_object(request, form.create(), None, dstream,
+                                data.get(u'valuetransferencoding', 'utf-8'), noncdmi)
+
     @response_headers
     def render_delete(self, request):
         name = unicode(parse_path(request.path)[-1])
@@ -390,10 +1161,7 @@ class CdmiView(HttpRestView):
             # are we deleting a container?
             if IStorageContainer.providedBy(self.context):
                 # check children
-                children = [child for child in self.context.listcontent() if
-                            IDataObject.providedBy(child) or
-                            IStorageContainer.providedBy(child)]
-                if len(children) > 0:
+                if child_count(self.context) > 0:
                     raise BadRequest('Attempt to delete a non-empty container')
             else:
                 # XXX: Alternative authentication methods!
@@ -434,7 +1202,8 @@ class StoxyViewFactory(Adapter):
     context(IStorageContainer)
 
     def resolve(self, path, request):
-        if request.method.lower() == 'get' and len(path) > 0:
+        # only PUT creates objects under a new name: POST creates them in the container itself
+        if request.method.lower() in ('get', 'post') and len(path) > 0:
             return
 
         if len(path) > 1:
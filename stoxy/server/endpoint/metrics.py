@@ -0,0 +1,22 @@
+from grokcore.component import context
+from twisted.web.server import NOT_DONE_YET
+
+from opennode.oms.endpoint.httprest.base import HttpRestView
+from opennode.oms.endpoint.httprest.root import NotFound
+
+from stoxy.server import metrics
+from stoxy.server.model.metrics import IMetrics
+
+
+class MetricsView(HttpRestView):
+    context(IMetrics)
+
+    def render_get(self, request):
+        allowed = metrics.allowed_addresses()
+        if not metrics.enabled() or (allowed is not None and request.getClientIP() not in allowed):
+            raise NotFound
+
+        request.setHeader('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        request.write(metrics.render().encode('utf-8'))
+        request.finish()
+        return NOT_DONE_YET
@@ -0,0 +1,330 @@
+"""
+Metrics of request and backend latency, data volumes and server load, exposed in the Prometheus text
+format (https://prometheus.io/docs/instrumenting/exposition_formats/)
+"""
+import bisect
+import logging
+import threading
+import time
+
+import transaction
+
+from grokcore.component import implements
+from twisted.internet import reactor
+
+from opennode.oms.config import get_config
+
+from stoxy.server.backend import cache
+from stoxy.server.backend.threadpool import pool_stats
+from stoxy.server.model.store import IDataStore
+
+
+log = logging.getLogger(__name__)
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+_metrics = []
+
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value))
+
+
+def format_labels(names, values):
+    if not names:
+        return ''
+    escaped = (unicode(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+               for value in values)
+    return '{%s}' % ','.join('%s="%s"' % pair for pair in zip(names, escaped))
+
+
+class Metric(object):
+    """ Metric of a family of time series, one per combination of label values """
+    type = None
+
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        _metrics.append(self)
+
+    def samples(self):
+        """ Return (suffix, labelnames, labelvalues, value) tuples of the current values """
+        raise NotImplementedError
+
+    def render(self):
+        lines = ['# HELP %s %s' % (self.name, self.help), '# TYPE %s %s' % (self.name, self.type)]
+        for suffix, names, values, value in self.samples():
+            lines.append('%s%s%s %s' % (self.name, suffix, format_labels(names, values), format_value(value)))
+        return '\n'.join(lines)
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def __init__(self, name, help, labelnames=()):
+        super(Counter, self).__init__(name, help, labelnames)
+        self._values = {}
+
+    def inc(self, labels=(), amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            return [('', self.labelnames, labels, value) for labels, value in sorted(self._values.items())]
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super(Histogram, self).__init__(name, help, labelnames)
+        self.buckets = tuple(buckets)
+        # per labels: [per bucket counts (non-cumulative, the last one over all buckets), sum]
+        self._values = {}
+
+    def observe(self, value, labels=()):
+        with self._lock:
+            counts = self._values.get(labels)
+            if counts is None:
+                counts = self._values[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+            counts[0][bisect.bisect_left(self.buckets, value)] += 1
+            counts[1] += value
+
+    def samples(self):
+        with self._lock:
+            values = sorted((labels, (list(counts), total)) for labels, (counts, total) in self._values.items())
+
+        samples = []
+        names = self.labelnames + ('le', )
+        for labels, (counts, total) in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'), ), counts):
+                cumulative += count
+                samples.append(('_bucket', names, labels + (format_value(bound), ), cumulative))
+            samples.append(('_sum', self.labelnames, labels, total))
+            samples.append(('_count', self.labelnames, labels, cumulative))
+        return samples
+
+
+class Gauge(Metric):
+    """ Gauge whose values are collected when rendered: collect returns (labels, value) pairs """
+    type = 'gauge'
+
+    def __init__(self, name, help, labelnames, collect):
+        super(Gauge, self).__init__(name, help, labelnames)
+        self.collect = collect
+
+    def samples(self):
+        return [('', self.labelnames, labels, value) for labels, value in self.collect()]
+
+
+def render():
+    """ Render all the metrics in the Prometheus text format """
+    parts = []
+    for metric in _metrics:
+        try:
+            parts.append(metric.render())
+        except Exception:
+            log.error('Could not collect metric %s', metric.name, exc_info=True)
+    return '\n'.join(parts) + '\n'
+
+
+_enabled = None
+
+
+def enabled():
+    """ Whether metrics are collected and served, as configured in the [metrics] section """
+    global _enabled
+    if _enabled is None:
+        value = get_config().getstring('metrics', 'enabled', 'yes')
+        _enabled = value.lower() in ('1', 'yes', 'true', 'on')
+    return _enabled
+
+
+def allowed_addresses():
+    """ Client addresses allowed to read the metrics; None allows any """
+    addresses = get_config().getstring('metrics', 'allowed_addresses', '127.0.0.1 ::1').replace(',', ' ').split()
+    return set(addresses) or None
+
+
+REQUEST_DURATION = Histogram('stoxy_http_request_duration_seconds',
+                             'Time from the start of processing of a CDMI request until the response is finished',
+                             ('method', 'code'))
+
+BACKEND_DURATION = Histogram('stoxy_backend_operation_duration_seconds',
+                             'Duration of data store operations; for loads, until the data stream is opened',
+                             ('backend', 'operation'))
+
+BACKEND_BYTES = Counter('stoxy_backend_bytes_total',
+                        'Bytes of object data saved to and loaded from data stores',
+                        ('backend', 'operation'))
+
+BACKEND_ERRORS = Counter('stoxy_backend_errors_total', 'Failed data store operations', ('backend', 'operation'))
+
+COMMIT_DURATION = Histogram('stoxy_zodb_commit_duration_seconds', 'Duration of ZODB transaction commits')
+
+COMMIT_FAILURES = Counter('stoxy_zodb_commit_failures_total', 'ZODB transaction commits that failed')
+
+
+def time_request(request):
+    """ Observe the duration of the request when its response is finished """
+    started = time.time()
+
+    def finished(r):
+        REQUEST_DURATION.observe(time.time() - started, (request.method, str(request.code)))
+
+    request.notifyFinish().addBoth(finished)
+
+
+def time_commit():
+    """ Observe the duration of the commit of the current transaction """
+    txn = transaction.get()
+    started = []
+
+    def before_commit():
+        started.append(time.time())
+
+    def after_commit(success):
+        if started:
+            COMMIT_DURATION.observe(time.time() - started[0])
+        if not success:
+            COMMIT_FAILURES.inc()
+
+    txn.addBeforeCommitHook(before_commit)
+    txn.addAfterCommitHook(after_commit)
+
+
+class CountingStream(object):
+    """ File-like wrapper counting the bytes read from the wrapped stream in a counter """
+
+    def __init__(self, stream, counter, labels):
+        self.stream = stream
+        self.counter = counter
+        self.labels = labels
+
+    def read(self, size=-1):
+        data = self.stream.read(size)
+        if data:
+            self.counter.inc(self.labels, len(data))
+        return data
+
+    def __iter__(self):
+        return iter(lambda: self.read(2 ** 16), '')
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+
+class InstrumentedDataStore(object):
+    """ Data store wrapper recording the duration, errors and data volume of the operations of a backend """
+    implements(IDataStore)
+
+    def __init__(self, store, backend):
+        self.store = store
+        self.backend = backend
+
+    @property
+    def context(self):
+        return self.store.context
+
+    def _timed(self, operation, f, *args):
+        started = time.time()
+        try:
+            return f(*args)
+        except Exception:
+            BACKEND_ERRORS.inc((self.backend, operation))
+            raise
+        finally:
+            BACKEND_DURATION.observe(time.time() - started, (self.backend, operation))
+
+    def save(self, datastream, encoding, credentials=None):
+        datastream = CountingStream(datastream, BACKEND_BYTES, (self.backend, 'save'))
+        return self._timed('save', self.store.save, datastream, encoding, credentials)
+
+    def load(self, credentials=None):
+        datastream = self._timed('load', self.store.load, credentials)
+        return CountingStream(datastream, BACKEND_BYTES, (self.backend, 'load'))
+
+    def delete(self, credentials=None):
+        return self._timed('delete', self.store.delete, credentials)
+
+    def copy(self, target, credentials=None):
+        return self._timed('copy', self.store.copy, getattr(target, 'store', target), credentials)
+
+    def move(self, target, credentials=None):
+        return self._timed('move', self.store.move, getattr(target, 'store', target), credentials)
+
+
+def instrument(store, backend):
+    """ Wrap the data store of the backend to record its metrics, if metrics are enabled """
+    return InstrumentedDataStore(store, backend) if enabled() else store
+
+
+class ReactorLagMonitor(object):
+    """ Measures how late the reactor runs timed calls, i.e. how long events wait while it is busy """
+
+    def __init__(self, interval):
+        self.interval = interval
+        self.lag = 0.0
+
+    def start(self):
+        self._expected = time.time() + self.interval
+        reactor.callLater(self.interval, self._tick)
+
+    def _tick(self):
+        now = time.time()
+        self.lag = max(0.0, now - self._expected)
+        self._expected = now + self.interval
+        reactor.callLater(self.interval, self._tick)
+
+
+_lag_monitor = ReactorLagMonitor(1)
+
+
+def start():
+    """ Start the periodic measurements, if metrics are enabled """
+    if not enabled():
+        return
+    _lag_monitor.interval = get_config().getint('metrics', 'reactor_lag_interval', 1)
+    _lag_monitor.start()
+
+
+def collect_reactor():
+    yield ('calls_from_threads', ), len(getattr(reactor, 'threadCallQueue', ()))
+    yield ('delayed_calls', ), len(reactor.getDelayedCalls())
+
+
+def collect_threadpools():
+    for backend, stats in sorted(pool_stats().items()):
+        for state, value in sorted(stats.items()):
+            yield (backend, state), value
+
+
+def collect_caches():
+    for name, instance in (('memory', cache._memory_cache), ('disk', cache._disk_cache)):
+        if instance is not None:
+            for stat, value in sorted(instance.stats().items()):
+                yield (name, stat), value
+
+
+def collect_write_behind():
+    # imported here, as write-behind records metrics itself
+    from stoxy.server.backend import writebehind
+    if writebehind._queue is not None:
+        yield (), writebehind._queue.pending
+
+
+Gauge('stoxy_reactor_queue', 'Calls waiting for the reactor: calls from threads and timed calls', ('queue', ),
+      collect_reactor)
+Gauge('stoxy_reactor_lag_seconds', 'Delay of the last periodic timed call of the reactor', (),
+      lambda: [((), _lag_monitor.lag)])
+Gauge('stoxy_threadpool_threads', 'Threads of the backend thread pools: working, started, maximum and '
+      'queued calls', ('backend', 'state'), collect_threadpools)
+Gauge('stoxy_cache', 'Statistics of the object data caches', ('cache', 'stat'), collect_caches)
+Gauge('stoxy_write_behind_pending_uploads', 'Spooled data objects waiting to be uploaded', (),
+      collect_write_behind)
@@ -1,13 +1,23 @@
 from __future__ import absolute_import
 
+import logging
+
+from itertools import islice
+from urlparse import urlparse
+
+from BTrees.Length import Length
+from BTrees.OOBTree import OOBTree
 from grokcore.component import context, implements
+from persistent import Persistent
 from zope import schema
 from zope.component import provideSubscriptionAdapter
+from zope.component import subscribers
 from zope.interface import Interface
 
 from opennode.oms.model.model.actions import ActionsContainerExtension
 from opennode.oms.model.model.base import Container
 from opennode.oms.model.model.base import ContainerInjector
+from opennode.oms.model.model.base import IContainerExtender
 from opennode.oms.model.model.base import IDisplayName
 from opennode.oms.model.model.base import ReadonlyContainer
 from opennode.oms.model.model.byname import ByNameContainerExtension
@@ -19,6 +29,9 @@ from stoxy.server import common
 from stoxy.server import model
 
 
+log = logging.getLogger(__name__)
+
+
 class IInStorageContainer(Interface):
     """Implementors of this interface can be contained in a `StorageContainer` container."""
 
@@ -38,14 +51,69 @@ class IRootContainer(Interface):
 
 
 class StorageContainer(Container):
+    """
+    Container of containers and data objects. Children are kept in an OOBTree ordered by name, so
+    that lookups, additions and removals only touch a few buckets and ranges of children can be
+    listed without sorting all of them; their number is kept in a conflict-resolving Length.
+    """
     implements(IStorageContainer, IDisplayName, IInStorageContainer)
 
     __contains__ = IInStorageContainer
 
+    # None in containers created before the counter was introduced
+    _length = None
+
     def __init__(self, oid=None, name=None, metadata={}):
         self.oid = unicode(common.generate_guid_b16() if oid is None else oid)
         self.__name__ = name
         self.metadata = metadata
+        self._items = OOBTree()
+        self._length = Length()
+
+    def migrate(self):
+        """ Convert children stored by older versions in a plain mapping. Returns True if converted """
+        if isinstance(self._items, OOBTree) and self._length is not None:
+            return False
+
+        log.info('Migrating %s to an OOBTree with %d children', self, len(self._items))
+        if not isinstance(self._items, OOBTree):
+            self._items = OOBTree(self._items.items())
+        self._length = Length(len(self._items))
+        return True
+
+    def add(self, item):
+        self.migrate()
+        name = getattr(item, '__name__', None)
+        new = name is None or name not in self._items
+        result = super(StorageContainer, self).add(item)
+        if new:
+            self._length.change(1)
+        return result
+
+    def __delitem__(self, key):
+        self.migrate()
+        super(StorageContainer, self).__delitem__(key)
+        self._length.change(-1)
+
+    def __getitem__(self, key):
+        # avoid building the whole content() mapping for a single lookup
+        item = self._items.get(key)
+        if item is not None:
+            return item
+        return self._extensions().get(key)
+
+    def _extensions(self):
+        """ Pseudo-children provided by container extensions, e.g. 'actions' and 'by-name' """
+        extensions = {}
+        for extender in subscribers((self, ), IContainerExtender):
+            extensions.update(extender.extend())
+        return extensions
+
+    def listcontent(self):
+        return list(self._items.values()) + self._extensions().values()
+
+    def listnames(self):
+        return list(self._items.keys()) + self._extensions().keys()
 
     @property
     def name(self):
@@ -66,6 +134,163 @@ class StorageContainer(Container):
         return StorageContainer
 
 
+class OidIndex(Persistent):
+    """Persistent OID -> object mapping of all containers and data objects under the storage root"""
+
+    def __init__(self):
+        self._objects = OOBTree()
+        self._length = Length()
+
+    def add(self, obj):
+        if obj.oid not in self._objects:
+            self._length.change(1)
+        self._objects[obj.oid] = obj
+
+    def remove(self, obj):
+        if obj.oid in self._objects:
+            del self._objects[obj.oid]
+            self._length.change(-1)
+
+    def get(self, oid, default=None):
+        return self._objects.get(oid, default)
+
+    def oids(self, begin=0, end=None):
+        """ Return OIDs in index order, sliced as [begin:end] """
+        return list(islice(self._objects.keys(), begin, end))
+
+    def items(self):
+        return self._objects.items()
+
+    def __len__(self):
+        return self._length()
+
+    def __contains__(self, oid):
+        return oid in self._objects
+
+
+def iter_storage(container):
+    """ Recursively yield all containers and data objects below the given container """
+    for item in container.listcontent():
+        if IStorageContainer.providedBy(item) or model.dataobject.IDataObject.providedBy(item):
+            yield item
+
+        if IStorageContainer.providedBy(item):
+            for child in iter_storage(item):
+                yield child
+
+
+def get_storage_root():
+    return db.get_root()['oms_root']['storage']
+
+
+def child_count(container):
+    """ Number of the children stored in a container """
+    length = getattr(container, '_length', None)
+    if length is not None:
+        return length()
+
+    return len(container._items)
+
+
+def migrate_containers(container=None):
+    """ Migrate all storage containers below the given one (the storage root by default) created by
+    older versions. Must be run inside a transaction; returns the number of migrated containers """
+    migrated = 0
+    for item in iter_storage(get_storage_root() if container is None else container):
+        if isinstance(item, StorageContainer) and item.migrate():
+            migrated += 1
+    return migrated
+
+
+def child_names(container, begin=0, end=None):
+    """ Names of the children stored in a container in sorted order, sliced as [begin:end] """
+    if isinstance(container._items, OOBTree):
+        return list(islice(container._items.keys(), begin, end))
+
+    return sorted(container._items.keys())[begin:end]
+
+
+def iter_child_names(container, after=None):
+    """ Iterate over names of the children stored in a container in sorted order, starting after the given one """
+    if isinstance(container._items, OOBTree):
+        if after is None:
+            return iter(container._items.keys())
+        return iter(container._items.keys(min=after, excludemin=True))
+
+    return (name for name in sorted(container._items.keys()) if after is None or name > after)
+
+
+def get_object_by_oid(oid):
+    """ Resolve a container or data object by its OID, the storage root included """
+    storage = get_storage_root()
+
+    if storage.oid == oid:
+        return storage
+
+    index = get_oid_index()
+
+    if index is None:
+        for item in iter_storage(storage):
+            if item.oid == oid:
+                return item
+        return None
+
+    return index.get(oid)
+
+
+def resolve_path(path):
+    """ Resolve an absolute CDMI path or URI of an object, e.g. /storage/container/object or
+    /storage/cdmi_objectid/<oid>. Returns None if there is no such object """
+    storage = get_storage_root()
+    segments = [unicode(segment) for segment in urlparse(path).path.split('/') if segment]
+
+    if segments and segments[0] == storage.__name__:
+        segments = segments[1:]
+
+    if len(segments) >= 2 and segments[0] == ObjectIdContainer.__name__:
+        obj = get_object_by_oid(segments[1])
+        segments = segments[2:]
+    else:
+        obj = storage
+
+    for segment in segments:
+        if not IStorageContainer.providedBy(obj):
+            return None
+        obj = obj[segment]
+
+    return obj
+
+
+def get_oid_index(create=False):
+    """ Return the OID index of the storage root.
+
+    Databases created before the index was introduced have none: it is then built from a full walk
+    of the storage tree if create is True, otherwise None is returned. Creating must happen inside
+    a transaction.
+    """
+    storage = get_storage_root()
+
+    if storage.oid_index is None and create:
+        log.info('Building the OID index of %s', storage)
+        index = OidIndex()
+        for item in iter_storage(storage):
+            index.add(item)
+        storage.oid_index = index
+        log.info('OID index built: %d objects', len(index))
+
+    return storage.oid_index
+
+
+def index_object(obj):
+    get_oid_index(create=True).add(obj)
+
+
+def unindex_object(obj):
+    index = get_oid_index()
+    if index is not None:
+        index.remove(obj)
+
+
 class ObjectIdContainer(ReadonlyContainer):
     implements(IInStorageContainer, IDisplayName)
     __contains__ = IInStorageContainer
@@ -84,22 +309,39 @@ class ObjectIdContainer(ReadonlyContainer):
 
     @property
     def _items(self):
-        storage = db.get_root()['oms_root']['storage']
+        index = get_oid_index()
+
+        if index is None:
+            return dict((item.oid, Symlink(item.oid, item)) for item in iter_storage(get_storage_root()))
 
-        objects = {}
+        return dict((oid, Symlink(oid, item)) for oid, item in index.items())
 
-        def collect(container):
-            seen = set()
-            for item in container.listcontent():
-                if IStorageContainer.providedBy(item) or model.dataobject.IDataObject.providedBy(item):
-                    objects[item.oid] = Symlink(item.oid, item)
+    def __getitem__(self, key):
+        index = get_oid_index()
 
-                if IStorageContainer.providedBy(item) and item.oid not in seen:
-                    seen.add(item.oid)
-                    collect(item)
+        if index is None:
+            return super(ObjectIdContainer, self).__getitem__(key)
 
-        collect(storage)
-        return objects
+        item = index.get(key)
+        if item is not None:
+            return Symlink(key, item)
+
+    def list_oids(self, begin=0, end=None):
+        """ Return a page of the indexed OIDs, sliced as [begin:end] """
+        index = get_oid_index()
+
+        if index is None:
+            return sorted(self._items.keys())[begin:end]
+
+        return index.oids(begin, end)
+
+    def __len__(self):
+        index = get_oid_index()
+
+        if index is None:
+            return len(self._items)
+
+        return len(index)
 
     @property
     def oid(self):
@@ -118,9 +360,13 @@ class RootStorageContainer(Container):
     __contains__ = IInStorageContainer
     __name__ = 'storage'
 
+    # OidIndex of the whole storage hierarchy; None in databases created before it was introduced
+    oid_index = None
+
     def __init__(self, *args, **kw):
         self.oid = unicode(common.generate_guid_b16())
         self.metadata = {}
+        self.oid_index = OidIndex()
         super(RootStorageContainer, self).__init__(*args, **kw)
 
     @property
@@ -1,5 +1,7 @@
 from __future__ import absolute_import
 
+import time
+
 from grokcore.component import implements
 from zope import schema
 from zope.interface import Interface
@@ -28,6 +30,15 @@ class IDataObject(Interface):
 class DataObject(Model):
     implements(IDataObject, IDisplayName, IInStorageContainer)
 
+    # digest of the value computed while it was stored; None for objects stored by older versions
+    hash_algorithm = None
+    value_hash = None
+    # incremented and updated on every modification
+    version = 0
+    mtime = None
+    # 'Processing' while the data is being written behind, an error message if writing it failed
+    completion_status = 'Complete'
+
     def __init__(self, oid=None, name=None, mimetype=None, value=None, metadata={}, content_length=None):
         self.oid = unicode(common.generate_guid_b16() if oid is None else oid)
         self.__name__ = name
@@ -53,3 +64,8 @@ class DataObject(Model):
     @property
     def type(self):
         return DataObject
+
+    def touch(self):
+        """ Record a modification of the object """
+        self.version += 1
+        self.mtime = time.time()
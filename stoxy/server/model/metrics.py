@@ -0,0 +1,40 @@
+from __future__ import absolute_import
+
+from grokcore.component import context, implements
+from zope.interface import Interface
+
+from opennode.oms.model.model.base import ContainerInjector
+from opennode.oms.model.model.base import IDisplayName
+from opennode.oms.model.model.base import ReadonlyContainer
+from opennode.oms.model.model.root import OmsRoot
+
+
+class IMetrics(Interface):
+    """ Metrics of the server, rendered in the Prometheus text format """
+
+
+class Metrics(ReadonlyContainer):
+    implements(IMetrics, IDisplayName)
+
+    __name__ = 'metrics'
+
+    _items = {}
+
+    @property
+    def name(self):
+        return self.__name__
+
+    def display_name(self):
+        return self.name
+
+    @property
+    def nicknames(self):
+        return [self.name]
+
+    def __str__(self):
+        return '<Metrics>'
+
+
+class MetricsRootInjector(ContainerInjector):
+    context(OmsRoot)
+    __class__ = Metrics
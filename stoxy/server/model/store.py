@@ -11,8 +11,32 @@ class IDataStore(Interface):
     def load(datastream):
         """ Retrieve data from the data store to a datastream"""
 
+    def copy(target, credentials):
+        """ Copy the data to the target data object of the same backend using a native primitive of the
+        backend. Returns False if that is not possible """
+
+    def move(target, credentials):
+        """ Move the data to the target data object of the same backend using a native primitive of the
+        backend. Returns False if that is not possible """
+
+
+class IAsyncDataStore(Interface):
+    """ Asynchronous variant of IDataStore. All methods return Deferreds """
+
+    def save(datastream, encoding, credentials):
+        """ Store data from datastream to the data store """
+
+    def load(credentials):
+        """ Retrieve data from the data store to a datastream"""
+
+    def delete(credentials):
+        """ Delete data from the data store """
+
 
 class IDataStoreFactory(Interface):
 
     def create():
         """ Create a data store manager for the data object """
+
+    def create_async():
+        """ Create an asynchronous data store manager for the data object """
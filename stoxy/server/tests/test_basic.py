@@ -12,6 +12,7 @@ import config
 
 from opennode.oms.config import get_config
 
+from stoxy.server.backend.manager import file_path
 from stoxy.server.tests.common import server_is_up
 from stoxy.server.tests.common import libcdmi_available
 from stoxy.server.tests.common import NotThere
@@ -227,27 +228,48 @@ class TestBasic(unittest.TestCase):
 
         self.assertEqual(200, response.status_code, response.text)
 
-        # TODO: test non-CDMI request optional Range header functionality
-        noncdmi_headers = {'Range': '10-15'}
+        noncdmi_headers = {'Range': 'bytes=10-14'}
         response = requests.get(self._endpoint + '/testcontainer/testobject',
                                 auth=self._credentials,
                                 headers=noncdmi_headers)
 
-        self.assertEqual(response.status_code, 200, response.text)
-        self.assertEqual(len(response.text), 5, response.text)
-        self.assertEqual(response.text, content[10:15])
+        self.assertEqual(response.status_code, 206, response.text)
+        self.assertEqual(len(response.content), 5, response.text)
+        self.assertEqual(response.content, content[10:15])
         self.assertEqual(response.headers['content-type'], object_headers['Content-Type'])
+        self.assertEqual(response.headers['content-range'], 'bytes 10-14/%d' % len(content))
+        self.assertEqual(response.headers['accept-ranges'], 'bytes')
 
-        # TODO: test non-CDMI request optional Range header functionality
-        noncdmi_headers = {'Range': '1-6'}
+        noncdmi_headers = {'Range': 'bytes=1-5'}
         response = requests.get(self._endpoint + '/testcontainer/testobject',
                                 auth=self._credentials,
                                 headers=noncdmi_headers)
 
-        self.assertEqual(5, len(response.text))
-        self.assertEqual(response.text, content[1:6])
+        self.assertEqual(5, len(response.content))
+        self.assertEqual(response.content, content[1:6])
         self.assertEqual(response.headers['content-type'], object_headers['Content-Type'])
 
+        for byterange, expected in (('bytes=20-', content[20:]), ('bytes=-4', content[-4:])):
+            response = requests.get(self._endpoint + '/testcontainer/testobject',
+                                    auth=self._credentials,
+                                    headers={'Range': byterange})
+            self.assertEqual(206, response.status_code, response.text)
+            self.assertEqual(expected, response.content)
+
+        response = requests.get(self._endpoint + '/testcontainer/testobject',
+                                auth=self._credentials,
+                                headers={'Range': 'bytes=0-1,20-21'})
+        self.assertEqual(206, response.status_code, response.text)
+        self.assertTrue(response.headers['content-type'].startswith('multipart/byteranges; boundary='))
+        self.assertTrue(content[0:2] in response.content)
+        self.assertTrue(content[20:22] in response.content)
+
+        response = requests.get(self._endpoint + '/testcontainer/testobject',
+                                auth=self._credentials,
+                                headers={'Range': 'bytes=%d-' % len(content)})
+        self.assertEqual(416, response.status_code, response.text)
+        self.assertEqual('bytes */%d' % len(content), response.headers['content-range'])
+
     @unittest.skipUnless(libcdmi_available(), 'libcdmi is not in the path')
     @unittest.skipUnless(server_is_up(), 'Requires a running Stoxy server')
     def test_delete_object(self):
@@ -268,10 +290,15 @@ class TestBasic(unittest.TestCase):
 
         self.assertEqual(200, response.status_code, response.text)
 
+        response = requests.get(self._endpoint + '/testcontainer/testobject?objectID',
+                                auth=self._credentials,
+                                headers=self._make_headers({}))
+        oid = response.json()['objectID']
+
         # XXX: when used from the unit test, get_config() gives only the OMS config, so need to specify
-        # the base path in OMS config too
-        stoxy_filepath = '%s/%s' % (get_config().getstring('store', 'file_base_path', '/tmp'),
-                                    'testobject')
+        # the base path and layout in OMS config too
+        stoxy_filepath = file_path(get_config().getstring('store', 'file_base_path', '/tmp'), oid, 'testobject',
+                                   get_config().getstring('store', 'file_layout', 'sharded'))
 
         self.assertTrue(os.path.exists(stoxy_filepath),
                         'File "%s" does not exist after creation of model object!' % stoxy_filepath)
@@ -413,3 +440,122 @@ class TestBasic(unittest.TestCase):
         self.assertTrue('objectID' in data.keys(), 'objectID is not in data (%s)!' % data)
         self.assertTrue('parentURI' in data.keys(), 'parentURI is not in data (%s)!' % data)
         self.assertEqual(base64.b64decode(content), base64.b64decode(data['value']), content)
+
+    @unittest.skipUnless(libcdmi_available(), 'libcdmi is not in the path')
+    @unittest.skipUnless(server_is_up(), 'Requires a running Stoxy server')
+    def test_cdmi_objectid_paged_listing(self):
+        c = libcdmi.open(self._endpoint, credentials=self._credentials)
+        self.addToCleanup(self.cleanup_object, '/testcontainer/')
+        container = c.create_container('/testcontainer/')
+
+        headers = self._make_headers({'Accept': libcdmi.common.CDMI_CONTAINER})
+        response = requests.get(self._endpoint + '/cdmi_objectid/?children=0-0',
+                                auth=self._credentials,
+                                headers=headers)
+
+        self.assertEqual(200, response.status_code, response.text)
+        data = response.json()
+        self.assertEqual(1, len(data['children']), data)
+
+        response = requests.get(self._endpoint + '/cdmi_objectid/%s/' % container['objectID'],
+                                auth=self._credentials,
+                                headers=headers)
+
+        self.assertEqual(200, response.status_code, response.text)
+        self.assertEqual(container['objectID'], response.json()['objectID'])
+
+    @unittest.skipUnless(libcdmi_available(), 'libcdmi is not in the path')
+    @unittest.skipUnless(server_is_up(), 'Requires a running Stoxy server')
+    def test_batch_create(self):
+        c = libcdmi.open(self._endpoint, credentials=self._credentials)
+        self.addToCleanup(self.cleanup_object, '/testcontainer/')
+        c.create_container('/testcontainer/')
+
+        names = ['batch-%d' % n for n in range(3)]
+        for name in names:
+            self.addToCleanup(self.cleanup_object, '/testcontainer/%s' % name)
+
+        batch = '\n'.join(json.dumps({'name': name, 'mimetype': 'text/plain', 'value': name}) for name in names)
+        response = requests.post(self._endpoint + '/testcontainer/',
+                                 auth=self._credentials,
+                                 headers={'Content-Type': 'application/x-ndjson'},
+                                 data=batch)
+
+        self.assertEqual(200, response.status_code, response.text)
+        self.assertEqual(names, [obj['objectName'] for obj in response.json()['objects']])
+
+        response = requests.get(self._endpoint + '/testcontainer/batch-1', auth=self._credentials)
+        self.assertEqual('batch-1', response.content)
+
+        # names must be unique: the whole batch is rejected
+        response = requests.post(self._endpoint + '/testcontainer/',
+                                 auth=self._credentials,
+                                 headers={'Content-Type': 'application/json'},
+                                 data=json.dumps([{'name': 'batch-3'}, {'name': 'batch-0'}]))
+
+        self.assertEqual(400, response.status_code, response.text)
+        response = requests.get(self._endpoint + '/testcontainer/batch-3', auth=self._credentials)
+        self.assertEqual(404, response.status_code, response.text)
+
+    @unittest.skipUnless(libcdmi_available(), 'libcdmi is not in the path')
+    @unittest.skipUnless(server_is_up(), 'Requires a running Stoxy server')
+    def test_post_object(self):
+        c = libcdmi.open(self._endpoint, credentials=self._credentials)
+        self.addToCleanup(self.cleanup_object, '/testcontainer/')
+        c.create_container('/testcontainer/')
+
+        response = requests.post(self._endpoint + '/testcontainer/',
+                                 auth=self._credentials,
+                                 headers={'Content-Type': 'application/cdmi-object',
+                                          'X-CDMI-Specification-Version': '1.0.2'},
+                                 data=json.dumps({'mimetype': 'text/plain', 'value': 'posted'}))
+
+        self.assertEqual(201, response.status_code, response.text)
+        oid = response.json()['objectID']
+        self.addToCleanup(self.cleanup_object, '/testcontainer/%s' % oid)
+        self.assertEqual(oid, response.json()['objectName'])
+        self.assertTrue(response.headers['Location'].endswith('/testcontainer/%s' % oid))
+
+        response = requests.post(self._endpoint + '/testcontainer/',
+                                 auth=self._credentials,
+                                 headers={'Content-Type': 'text/plain'},
+                                 data='posted too')
+
+        self.assertEqual(201, response.status_code, response.text)
+        location = response.headers['Location']
+        self.addToCleanup(self.cleanup_object, '/testcontainer/%s' % location.rsplit('/', 1)[-1])
+        self.assertNotEqual(oid, location.rsplit('/', 1)[-1])
+
+        response = requests.get(self._endpoint + '/cdmi_objectid/%s' % location.rsplit('/', 1)[-1],
+                                auth=self._credentials)
+        self.assertEqual('posted too', response.content)
+
+    @unittest.skipUnless(libcdmi_available(), 'libcdmi is not in the path')
+    @unittest.skipUnless(server_is_up(), 'Requires a running Stoxy server')
+    def test_copy_and_move_object(self):
+        c = libcdmi.open(self._endpoint, credentials=self._credentials)
+        self.addToCleanup(self.cleanup_object, '/testcontainer/')
+        c.create_container('/testcontainer/')
+        for name in ('original', 'copy', 'moved'):
+            self.addToCleanup(self.cleanup_object, '/testcontainer/%s' % name)
+
+        requests.put(self._endpoint + '/testcontainer/original', auth=self._credentials,
+                     headers={'Content-Type': 'text/plain'}, data='contents')
+
+        headers = self._make_headers({'Content-Type': libcdmi.common.CDMI_OBJECT})
+        response = requests.put(self._endpoint + '/testcontainer/copy', auth=self._credentials, headers=headers,
+                                data=json.dumps({'copy': self._endpoint + '/testcontainer/original'}))
+        self.assertEqual(200, response.status_code, response.text)
+        copy_id = response.json()['objectID']
+
+        response = requests.put(self._endpoint + '/testcontainer/moved', auth=self._credentials, headers=headers,
+                                data=json.dumps({'move': self._endpoint + '/testcontainer/copy'}))
+        self.assertEqual(200, response.status_code, response.text)
+        self.assertEqual(copy_id, response.json()['objectID'])
+
+        response = requests.get(self._endpoint + '/testcontainer/moved', auth=self._credentials)
+        self.assertEqual('contents', response.content)
+        response = requests.get(self._endpoint + '/testcontainer/original', auth=self._credentials)
+        self.assertEqual('contents', response.content)
+        response = requests.get(self._endpoint + '/testcontainer/copy', auth=self._credentials)
+        self.assertEqual(404, response.status_code, response.text)
@@ -0,0 +1,243 @@
+import io
+import os
+import shutil
+import tempfile
+import unittest
+
+from stoxy.server.backend.cache import CacheFillingStream
+from stoxy.server.backend.cache import CachingDataStore
+from stoxy.server.backend.cache import DiskCache
+from stoxy.server.backend.cache import MemoryCache
+
+
+class FakeObject(object):
+    oid = u'0000'
+    value = 'file+file:///tmp/object'
+    version = 1
+
+
+class FakeStore(object):
+
+    def __init__(self, data):
+        self.context = FakeObject()
+        self.data = data
+        self.loads = 0
+
+    def load(self, credentials=None):
+        self.loads += 1
+        return io.BytesIO(self.data)
+
+    def save(self, datastream, encoding, credentials=None):
+        self.data = datastream.read()
+
+    def delete(self, credentials=None):
+        self.data = None
+
+
+class MemoryCacheTestCase(unittest.TestCase):
+
+    def testLeastRecentlyUsedAreEvicted(self):
+        cache = MemoryCache(10, 10)
+        cache.put(('a', 1), 'aaaa')
+        cache.put(('b', 1), 'bbbb')
+        self.assertEqual('aaaa', cache.get(('a', 1)))
+
+        cache.put(('c', 1), 'cccc')
+
+        self.assertEqual(None, cache.get(('b', 1)))
+        self.assertEqual('aaaa', cache.get(('a', 1)))
+        self.assertEqual('cccc', cache.get(('c', 1)))
+        self.assertEqual(8, cache.used)
+        self.assertEqual(1, cache.evictions)
+        self.assertEqual(3, cache.hits)
+        self.assertEqual(1, cache.misses)
+
+    def testObjectsOverTheCapAreNotCached(self):
+        cache = MemoryCache(100, 4)
+        cache.put(('a', 1), 'aaaaa')
+        self.assertEqual(None, cache.get(('a', 1)))
+        self.assertEqual(0, cache.used)
+
+    def testInvalidateAllEntriesOfUri(self):
+        cache = MemoryCache(100, 10)
+        cache.put(('a', 1), 'a1')
+        cache.put(('a', 2), 'a2')
+        cache.put(('b', 1), 'b1')
+
+        cache.invalidate('a')
+
+        self.assertEqual(None, cache.get(('a', 1)))
+        self.assertEqual(None, cache.get(('a', 2)))
+        self.assertEqual('b1', cache.get(('b', 1)))
+        self.assertEqual(2, cache.used)
+
+
+class CachingDataStoreTestCase(unittest.TestCase):
+
+    def testLoadsAreServedFromCache(self):
+        store = FakeStore('data')
+        cached = CachingDataStore(store, MemoryCache(100, 10))
+
+        self.assertEqual('data', cached.load().read())
+        self.assertEqual('data', cached.load().read())
+        self.assertEqual(1, store.loads)
+
+    def testCredentialsAreNotShared(self):
+        store = FakeStore('data')
+        cached = CachingDataStore(store, MemoryCache(100, 10))
+
+        cached.load('token-1')
+        cached.load('token-2')
+        self.assertEqual(2, store.loads)
+
+    def testSaveInvalidates(self):
+        store = FakeStore('data')
+        cached = CachingDataStore(store, MemoryCache(100, 10))
+        cached.load()
+
+        cached.save(io.BytesIO('new data'), 'utf-8')
+
+        self.assertEqual('new data', cached.load().read())
+        self.assertEqual(2, store.loads)
+
+
+class SizedStream(io.BytesIO):
+    """ Stream of known size, like a Swift object stream """
+
+    def __init__(self, data):
+        io.BytesIO.__init__(self, data)
+        self.size = len(data)
+
+
+def fill(cache, key, etag, data):
+    stream = CacheFillingStream(cache, key, etag, SizedStream(data))
+    while stream.read(7):
+        pass
+    stream.close()
+    return cache.lookup(key)
+
+
+class DiskCacheTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix='stoxy-cache-test-')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def testFillAndLookup(self):
+        cache = DiskCache(self.directory, 100, 50)
+        self.assertEqual(None, cache.lookup('swift://a'))
+
+        entry = fill(cache, 'swift://a', '"etag-a"', 'a' * 10)
+
+        self.assertEqual('a' * 10, entry.open().read())
+        self.assertEqual('"etag-a"', cache.lookup('swift://a').etag)
+        self.assertEqual(10, cache.used)
+
+    def testHitsAndMissesAreRecorded(self):
+        cache = DiskCache(self.directory, 100, 50)
+        fill(cache, 'swift://a', 'a', 'a' * 10)
+
+        cache.lookup('swift://a')
+        self.assertEqual((0, 0), (cache.hits, cache.misses))
+
+        cache.record_hit('swift://a')
+        cache.record_miss()
+        self.assertEqual((1, 1), (cache.hits, cache.misses))
+        self.assertEqual(1, cache.lookup('swift://a').hits)
+
+    def testEntriesSurviveRestart(self):
+        cache = DiskCache(self.directory, 100, 50)
+        fill(cache, 'swift://a', 'etag-a', 'a' * 10)
+        open(os.path.join(self.directory, 'tmpunfinished'), 'w').close()
+
+        cache = DiskCache(self.directory, 100, 50)
+
+        self.assertEqual('etag-a', cache.lookup('swift://a').etag)
+        self.assertEqual(10, cache.used)
+        self.assertEqual(1, len(os.listdir(self.directory)))
+
+    def testLeastRecentlyUsedAreEvicted(self):
+        cache = DiskCache(self.directory, 25, 25)
+        fill(cache, 'swift://a', 'a', 'a' * 10)
+        fill(cache, 'swift://b', 'b', 'b' * 10)
+        cache.record_hit('swift://a')
+
+        fill(cache, 'swift://c', 'c', 'c' * 10)
+
+        self.assertEqual(None, cache.lookup('swift://b'))
+        self.assertNotEqual(None, cache.lookup('swift://a'))
+        self.assertEqual(20, cache.used)
+
+    def testLeastFrequentlyUsedAreEvicted(self):
+        cache = DiskCache(self.directory, 25, 25, policy='lfu')
+        fill(cache, 'swift://a', 'a', 'a' * 10)
+        fill(cache, 'swift://b', 'b', 'b' * 10)
+        cache.record_hit('swift://a')
+        cache.record_hit('swift://a')
+        cache.record_hit('swift://b')
+
+        fill(cache, 'swift://c', 'c', 'c' * 10)
+
+        self.assertEqual(None, cache.lookup('swift://b'))
+        self.assertNotEqual(None, cache.lookup('swift://a'))
+
+    def testConcurrentFillsOfTheSameData(self):
+        cache = DiskCache(self.directory, 100, 50)
+        first = CacheFillingStream(cache, 'swift://a', 'a', SizedStream('a' * 10))
+        second = CacheFillingStream(cache, 'swift://a', 'a', SizedStream('a' * 10))
+
+        self.assertEqual('a' * 10, first.read())
+        self.assertEqual('a' * 10, second.read())
+
+        self.assertEqual(10, cache.used)
+        self.assertEqual(1, len(os.listdir(self.directory)))
+
+
+class FailingStream(SizedStream):
+
+    def read(self, size=-1):
+        raise IOError('Connection lost')
+
+
+class CacheFillingStreamTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix='stoxy-cache-test-')
+        self.cache = DiskCache(self.directory, 100, 50)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def testDataIsCachedWhileRead(self):
+        stream = CacheFillingStream(self.cache, 'swift://a', 'a', SizedStream('0123456789'))
+
+        self.assertEqual('0123', stream.read(4))
+        self.assertEqual(None, self.cache.lookup('swift://a'))
+        self.assertEqual('456789', stream.read(10))
+
+        self.assertEqual('0123456789', self.cache.lookup('swift://a').open().read())
+
+    def testUnfinishedFillIsDiscarded(self):
+        stream = CacheFillingStream(self.cache, 'swift://a', 'a', SizedStream('0123456789'))
+        stream.read(4)
+        stream.close()
+
+        self.assertEqual(None, self.cache.lookup('swift://a'))
+        self.assertEqual([], os.listdir(self.directory))
+
+    def testSeekDiscardsFill(self):
+        stream = CacheFillingStream(self.cache, 'swift://a', 'a', SizedStream('0123456789'))
+        stream.seek(0)
+        stream.seek(5)
+
+        self.assertEqual('56789', stream.read())
+        self.assertEqual(None, self.cache.lookup('swift://a'))
+        self.assertEqual([], os.listdir(self.directory))
+
+    def testFailedReadDiscardsFill(self):
+        stream = CacheFillingStream(self.cache, 'swift://a', 'a', FailingStream('0123456789'))
+
+        self.assertRaises(IOError, stream.read, 4)
+        self.assertEqual([], os.listdir(self.directory))
@@ -1,9 +1,23 @@
+import base64
+import hashlib
+import os
 import re
 import struct
 import unittest
+import StringIO
 
+from stoxy.server.common import Base64DecodingStream
+from stoxy.server.common import check_preconditions
+from stoxy.server.common import crc16
+from stoxy.server.common import CRC16_TABLE
 from stoxy.server.common import generate_guid
 from stoxy.server.common import generate_guid_b64
+from stoxy.server.common import generate_guids
+from stoxy.server.common import generate_guids_b16
+from stoxy.server.common import get_stream_size
+from stoxy.server.common import HashingStream
+from stoxy.server.common import normalize_hash_algorithm
+from stoxy.server.common import parse_byte_ranges
 
 
 class GuidGenTestCase(unittest.TestCase):
@@ -25,3 +39,180 @@ class GuidGenTestCase(unittest.TestCase):
         guid = generate_guid()
         guiddata = struct.unpack('!LBBH' + 'p' * (len(guid) - 8), guid)
         self.assertEqual(len(guid), guiddata[2])
+
+    def testCrcCoversGuidWithZeroedCrc(self):
+        for guid in generate_guids(100, entnumber=32012) + [generate_guid()]:
+            self.assertEqual(struct.unpack('!H', guid[6:8])[0],
+                             reference_crc16(guid[:6] + '\x00\x00' + guid[8:]))
+
+    def testGuidsAreRandomVersion4Uuids(self):
+        guids = generate_guids(100)
+        self.assertEqual(100, len(set(guids)))
+        for guid in guids:
+            self.assertEqual(0x40, ord(guid[8 + 6]) & 0xF0)
+            self.assertEqual(0x80, ord(guid[8 + 8]) & 0xC0)
+
+    def testBase16Guids(self):
+        for guid in generate_guids_b16(10):
+            self.assertTrue(re.match('^00FFFFFF0018[0-9A-F]{36}$', guid))
+
+
+def reference_crc16(s):
+    """ Straightforward byte by byte implementation of the CDMI CRC-16 """
+    crc = 0x0000
+    for ch in s:
+        crc = (crc >> 8) ^ CRC16_TABLE[(crc ^ ord(ch)) & 0xff]
+    return crc
+
+
+class Crc16TestCase(unittest.TestCase):
+
+    def testCheckValue(self):
+        self.assertEqual(0xBB3D, crc16('123456789'))
+        self.assertEqual(0xBB3D, reference_crc16('123456789'))
+
+    def testMatchesReferenceImplementation(self):
+        for length in range(0, 64) + [1000, 1001]:
+            data = os.urandom(length)
+            self.assertEqual(reference_crc16(data), crc16(data), repr(data))
+
+    def testContinuesFromGivenState(self):
+        data = os.urandom(101)
+        for split in (0, 1, 2, 50, 101):
+            self.assertEqual(crc16(data), crc16(data[split:], crc16(data[:split])))
+
+
+class Base64DecodingStreamTestCase(unittest.TestCase):
+    data = os.urandom(10000)
+
+    def decode_in_chunks(self, encoded, size):
+        stream = Base64DecodingStream(StringIO.StringIO(encoded))
+        chunks = []
+        chunk = stream.read(size)
+        while chunk:
+            chunks.append(chunk)
+            chunk = stream.read(size)
+        return ''.join(chunks)
+
+    def testUnalignedChunks(self):
+        encoded = base64.b64encode(self.data)
+        for size in (1, 2, 7, 100, 4095, 20000):
+            self.assertEqual(self.data, self.decode_in_chunks(encoded, size))
+
+    def testReadsReturnAtMostTheRequestedSize(self):
+        encoded = base64.b64encode(self.data)
+        for size in (1, 2, 4, 5, 7, 100, 1001):
+            stream = Base64DecodingStream(StringIO.StringIO(encoded))
+            chunks = []
+            chunk = stream.read(size)
+            while chunk:
+                self.assertTrue(len(chunk) <= size, (size, len(chunk)))
+                chunks.append(chunk)
+                chunk = stream.read(size)
+            self.assertEqual(self.data, ''.join(chunks))
+            self.assertEqual([size] * (len(chunks) - 1), [len(c) for c in chunks[:-1]])
+
+    def testWhitespaceIsIgnored(self):
+        encoded = base64.encodestring(self.data)
+        self.assertEqual(self.data, self.decode_in_chunks(encoded, 1000))
+        self.assertEqual(self.data, Base64DecodingStream(StringIO.StringIO(encoded)).read())
+
+    def testInvalidInput(self):
+        stream = Base64DecodingStream(StringIO.StringIO('abc'))
+        self.assertRaises(ValueError, stream.read, 100)
+
+
+class ByteRangesTestCase(unittest.TestCase):
+
+    def testSingleRanges(self):
+        self.assertEqual([(10, 14)], parse_byte_ranges('bytes=10-14', 100))
+        self.assertEqual([(10, 99)], parse_byte_ranges('bytes=10-', 100))
+        self.assertEqual([(90, 99)], parse_byte_ranges('bytes=-10', 100))
+        self.assertEqual([(0, 99)], parse_byte_ranges('bytes=-1000', 100))
+        self.assertEqual([(95, 99)], parse_byte_ranges('bytes=95-1000', 100))
+
+    def testMultipleRangesAreSortedAndCoalesced(self):
+        self.assertEqual([(0, 9), (50, 59)], parse_byte_ranges('bytes=50-59, 0-9', 100))
+        self.assertEqual([(0, 19)], parse_byte_ranges('bytes=0-9,5-14,15-19', 100))
+        overlapping = ','.join('%d-%d' % (i, i + 10) for i in range(0, 50, 2))
+        self.assertEqual([(0, 58)], parse_byte_ranges('bytes=' + overlapping, 100))
+
+    def testTooManyRangesAreIgnored(self):
+        header = 'bytes=' + ','.join('%d-%d' % (i, i) for i in range(0, 20, 2))
+        self.assertEqual(10, len(parse_byte_ranges(header, 100, max_ranges=10)))
+        self.assertEqual(None, parse_byte_ranges(header + ',50-51', 100, max_ranges=10))
+
+    def testUnsatisfiable(self):
+        self.assertEqual([], parse_byte_ranges('bytes=100-', 100))
+        self.assertEqual([], parse_byte_ranges('bytes=-0', 100))
+        self.assertEqual([], parse_byte_ranges('bytes=0-', 0))
+
+    def testInvalidHeadersAreIgnored(self):
+        for header in ('10-15', 'items=0-1', 'bytes=5-1', 'bytes=a-b', 'bytes=-', 'bytes=1'):
+            self.assertEqual(None, parse_byte_ranges(header, 100), header)
+
+    def testStreamSize(self):
+        stream = StringIO.StringIO('x' * 42)
+        stream.seek(3)
+        self.assertEqual(42, get_stream_size(stream))
+        self.assertEqual(3, stream.tell())
+
+
+class HashingStreamTestCase(unittest.TestCase):
+
+    def testDigestsOfReadData(self):
+        data = os.urandom(10000)
+        stream = HashingStream(StringIO.StringIO(data), ['md5', 'sha256'])
+        self.assertEqual(10000, stream.size)
+
+        read = ''.join(iter(lambda: stream.read(999), ''))
+
+        self.assertEqual(data, read)
+        self.assertEqual(hashlib.md5(data).hexdigest(), stream.hexdigest('md5'))
+        self.assertEqual(hashlib.sha256(data).digest(), stream.digest('sha256'))
+
+    def testAlgorithmNames(self):
+        self.assertEqual('sha256', normalize_hash_algorithm('SHA-256'))
+        self.assertEqual('md5', normalize_hash_algorithm('MD5'))
+        self.assertEqual(None, normalize_hash_algorithm('CRC-99'))
+        self.assertEqual(None, normalize_hash_algorithm(None))
+
+
+class PreconditionsTestCase(unittest.TestCase):
+    etags = ['"abc"', '"def"']
+    mtime = 784111777  # Sun, 06 Nov 1994 08:49:37 GMT
+
+    def check(self, method, exists=True, **headers):
+        headers = dict((name.replace('_', '-').lower(), value) for name, value in headers.items())
+        return check_preconditions(method, lambda name: headers.get(name.lower()),
+                                   self.etags if exists else [], self.mtime if exists else None)
+
+    def testNoConditions(self):
+        self.assertEqual(None, self.check('GET'))
+
+    def testIfNoneMatch(self):
+        self.assertEqual(304, self.check('GET', If_None_Match='"xyz", "abc"'))
+        self.assertEqual(304, self.check('GET', If_None_Match='W/"def"'))
+        self.assertEqual(304, self.check('GET', If_None_Match='*'))
+        self.assertEqual(None, self.check('GET', If_None_Match='"xyz"'))
+        self.assertEqual(412, self.check('PUT', If_None_Match='*'))
+        self.assertEqual(None, self.check('PUT', exists=False, If_None_Match='*'))
+
+    def testIfModifiedSince(self):
+        self.assertEqual(304, self.check('GET', If_Modified_Since='Sun, 06 Nov 1994 08:49:37 GMT'))
+        self.assertEqual(None, self.check('GET', If_Modified_Since='Sun, 06 Nov 1994 08:49:36 GMT'))
+        self.assertEqual(None, self.check('GET', If_Modified_Since='yesterday'))
+        # If-None-Match takes precedence
+        self.assertEqual(None, self.check('GET', If_None_Match='"xyz"',
+                                          If_Modified_Since='Sun, 06 Nov 1994 08:49:37 GMT'))
+
+    def testIfMatch(self):
+        self.assertEqual(None, self.check('PUT', If_Match='"abc"'))
+        self.assertEqual(None, self.check('PUT', If_Match='*'))
+        self.assertEqual(412, self.check('PUT', If_Match='"xyz"'))
+        self.assertEqual(412, self.check('PUT', If_Match='W/"abc"'))
+        self.assertEqual(412, self.check('PUT', exists=False, If_Match='*'))
+
+    def testIfUnmodifiedSince(self):
+        self.assertEqual(412, self.check('PUT', If_Unmodified_Since='Sun, 06 Nov 1994 08:49:36 GMT'))
+        self.assertEqual(None, self.check('PUT', If_Unmodified_Since='Sun, 06 Nov 1994 08:49:37 GMT'))
@@ -0,0 +1,196 @@
+import os
+import random
+import shutil
+import tempfile
+import unittest
+
+import transaction
+from BTrees.OOBTree import OOBTree
+from grokcore.component.testing import grok
+from persistent.mapping import PersistentMapping
+from ZODB import DB
+from ZODB.FileStorage import FileStorage
+from mock import patch
+from zope.component import handle
+
+from opennode.oms.model.model.events import ModelCreatedEvent
+from opennode.oms.model.model.events import ModelDeletedEvent
+
+from stoxy.server.model.container import RootStorageContainer
+from stoxy.server.model.container import StorageContainer
+from stoxy.server.model.container import child_count
+from stoxy.server.model.container import child_names
+from stoxy.server.model.container import get_object_by_oid
+from stoxy.server.model.container import iter_child_names
+from stoxy.server.model.container import migrate_containers
+from stoxy.server.model.dataobject import DataObject
+
+
+def setUpModule():
+    # applies the implements() directives of the models
+    grok('stoxy.server.model.container')
+    grok('stoxy.server.model.dataobject')
+    grok('stoxy.server.backend.events')
+
+
+def make_object(name):
+    return DataObject(name=name, mimetype=u'text/plain')
+
+
+class ChildNamesTestCase(unittest.TestCase):
+
+    names = [u'a', u'b', u'c', u'd', u'e']
+
+    def setUp(self):
+        self.container = StorageContainer(name=u'container')
+        for name in random.sample(self.names, len(self.names)):
+            self.container.add(make_object(name))
+
+    def testNamesAreSorted(self):
+        self.assertEqual(self.names, child_names(self.container))
+
+    def testSlices(self):
+        self.assertEqual([u'b', u'c'], child_names(self.container, 1, 3))
+        self.assertEqual([u'd', u'e'], child_names(self.container, 3, 10))
+        self.assertEqual([], child_names(self.container, 7, 9))
+
+    def testIterAfter(self):
+        self.assertEqual(self.names, list(iter_child_names(self.container)))
+        self.assertEqual([u'c', u'd', u'e'], list(iter_child_names(self.container, u'b')))
+        # the last name of the previous page may have been removed meanwhile
+        self.assertEqual([u'c', u'd', u'e'], list(iter_child_names(self.container, u'bb')))
+        self.assertEqual([], list(iter_child_names(self.container, u'e')))
+
+    def testNamesInLegacyMapping(self):
+        self.container._items = dict(self.container._items.items())
+
+        self.assertEqual([u'b', u'c'], child_names(self.container, 1, 3))
+        self.assertEqual([u'd', u'e'], list(iter_child_names(self.container, u'c')))
+
+
+def make_legacy_container(name, children):
+    """ A container as stored by versions that kept the children in a plain mapping without a counter """
+    container = StorageContainer(name=name)
+    del container._length
+    container._items = PersistentMapping()
+    for child in children:
+        child.__parent__ = container
+        container._items[child.__name__] = child
+    return container
+
+
+class StorageTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.db = DB(None)
+        self.addCleanup(self.db.close)
+
+    def open(self):
+        connection = self.db.open(transaction.TransactionManager())
+        self.addCleanup(connection.close)
+        return connection.root(), connection.transaction_manager
+
+    def store(self, container):
+        root, tm = self.open()
+        root['container'] = container
+        tm.commit()
+
+    def testMigrateLegacyContainers(self):
+        names = [u'object-%03d' % i for i in range(100)]
+        nested = make_legacy_container(u'nested', [make_object(u'x'), make_object(u'y')])
+        self.store(make_legacy_container(u'container', [make_object(name) for name in names] + [nested]))
+
+        root, tm = self.open()
+        container = root['container']
+        oids = dict((name, container[name].oid) for name in child_names(container))
+        self.assertEqual(101, child_count(container))
+        self.assertEqual(1, migrate_containers(container))
+        self.assertTrue(container.migrate())
+        self.assertFalse(container.migrate())
+        tm.commit()
+
+        root, tm = self.open()
+        container = root['container']
+        self.assertTrue(isinstance(container._items, OOBTree))
+        self.assertEqual(101, child_count(container))
+        self.assertEqual(sorted(names + [u'nested']), child_names(container))
+        self.assertEqual(oids, dict((name, container[name].oid) for name in child_names(container)))
+        self.assertEqual([u'x', u'y'], child_names(container[u'nested']))
+        self.assertEqual(2, child_count(container[u'nested']))
+        self.assertTrue(container[u'nested'].__parent__ is container)
+
+    def testAddMigratesLegacyContainer(self):
+        self.store(make_legacy_container(u'container', [make_object(u'a'), make_object(u'b')]))
+
+        root, tm = self.open()
+        root['container'].add(make_object(u'c'))
+        tm.commit()
+
+        root, tm = self.open()
+        self.assertTrue(isinstance(root['container']._items, OOBTree))
+        self.assertEqual(3, child_count(root['container']))
+        self.assertEqual([u'a', u'b', u'c'], child_names(root['container']))
+
+    def testAddAndDeleteKeepLength(self):
+        container = StorageContainer(name=u'container')
+        for name in (u'a', u'b', u'c'):
+            container.add(make_object(name))
+        # replacing a child does not change the count
+        container.add(make_object(u'b'))
+        self.store(container)
+
+        root, tm = self.open()
+        container = root['container']
+        self.assertEqual(3, child_count(container))
+        del container[u'a']
+        tm.commit()
+
+        root, tm = self.open()
+        container = root['container']
+        self.assertEqual(2, child_count(container))
+        self.assertEqual(len(container._items), child_count(container))
+        self.assertEqual([u'b', u'c'], child_names(container))
+
+    def testConcurrentAddsAreResolved(self):
+        # conflicts are resolved only by storages that keep old revisions, unlike DB(None)
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.db = DB(FileStorage(os.path.join(directory, 'Data.fs')))
+        self.addCleanup(self.db.close)
+        self.store(StorageContainer(name=u'container'))
+
+        root1, tm1 = self.open()
+        root2, tm2 = self.open()
+        root1['container'].add(make_object(u'a'))
+        root2['container'].add(make_object(u'b'))
+        tm1.commit()
+        tm2.commit()
+
+        root, tm = self.open()
+        self.assertEqual(2, child_count(root['container']))
+        self.assertEqual([u'a', u'b'], child_names(root['container']))
+
+
+class OidIndexEventsTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.storage = RootStorageContainer()
+        patcher = patch('stoxy.server.model.container.get_storage_root', lambda: self.storage)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def testCreatedObjectsAreIndexed(self):
+        container = StorageContainer(name=u'container')
+        self.storage.add(container)
+        handle(container, ModelCreatedEvent(self.storage))
+        obj = make_object(u'object')
+        container.add(obj)
+        handle(obj, ModelCreatedEvent(container))
+
+        self.assertTrue(get_object_by_oid(container.oid) is container)
+        self.assertTrue(get_object_by_oid(obj.oid) is obj)
+
+        del container[u'object']
+        handle(obj, ModelDeletedEvent(container))
+
+        self.assertEqual(None, get_object_by_oid(obj.oid))
@@ -0,0 +1,109 @@
+import io
+import os
+import shutil
+import tempfile
+import unittest
+
+from mock import patch
+
+from stoxy.server.backend.manager import FileStore
+from stoxy.server.backend.manager import file_path
+
+
+class FakeObject(object):
+
+    def __init__(self, path):
+        self.value = 'file+file://%s' % path
+
+
+class FailingStream(object):
+
+    def __init__(self, data):
+        self.data = data
+
+    def read(self, size=-1):
+        if not self.data:
+            raise IOError('Connection lost')
+        data, self.data = self.data, ''
+        return data
+
+
+class FileStoreTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix='stoxy-filestore-test-')
+        self.path = os.path.join(self.directory, 'object')
+        self.store = FileStore(FakeObject(self.path))
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def testSaveReplacesFile(self):
+        self.store.save(io.BytesIO('old data'), 'utf-8')
+        self.store.save(io.BytesIO('new data'), 'utf-8')
+
+        self.assertEqual('new data', self.store.load().read())
+        self.assertEqual(['object'], os.listdir(self.directory))
+
+    def testReadersKeepDataBeingReplaced(self):
+        self.store.save(io.BytesIO('old data'), 'utf-8')
+        reader = self.store.load()
+
+        self.store.save(io.BytesIO('new data'), 'utf-8')
+
+        self.assertEqual('old data', reader.read())
+        reader.close()
+
+    def testHardLinkedCopiesAreKept(self):
+        self.store.save(io.BytesIO('old data'), 'utf-8')
+        copy = FileStore(FakeObject(os.path.join(self.directory, 'copy')))
+        self.assertTrue(self.store.copy(copy))
+
+        self.store.save(io.BytesIO('new data'), 'utf-8')
+
+        self.assertEqual('old data', copy.load().read())
+
+    def testFailedSaveKeepsOldData(self):
+        self.store.save(io.BytesIO('old data'), 'utf-8')
+
+        self.assertRaises(IOError, self.store.save, FailingStream('partial'), 'utf-8')
+
+        self.assertEqual('old data', self.store.load().read())
+        self.assertEqual(['object'], os.listdir(self.directory))
+
+    def testSaveCreatesShardDirectories(self):
+        path = file_path(self.directory, u'00FFFFFF0018ABCD', u'object', 'sharded')
+        store = FileStore(FakeObject(path))
+
+        store.save(io.BytesIO('data'), 'utf-8')
+
+        self.assertEqual('data', store.load().read())
+
+
+    def testNewDirectoriesAreSynced(self):
+        synced = []
+        path = file_path(self.directory, u'00FFFFFF0018ABCD', u'object', 'sharded')
+        shard = os.path.dirname(path)
+
+        with patch('stoxy.server.backend.manager.get_fsync_policy', lambda: 'file+dir'):
+            with patch('stoxy.server.backend.manager.fsync_directory', synced.append):
+                FileStore(FakeObject(path)).save(io.BytesIO('data'), 'utf-8')
+                self.assertEqual([self.directory, os.path.dirname(shard), shard], synced)
+
+                del synced[:]
+                FileStore(FakeObject(path + '2')).save(io.BytesIO('data'), 'utf-8')
+                self.assertEqual([shard], synced)
+
+
+class FilePathTestCase(unittest.TestCase):
+
+    def testFlatLayout(self):
+        self.assertEqual('/base/object', file_path('/base', u'00FF', u'object', 'flat'))
+
+    def testShardedLayoutIsUniqueAndStable(self):
+        path = file_path('/base', u'00FF01', u'object', 'sharded')
+
+        base, first, second, name = path.rsplit('/', 3)
+        self.assertEqual(('/base', 2, 2, '00FF01'), (base, len(first), len(second), name))
+        self.assertEqual(path, file_path('/base', u'00FF01', u'other name', 'sharded'))
+        self.assertNotEqual(path, file_path('/base', u'00FF02', u'object', 'sharded'))
@@ -0,0 +1,78 @@
+import io
+import unittest
+
+from stoxy.server.metrics import BACKEND_BYTES
+from stoxy.server.metrics import BACKEND_DURATION
+from stoxy.server.metrics import BACKEND_ERRORS
+from stoxy.server.metrics import Counter
+from stoxy.server.metrics import Histogram
+from stoxy.server.metrics import InstrumentedDataStore
+
+
+class FakeStore(object):
+    context = None
+
+    def __init__(self, data):
+        self.data = data
+
+    def load(self, credentials=None):
+        return io.BytesIO(self.data)
+
+    def save(self, datastream, encoding, credentials=None):
+        self.data = datastream.read()
+
+    def delete(self, credentials=None):
+        raise IOError('No such object')
+
+
+class MetricsTestCase(unittest.TestCase):
+
+    def testCounterRendering(self):
+        counter = Counter('test_counter_total', 'A counter', ('backend', 'operation'))
+        counter.inc(('file', 'save'), 10)
+        counter.inc(('file', 'save'), 5)
+        counter.inc(('swift', 'say "hi"\n'))
+
+        self.assertEqual('# HELP test_counter_total A counter\n'
+                         '# TYPE test_counter_total counter\n'
+                         'test_counter_total{backend="file",operation="save"} 15.0\n'
+                         'test_counter_total{backend="swift",operation="say \\"hi\\"\\n"} 1.0',
+                         counter.render())
+
+    def testHistogramBucketsAreCumulative(self):
+        histogram = Histogram('test_seconds', 'A histogram', ('method', ), buckets=(0.1, 1.0))
+        for value in (0.05, 0.1, 0.5, 2.0):
+            histogram.observe(value, ('GET', ))
+
+        lines = histogram.render().split('\n')[2:]
+        self.assertEqual(['test_seconds_bucket{method="GET",le="0.1"} 2.0',
+                          'test_seconds_bucket{method="GET",le="1.0"} 3.0',
+                          'test_seconds_bucket{method="GET",le="+Inf"} 4.0',
+                          'test_seconds_sum{method="GET"} 2.65',
+                          'test_seconds_count{method="GET"} 4.0'], lines)
+
+
+class InstrumentedDataStoreTestCase(unittest.TestCase):
+
+    def value(self, metric, labels):
+        return dict((values, value) for suffix, names, values, value in metric.samples()
+                    if suffix in ('', '_count')).get(labels, 0)
+
+    def testBytesAreCountedAsRead(self):
+        store = InstrumentedDataStore(FakeStore('data'), 'test-bytes')
+
+        store.save(io.BytesIO('new data'), 'utf-8')
+        datastream = store.load()
+        datastream.read(3)
+
+        self.assertEqual(8, self.value(BACKEND_BYTES, ('test-bytes', 'save')))
+        self.assertEqual(3, self.value(BACKEND_BYTES, ('test-bytes', 'load')))
+        self.assertEqual(1, self.value(BACKEND_DURATION, ('test-bytes', 'load')))
+
+    def testFailuresAreCounted(self):
+        store = InstrumentedDataStore(FakeStore('data'), 'test-errors')
+
+        self.assertRaises(IOError, store.delete)
+
+        self.assertEqual(1, self.value(BACKEND_ERRORS, ('test-errors', 'delete')))
+        self.assertEqual(1, self.value(BACKEND_DURATION, ('test-errors', 'delete')))
@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+import base64
+import json
+import os
+import unittest
+import StringIO
+
+from stoxy.server.endpoint.cdmi.parser import CdmiObjectParser
+from stoxy.server.endpoint.cdmi.parser import JsonStringReader
+
+
+class CdmiObjectParserTestCase(unittest.TestCase):
+
+    def parse(self, document, chunk_size=7):
+        return CdmiObjectParser(StringIO.StringIO(document), chunk_size=chunk_size).parse()
+
+    def read_all(self, reader, size):
+        chunks = []
+        chunk = reader.read(size)
+        while chunk:
+            chunks.append(chunk)
+            chunk = reader.read(size)
+        return ''.join(chunks)
+
+    def testMetadataFieldsAreDecoded(self):
+        document = {'mimetype': 'text/plain',
+                    'metadata': {'a "quoted" key': ['x', {'y': None}], 'b': 1.5},
+                    'valuetransferencoding': 'utf-8',
+                    'value': 'hello'}
+        data = self.parse(json.dumps(document))
+        self.assertEqual(document['metadata'], data['metadata'])
+        self.assertEqual(document['mimetype'], data['mimetype'])
+        self.assertTrue(isinstance(data['value'], JsonStringReader))
+        self.assertEqual('hello', data['value'].read())
+
+    def testValueIsStreamedRegardlessOfFieldOrder(self):
+        value = base64.b64encode(os.urandom(50000))
+        document = '{"value" : "%s",\n "valuetransferencoding": "base64", "metadata": {}}' % value
+        data = self.parse(document, chunk_size=4096)
+        self.assertEqual('base64', data['valuetransferencoding'])
+        self.assertEqual(value, self.read_all(data['value'], 1000))
+
+    def testEscapesAcrossChunkBoundaries(self):
+        value = u'line\nbreak "quotes" \\ slash/ été \U0001F600 end\t'
+        document = json.dumps({'value': value})
+        for size in (1, 2, 3, 5, 13, 100):
+            data = self.parse(document)
+            self.assertEqual(value.encode('utf-8'), self.read_all(data['value'], size))
+
+    def testRawUtf8IsPreserved(self):
+        value = u'été'
+        document = json.dumps({'value': value}, ensure_ascii=False).encode('utf-8')
+        self.assertEqual(value.encode('utf-8'), self.parse(document)['value'].read())
+
+    def testNonStringValue(self):
+        self.assertEqual(None, self.parse('{"value": null}')['value'])
+        self.assertEqual({}, self.parse(' { } '))
+
+    def testInvalidDocuments(self):
+        for document in ('', '[]', '{"value": "abc}', '{"a": 1,}', '{"a": 1} x', '{"a" 1}'):
+            self.assertRaises(ValueError, self.parse, document)
@@ -1,16 +1,30 @@
 import base64
+import io
 import json
 import logging
 import os
+import re
 import requests
+import shutil
 import tempfile
+import threading
 import unittest
 import time
 
+from contextlib import contextmanager
+from urlparse import urlparse
+
 from mock import MagicMock
+from mock import patch
+from swiftclient.client import ClientException
 
 import config
 
+from stoxy.server.backend.cache import DiskCache
+from stoxy.server.backend.swift import SegmentedUpload
+from stoxy.server.backend.swift import SwiftObjectStream
+from stoxy.server.backend.swift import SwiftStore
+from stoxy.server.backend.swift import split_swift_uri
 from stoxy.server.tests.common import server_is_up
 from stoxy.server.tests.common import libcdmi_available
 from stoxy.server.tests.common import NotThere
@@ -26,6 +40,434 @@ except ImportError:
 log = logging.getLogger(__name__)
 
 
+class TestSwiftUri(unittest.TestCase):
+
+    def test_split_object_uri(self):
+        self.assertEqual(('https://swift.example.org:8888/v1/AUTH_x', 'container', 'object'),
+                         split_swift_uri('swift+https://swift.example.org:8888/v1/AUTH_x/container/object'))
+
+    def test_split_uri_without_container(self):
+        self.assertEqual(('https://swift.example.org:8888/v1', 'AUTH_x', 'object'),
+                         split_swift_uri('swift+https://swift.example.org:8888/v1/AUTH_x/object'))
+
+
+class FakeResponse(object):
+
+    def __init__(self, status, body):
+        self.status = status
+        self.reason = 'OK' if status == 200 else 'Error'
+        self.body = body
+
+    def read(self):
+        return self.body
+
+
+class FakeConnection(object):
+
+    def __init__(self):
+        self.closed = False
+        self.requests = []
+        self.response = FakeResponse(200, '')
+
+    def request(self, method, path, data, headers):
+        self.requests.append((method, path))
+
+    def getresponse(self):
+        return self.response
+
+    def close(self):
+        self.closed = True
+
+
+class FakeConnectionPool(object):
+
+    def __init__(self):
+        self.acquired = []
+        self.released = []
+
+    def acquire(self, url, token):
+        http_conn = (urlparse(url), FakeConnection())
+        self.acquired.append(http_conn)
+        return http_conn
+
+    def release(self, url, token, http_conn):
+        self.released.append(http_conn)
+
+    @contextmanager
+    def connection(self, url, token):
+        yield self.acquire(url, token)
+
+
+class SwiftClientTestCase(unittest.TestCase):
+    """ Swift is replaced by a mock of swiftclient and a connection pool handing out fake connections """
+
+    def setUp(self):
+        self.pool = FakeConnectionPool()
+        patcher = patch('stoxy.server.backend.swift.get_connection_pool', lambda: self.pool)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = patch('stoxy.server.backend.swift.client')
+        self.client = patcher.start()
+        self.client.ClientException = ClientException
+        self.addCleanup(patcher.stop)
+
+
+class SwiftObjectStreamTestCase(SwiftClientTestCase):
+
+    data = ''.join(chr(i % 256) for i in range(100))
+
+    def setUp(self):
+        super(SwiftObjectStreamTestCase, self).setUp()
+        self.client.get_object.side_effect = self.get_object
+
+    def get_object(self, url, token, container, objname, http_conn=None, resp_chunk_size=None, headers=None):
+        offset = int(headers['Range'][len('bytes='):-1]) if 'Range' in headers else 0
+        body = self.data[offset:]
+        return ({'content-length': str(len(body)), 'etag': 'etag'},
+                iter([body[i:i + resp_chunk_size] for i in range(0, len(body), resp_chunk_size)]))
+
+    def open(self):
+        return SwiftObjectStream('https://swift', 'token', 'container', 'object', 10)
+
+    def testConnectionIsReleasedAtTheEnd(self):
+        stream = self.open()
+
+        self.assertEqual(self.data, stream.read())
+        self.assertEqual((100, 'etag'), (stream.size, stream.etag))
+        self.assertEqual(self.pool.acquired, self.pool.released)
+        self.assertFalse(self.pool.acquired[0][1].closed)
+
+    def testUnfinishedResponseIsNotReused(self):
+        stream = self.open()
+        stream.read(15)
+
+        stream.close()
+
+        self.assertEqual([], self.pool.released)
+        self.assertTrue(self.pool.acquired[0][1].closed)
+
+    def testShortSeekSkipsData(self):
+        stream = self.open()
+        stream.read(3)
+
+        stream.seek(42)
+
+        self.assertEqual(42, stream.tell())
+        self.assertEqual(self.data[42:], stream.read())
+        self.assertEqual(1, self.client.get_object.call_count)
+
+    def testLongSeekRequestsTheRest(self):
+        stream = self.open()
+        stream.MAX_SKIP = 10
+
+        stream.seek(50)
+
+        self.assertEqual(self.data[50:], stream.read())
+        self.assertEqual({'Range': 'bytes=50-'}, self.client.get_object.call_args[1]['headers'])
+        self.assertTrue(self.pool.acquired[0][1].closed)
+        self.assertEqual([self.pool.acquired[1]], self.pool.released)
+        # the size of the whole object is kept
+        self.assertEqual(100, stream.size)
+
+    def testSeekToTheEnd(self):
+        stream = self.open()
+
+        stream.seek(0, os.SEEK_END)
+
+        self.assertEqual('', stream.read())
+        self.assertTrue(self.pool.acquired[0][1].closed)
+
+    def testSeekingBackwardsFails(self):
+        stream = self.open()
+        stream.read(20)
+
+        self.assertRaises(IOError, stream.seek, 10)
+
+
+class SegmentedUploadTestCase(SwiftClientTestCase):
+
+    def setUp(self):
+        super(SegmentedUploadTestCase, self).setUp()
+        self.uploading = 0
+        self.most_uploading = 0
+        self.failing = None
+        self.lock = threading.Lock()
+        self.client.put_object.side_effect = self.put_object
+
+    def put_object(self, url, token, container, name, contents=None, content_length=None, etag=None,
+                   query_string=None, http_conn=None):
+        if query_string is not None:
+            return
+        with self.lock:
+            self.uploading += 1
+            self.most_uploading = max(self.most_uploading, self.uploading)
+        try:
+            time.sleep(0.01)
+            if contents.read() == self.failing:
+                raise IOError('Upload failed')
+        finally:
+            with self.lock:
+                self.uploading -= 1
+
+    def upload(self, segments, workers):
+        upload = SegmentedUpload('https://swift', 'token', 'container', 'object', workers)
+        for data in segments:
+            upload.add_segment(io.BytesIO(data), len(data), 'etag-%s' % data)
+        upload.finish()
+        return upload
+
+    def manifest(self):
+        args, kwargs = self.client.put_object.call_args
+        self.assertEqual('multipart-manifest=put', kwargs['query_string'])
+        self.assertEqual(('container', 'object'), args[2:4])
+        return json.loads(kwargs['contents'])
+
+    def testSegmentsAreReferencedByTheManifest(self):
+        upload = self.upload(['aa', 'bb', 'c'], 2)
+
+        self.assertEqual('container_segments', self.client.put_container.call_args[0][2])
+        manifest = self.manifest()
+        self.assertEqual([('etag-aa', 2), ('etag-bb', 2), ('etag-c', 1)],
+                         [(segment['etag'], segment['size_bytes']) for segment in manifest])
+        for index, segment in enumerate(manifest):
+            self.assertEqual('/container_segments/%s/%08d' % (upload.segment_prefix, index), segment['path'])
+        self.assertTrue(re.match(r'^object/[0-9.]+$', upload.segment_prefix), upload.segment_prefix)
+
+    def testConcurrentUploadsAreBounded(self):
+        self.upload(['segment %d' % i for i in range(8)], 3)
+
+        self.assertTrue(1 < self.most_uploading <= 3, self.most_uploading)
+        self.assertEqual(8, len(self.manifest()))
+
+    def testUploadedSegmentsAreRemovedOnFailure(self):
+        self.failing = 'bb'
+
+        self.assertRaises(IOError, self.upload, ['aa', 'bb', 'cc'], 1)
+
+        deleted = [args[3] for args, kwargs in self.client.delete_object.call_args_list]
+        self.assertEqual(1, len(deleted))
+        self.assertTrue(deleted[0].endswith('/00000000'), deleted)
+        # segments after the failed one are not uploaded and no manifest is stored
+        self.assertEqual(2, self.client.put_object.call_count)
+
+
+class FakeObject(object):
+
+    def __init__(self, value='swift+https://swift.example.org/v1/AUTH_x/container/object'):
+        self.value = value
+
+
+class SwiftStoreTestCase(SwiftClientTestCase):
+
+    def setUp(self):
+        super(SwiftStoreTestCase, self).setUp()
+        patcher = patch('stoxy.server.backend.swift.get_disk_cache', lambda: None)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.store = SwiftStore(FakeObject())
+
+    def large_object(self, status, body):
+        self.client.head_object.return_value = {'x-static-large-object': 'True'}
+        self.http_conn = (urlparse('https://swift.example.org/v1/AUTH_x'), FakeConnection())
+        self.http_conn[1].response = FakeResponse(status, body)
+        self.pool.acquire = lambda url, token: self.http_conn
+
+    def testDeletePlainObject(self):
+        self.client.head_object.return_value = {'content-length': '10'}
+
+        self.store.delete('token')
+
+        args, kwargs = self.client.delete_object.call_args
+        self.assertEqual(('container', 'object'), args[2:4])
+        self.assertEqual(None, kwargs.get('query_string'))
+
+    def testDeleteLargeObjectWithSegments(self):
+        self.large_object(200, json.dumps({'Response Status': '200 OK', 'Number Deleted': 3, 'Errors': []}))
+
+        self.store.delete('token')
+
+        self.assertEqual([('DELETE', '/v1/AUTH_x/container/object?multipart-manifest=delete')],
+                         self.http_conn[1].requests)
+        self.assertFalse(self.client.delete_object.called)
+
+    def testFailedDeletionOfSegmentsIsReported(self):
+        self.large_object(200, json.dumps({'Response Status': '400 Bad Request', 'Number Deleted': 0,
+                                           'Errors': [['/container/object', 'Not an SLO manifest']]}))
+
+        self.assertRaises(ClientException, self.store.delete, 'token')
+
+    def testFailedDeletionOfLargeObject(self):
+        self.large_object(401, 'Unauthorized')
+
+        self.assertRaises(ClientException, self.store.delete, 'token')
+
+    def save(self, data, old_segments=None):
+        config = MagicMock()
+        config.getint.side_effect = lambda section, option, default: 4 if option == 'segment_size' else default
+        patcher = patch('stoxy.server.backend.swift.get_config', lambda: config)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        if old_segments is None:
+            self.client.head_object.return_value = {'content-length': '10'}
+        else:
+            self.client.head_object.return_value = {'x-static-large-object': 'True'}
+            self.client.get_object.return_value = ({}, json.dumps([{'name': '/container_segments/%s' % segment}
+                                                                   for segment in old_segments]))
+        self.store.save(io.BytesIO(data), None, 'token')
+
+    def deleted(self):
+        return [args[2:4] for args, kwargs in self.client.delete_object.call_args_list]
+
+    def testOverwriteOfPlainObject(self):
+        self.save('abc')
+
+        self.assertFalse(self.client.get_object.called)
+        self.assertEqual([], self.deleted())
+
+    def testOverwriteOfLargeObjectRemovesItsSegments(self):
+        self.save('abc', ['object/1.0/00000000', 'object/1.0/00000001'])
+
+        args, kwargs = self.client.get_object.call_args
+        self.assertEqual('multipart-manifest=get', kwargs['query_string'])
+        self.assertEqual([('container_segments', 'object/1.0/00000000'),
+                          ('container_segments', 'object/1.0/00000001')], self.deleted())
+        # the segments are removed only once the new data is stored
+        calls = [call[0] for call in self.client.mock_calls]
+        self.assertTrue(calls.index('put_object') < calls.index('delete_object'), calls)
+
+    def testSegmentedOverwriteRemovesOnlyTheOldSegments(self):
+        self.save('abcdefghij', ['object/1.0/00000000'])
+
+        self.assertEqual(4, self.client.put_object.call_count)
+        self.assertEqual([('container_segments', 'object/1.0/00000000')], self.deleted())
+
+    def target(self, value='swift+https://swift.example.org/v1/AUTH_x/other/copy'):
+        return SwiftStore(FakeObject(value))
+
+    def testCopy(self):
+        self.client.head_object.return_value = {'content-length': '10'}
+
+        self.assertTrue(self.store.copy(self.target(), 'token'))
+
+        args, kwargs = self.client.put_object.call_args
+        self.assertEqual(('other', 'copy'), args[2:4])
+        self.assertEqual({'X-Copy-From': '/container/object'}, kwargs['headers'])
+
+    def testLargeObjectIsNotCopiedOnTheServer(self):
+        self.client.head_object.return_value = {'x-static-large-object': 'True'}
+
+        self.assertFalse(self.store.copy(self.target(), 'token'))
+        self.assertFalse(self.client.put_object.called)
+
+    def testCopyToAnotherAccount(self):
+        self.assertFalse(self.store.copy(self.target('swift+https://swift.example.org/v1/AUTH_y/other/copy'),
+                                         'token'))
+        self.assertFalse(self.store.move(self.target('swift+https://swift.example.org/v1/AUTH_y/other/copy'),
+                                         'token'))
+        self.assertFalse(self.client.put_object.called)
+
+    def testMove(self):
+        self.client.head_object.return_value = {'content-length': '10'}
+
+        self.assertTrue(self.store.move(self.target(), 'token'))
+
+        args, kwargs = self.client.put_object.call_args
+        self.assertEqual({'X-Copy-From': '/container/object'}, kwargs['headers'])
+        self.assertEqual(None, kwargs['query_string'])
+        args, kwargs = self.client.delete_object.call_args
+        self.assertEqual(('container', 'object'), args[2:4])
+
+    def testMoveOfLargeObjectKeepsSegments(self):
+        self.client.head_object.return_value = {'x-static-large-object': 'True'}
+
+        self.assertTrue(self.store.move(self.target(), 'token'))
+
+        args, kwargs = self.client.put_object.call_args
+        self.assertEqual(('other', 'copy'), args[2:4])
+        self.assertEqual('multipart-manifest=get', kwargs['query_string'])
+        # only the manifest of the source is deleted
+        args, kwargs = self.client.delete_object.call_args
+        self.assertEqual(('container', 'object'), args[2:4])
+        self.assertEqual(None, kwargs.get('query_string'))
+
+
+class FakeObjectStream(io.BytesIO):
+
+    def __init__(self, data, etag):
+        io.BytesIO.__init__(self, data)
+        self.size = len(data)
+        self.etag = etag
+
+
+class DiskCacheLoadTestCase(unittest.TestCase):
+
+    def setUp(self):
+        directory = tempfile.mkdtemp(prefix='stoxy-cache-test-')
+        self.addCleanup(shutil.rmtree, directory)
+        self.cache = DiskCache(directory, 100, 50)
+        self.store = SwiftStore(FakeObject())
+        self.responses = []
+        self.requests = []
+        patcher = patch('stoxy.server.backend.swift.SwiftObjectStream', self.open_stream)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def open_stream(self, url, token, container, objname, chunk_size, headers=None):
+        self.requests.append(headers)
+        response = self.responses.pop(0)
+        if isinstance(response, Exception):
+            raise response
+        return FakeObjectStream(*response)
+
+    def load(self):
+        return self.store._load_cached(self.cache, 'https://swift.example.org/v1/AUTH_x', 'token',
+                                       'container', 'object', 4)
+
+    def read(self):
+        stream = self.load()
+        try:
+            return stream.read()
+        finally:
+            stream.close()
+
+    def testFirstReadFillsCache(self):
+        self.responses.append(('data', 'etag-1'))
+
+        self.assertEqual('data', self.read())
+
+        self.assertEqual([None], self.requests)
+        self.assertEqual('etag-1', self.cache.lookup(self.store.context.value).etag)
+        self.assertEqual((0, 1), (self.cache.hits, self.cache.misses))
+
+    def testCurrentEntryIsServed(self):
+        self.responses += [('data', 'etag-1'), ClientException('Not Modified', http_status=304)]
+        self.read()
+
+        self.assertEqual('data', self.read())
+
+        self.assertEqual({'If-None-Match': '"etag-1"'}, self.requests[1])
+        self.assertEqual((1, 1), (self.cache.hits, self.cache.misses))
+
+    def testStaleEntryIsAMiss(self):
+        self.responses += [('data', 'etag-1'), ('new data', 'etag-2')]
+        self.read()
+
+        self.assertEqual('new data', self.read())
+
+        self.assertEqual((0, 2), (self.cache.hits, self.cache.misses))
+        self.assertEqual('new data', self.cache.lookup(self.store.context.value).open().read())
+
+    def testEntryRemovedMeanwhileIsLoadedAgain(self):
+        self.responses += [('data', 'etag-1'), ClientException('Not Modified', http_status=304),
+                           ('data', 'etag-1')]
+        self.read()
+        os.unlink(self.cache.lookup(self.store.context.value).path)
+
+        self.assertEqual('data', self.read())
+        self.assertEqual((0, 2), (self.cache.hits, self.cache.misses))
+
+
 class TestSwift(unittest.TestCase):
     _endpoint = config.DEFAULT_ENDPOINT
     _swift_endpoint = 'https://swift.zam.kfa-juelich.de:8888/v1/AUTH_df37f5b1ebc94604964c2854b9c0551f'
@@ -0,0 +1,489 @@
+import base64
+import io
+import itertools
+import json
+import unittest
+
+from grokcore.component.testing import grok
+from mock import Mock
+from mock import patch
+from twisted.internet import defer
+
+from opennode.oms.endpoint.httprest.root import BadRequest
+from opennode.oms.endpoint.httprest.root import Forbidden
+
+from stoxy.server.endpoint.cdmi.view import Base64ValueProducer
+from stoxy.server.endpoint.cdmi.view import CdmiView
+from stoxy.server.endpoint.cdmi.view import ChildrenListingProducer
+from stoxy.server.endpoint.cdmi.view import DataStreamProducer
+from stoxy.server.endpoint.cdmi.view import MultipartRangeProducer
+from stoxy.server.model.container import StorageContainer
+from stoxy.server.model.container import iter_child_names
+from stoxy.server.model.dataobject import DataObject
+
+
+def setUpModule():
+    # applies the implements() directives of the models
+    grok('stoxy.server.model.container')
+    grok('stoxy.server.model.dataobject')
+
+
+class FakeTransport(object):
+
+    def __init__(self):
+        self.connected = True
+
+    def loseConnection(self):
+        self.connected = False
+
+
+class FakeRequest(object):
+    """ Request of which only the per-request state and the security interaction are used """
+
+    def __init__(self, denied=(), method='GET', request_headers=None, unresolved_path=None):
+        self.interaction = FakeInteraction(denied)
+        self.method = method
+        self.request_headers = request_headers or {}
+        if unresolved_path is not None:
+            self.unresolved_path = unresolved_path
+        self.headers = {}
+        self.code = 200
+        self.finished = False
+
+    def getHeader(self, name):
+        return self.request_headers.get(name.lower())
+
+    def setHeader(self, name, value):
+        self.headers[name.lower()] = value
+
+    def setResponseCode(self, code):
+        self.code = code
+
+    def finish(self):
+        self.finished = True
+
+    def write(self, data):
+        self.written = data
+
+    def notifyFinish(self):
+        return defer.Deferred()
+
+
+class FakeParticipation(object):
+    principal = 'user'
+
+
+class FakeInteraction(object):
+    """ Grants all permissions but the denied (permission, object) pairs """
+
+    def __init__(self, denied):
+        self.denied = denied
+        self.participations = [FakeParticipation()]
+
+    def checkPermission(self, permission, obj):
+        return (permission, obj) not in self.denied
+
+
+class FakeConsumer(object):
+    """ Records what is written to it, like a twisted.web request """
+
+    def __init__(self):
+        self.written = []
+        self.producer = None
+        self.finished = False
+        self.transport = FakeTransport()
+
+    def registerProducer(self, producer, streaming):
+        self.producer = producer
+
+    def unregisterProducer(self):
+        self.producer = None
+
+    def write(self, data):
+        self.written.append(data)
+
+    def finish(self):
+        self.finished = True
+
+    @property
+    def value(self):
+        return ''.join(self.written)
+
+
+class BackendCalls(object):
+    """ Stands in for the thread pools of the backends: calls are run only when the test runs them """
+
+    def __init__(self):
+        self.pending = []
+
+    def __call__(self, backend, f, *args, **kwargs):
+        d = defer.Deferred()
+        self.pending.append((d, f, args, kwargs))
+        return d
+
+    def run(self):
+        d, f, args, kwargs = self.pending.pop(0)
+        try:
+            result = f(*args, **kwargs)
+        except Exception:
+            d.errback()
+        else:
+            d.callback(result)
+
+    def run_all(self):
+        while self.pending:
+            self.run()
+
+
+class ShortReadStream(io.BytesIO):
+    """ Returns at most the next of the given numbers of bytes from each read, like a network stream """
+
+    def __init__(self, data, sizes):
+        io.BytesIO.__init__(self, data)
+        self.sizes = itertools.cycle(sizes)
+
+    def read(self, size=-1):
+        limit = next(self.sizes)
+        return io.BytesIO.read(self, limit if size is None or size < 0 else min(size, limit))
+
+
+class FailingStream(io.BytesIO):
+
+    def read(self, size=-1):
+        raise IOError('Connection lost')
+
+
+class ProducerTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.calls = BackendCalls()
+        patcher = patch('stoxy.server.endpoint.cdmi.view.defer_to_backend', self.calls)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.consumer = FakeConsumer()
+
+    def result(self, d):
+        results = []
+        d.addBoth(results.append)
+        return results[0]
+
+
+class DataStreamProducerTestCase(ProducerTestCase):
+
+    def setUp(self):
+        super(DataStreamProducerTestCase, self).setUp()
+        self.producer = DataStreamProducer('file')
+        self.producer.MAX_CHUNK = 4
+        self.stream = io.BytesIO('0123456789')
+
+    def testSendsRange(self):
+        d = self.producer.beginSendingData(self.stream, self.consumer, 2, 7)
+        self.calls.run_all()
+
+        self.assertEqual('23456', self.consumer.value)
+        self.assertEqual('6', self.result(d))
+        self.assertTrue(self.consumer.finished)
+        self.assertEqual(None, self.consumer.producer)
+        self.assertTrue(self.stream.closed)
+
+    def testPauseWhileReading(self):
+        self.producer.beginSendingData(self.stream, self.consumer)
+        self.producer.pauseProducing()
+        self.calls.run()
+
+        self.assertEqual('0123', self.consumer.value)
+        self.assertEqual([], self.calls.pending)
+
+        self.producer.resumeProducing()
+        self.calls.run_all()
+
+        self.assertEqual('0123456789', self.consumer.value)
+        self.assertTrue(self.consumer.finished)
+
+    def testResumeWhileReadingDoesNotReadTwice(self):
+        self.producer.beginSendingData(self.stream, self.consumer)
+        self.producer.pauseProducing()
+        self.producer.resumeProducing()
+
+        self.assertEqual(1, len(self.calls.pending))
+        self.calls.run_all()
+        self.assertEqual('0123456789', self.consumer.value)
+
+    def testStopWhileReading(self):
+        self.producer.beginSendingData(self.stream, self.consumer)
+        self.producer.stopProducing()
+        # the stream is still being read from in the thread pool
+        self.assertFalse(self.stream.closed)
+
+        self.calls.run()
+
+        self.assertTrue(self.stream.closed)
+        self.assertEqual('', self.consumer.value)
+        self.assertEqual([], self.calls.pending)
+        self.assertFalse(self.consumer.finished)
+
+    def testStopWhilePaused(self):
+        self.producer.beginSendingData(self.stream, self.consumer)
+        self.producer.pauseProducing()
+        self.calls.run()
+
+        self.producer.stopProducing()
+        self.producer.resumeProducing()
+
+        self.assertTrue(self.stream.closed)
+        self.assertEqual([], self.calls.pending)
+        self.assertEqual('0123', self.consumer.value)
+
+    def testFailedReadDropsConnection(self):
+        stream = FailingStream()
+        d = self.producer.beginSendingData(stream, self.consumer)
+        self.calls.run()
+
+        self.assertEqual(IOError, self.result(d).type)
+        self.assertFalse(self.consumer.transport.connected)
+        self.assertEqual(None, self.consumer.producer)
+        self.assertFalse(self.consumer.finished)
+        self.assertTrue(stream.closed)
+
+
+class Base64ValueProducerTestCase(ProducerTestCase):
+
+    data = ''.join(chr(i % 256) for i in range(1000))
+
+    def send(self, stream, begin=0, end=None):
+        producer = Base64ValueProducer('file', '{"value": "', '"}')
+        d = producer.beginSendingData(stream, self.consumer, begin, end)
+        self.calls.run_all()
+        self.result(d)
+        return self.consumer.value
+
+    def testShortReadsAreEncodedAsAWhole(self):
+        for sizes in ([1], [2], [4], [5, 7, 1], [3 * 2 ** 14]):
+            self.consumer = FakeConsumer()
+            self.assertEqual('{"value": "%s"}' % base64.b64encode(self.data),
+                             self.send(ShortReadStream(self.data, sizes)), sizes)
+
+    def testRange(self):
+        self.assertEqual('{"value": "%s"}' % base64.b64encode(self.data[10:511]),
+                         self.send(ShortReadStream(self.data, [7, 2]), 10, 511))
+
+    def testEmptyValue(self):
+        self.assertEqual('{"value": ""}', self.send(io.BytesIO('')))
+        self.assertTrue(self.consumer.finished)
+
+
+class MultipartRangeProducerTestCase(ProducerTestCase):
+
+    def testPartsAreFramedByBoundaries(self):
+        producer = MultipartRangeProducer('file', [(0, 2), (5, 9)], 12, 'text/plain')
+        producer.MAX_CHUNK = 3
+        d = producer.beginSendingData(ShortReadStream('0123456789ab', [2]), self.consumer)
+        self.calls.run_all()
+        self.result(d)
+
+        boundary = producer.boundary
+        self.assertEqual('\r\n--%s\r\n'
+                         'Content-Type: text/plain\r\n'
+                         'Content-Range: bytes 0-2/12\r\n'
+                         '\r\n'
+                         '012'
+                         '\r\n--%s\r\n'
+                         'Content-Type: text/plain\r\n'
+                         'Content-Range: bytes 5-9/12\r\n'
+                         '\r\n'
+                         '56789'
+                         '\r\n--%s--\r\n' % (boundary, boundary, boundary), self.consumer.value)
+        self.assertEqual(len(self.consumer.value), producer.content_length)
+        self.assertTrue(self.consumer.finished)
+
+
+def make_container(names):
+    container = StorageContainer(name=u'container')
+    for name in names:
+        container.add(DataObject(name=name, mimetype=u'text/plain'))
+    return container
+
+
+class ChildrenListingTestCase(unittest.TestCase):
+
+    names = [u'a', u'b', u'c', u'd', u'e']
+
+    def render(self, container, attrs):
+        return CdmiView(container).object_to_dict(container, FakeRequest(), attrs=attrs)
+
+    def page(self, container, begin, last):
+        return self.render(container, {'children': [begin, last], 'childrenrange': None})
+
+    def testFullListingRangeIsInclusive(self):
+        self.assertEqual({'childrenrange': '0-4'}, self.render(make_container(self.names), {'childrenrange': None}))
+        self.assertEqual({'childrenrange': ''}, self.render(make_container([]), {'childrenrange': None}))
+
+    def testPage(self):
+        self.assertEqual({'children': [u'b', u'c', u'd'], 'childrenrange': '1-3'},
+                         self.page(make_container(self.names), 1, 3))
+        self.assertEqual({'children': [u'a'], 'childrenrange': '0-0'}, self.page(make_container(self.names), 0, 0))
+
+    def testPageIsCutAtTheLastChild(self):
+        self.assertEqual({'children': [u'd', u'e'], 'childrenrange': '3-4'},
+                         self.page(make_container(self.names), 3, 10))
+
+    def testPageBeyondTheLastChildIsEmpty(self):
+        self.assertEqual({'children': [], 'childrenrange': ''}, self.page(make_container(self.names), 5, 9))
+        self.assertEqual({'children': [], 'childrenrange': ''}, self.page(make_container([]), 0, 9))
+
+
+class ChildrenListingProducerTestCase(unittest.TestCase):
+
+    names = [u'child-%02d' % i for i in range(7)]
+
+    def setUp(self):
+        self.calls = BackendCalls()
+        patcher = patch('stoxy.server.endpoint.cdmi.view.fetch_child_names', self.fetch_child_names)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.consumer = FakeConsumer()
+        self.container = make_container(self.names)
+
+    def fetch_child_names(self, oid, after, limit):
+        return self.calls(None, lambda: list(itertools.islice(iter_child_names(self.container, after), limit)))
+
+    def begin(self, batch_size):
+        self.producer = ChildrenListingProducer(self.container.oid, batch_size)
+        return self.producer.beginProducing('{"children": [', self.consumer)
+
+    def testBatches(self):
+        for batch_size in (1, 2, 3, 7, 100):
+            self.consumer = FakeConsumer()
+            self.begin(batch_size)
+            self.calls.run_all()
+
+            self.assertEqual({'children': self.names, 'childrenrange': '0-6'}, json.loads(self.consumer.value))
+            self.assertTrue(self.consumer.finished)
+
+    def testEmptyContainer(self):
+        self.container = make_container([])
+        self.begin(3)
+        self.calls.run_all()
+
+        self.assertEqual({'children': [], 'childrenrange': ''}, json.loads(self.consumer.value))
+
+    def testPauseWhileFetching(self):
+        self.begin(3)
+        self.producer.pauseProducing()
+        self.calls.run()
+
+        self.assertEqual([], self.calls.pending)
+        self.producer.resumeProducing()
+        self.calls.run_all()
+
+        self.assertEqual(self.names, json.loads(self.consumer.value)['children'])
+
+    def testStopWhileFetching(self):
+        self.begin(3)
+        self.producer.stopProducing()
+        self.calls.run()
+
+        self.assertEqual([], self.calls.pending)
+        self.assertEqual('{"children": [', self.consumer.value)
+        self.assertFalse(self.consumer.finished)
+
+
+class FilterAttrsTestCase(unittest.TestCase):
+
+    def parse(self, args):
+        return dict(CdmiView(None).parse_args_to_filter_attrs(args))
+
+    def testRanges(self):
+        self.assertEqual({'children': [0, 4], 'metadata': ['a']},
+                         self.parse({'children': ['0-4'], 'metadata': ['a']}))
+        self.assertEqual({'value': [1, 6]}, self.parse({'value': ['1', '6']}))
+
+    def testMalformedRangeIsABadRequest(self):
+        for malformed in (['a-b'], ['5-'], [''], ['1', 'x']):
+            self.assertRaises(BadRequest, self.parse, {'children': malformed})
+            self.assertRaises(BadRequest, self.parse, {'value': malformed})
+
+
+class TransferPermissionTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.source = make_container([u'object'])[u'object']
+        self.target = make_container([])
+        patcher = patch('stoxy.server.endpoint.cdmi.view.resolve_path', lambda path: self.source)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.transfers = []
+        self.view = CdmiView(self.target)
+        self.view.handle_transfer = lambda *args: self.transfers.append(args) or defer.Deferred()
+
+    def transfer(self, operation, denied=()):
+        request = FakeRequest(denied, method='PUT', unresolved_path=u'target')
+        return self.view.handle_copy_or_move(request, operation, {operation: u'/storage/container/object'},
+                                             'application/cdmi-object', False)
+
+    def testCopyOfAnObjectThatCannotBeViewedIsForbidden(self):
+        self.assertRaises(Forbidden, self.transfer, u'copy', [('view', self.source)])
+        self.assertRaises(Forbidden, self.transfer, u'move', [('view', self.source)])
+        self.assertEqual([], self.transfers)
+
+    def testMoveRequiresRemovingTheSource(self):
+        self.assertRaises(Forbidden, self.transfer, u'move', [('delete', self.source)])
+        self.assertRaises(Forbidden, self.transfer, u'move', [('modify', self.source.__parent__)])
+        self.assertEqual([], self.transfers)
+
+        self.transfer(u'copy', [('delete', self.source), ('modify', self.source.__parent__)])
+        self.assertEqual(1, len(self.transfers))
+
+    def testPermittedMove(self):
+        self.transfer(u'move')
+        self.assertEqual(u'move', self.transfers[0][1])
+        self.assertTrue(self.transfers[0][2] is self.source)
+
+
+class ConditionalUpdateTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.obj = make_container([u'object'])[u'object']
+        self.factory = Mock()
+        for target, value in (('CdmiObjectValidatorFactory', self.factory), ('metrics.enabled', lambda: False)):
+            patcher = patch('stoxy.server.endpoint.cdmi.view.' + target, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def testFailedPreconditionStopsBeforeTheUpdate(self):
+        request = FakeRequest(method='PUT', request_headers={'content-type': 'text/plain', 'if-match': '"other"'})
+
+        CdmiView(self.obj).render_put(request)
+
+        self.assertEqual(412, request.code)
+        self.assertTrue(request.finished)
+        self.assertFalse(self.factory.get_applier.called)
+
+    def update(self, if_match, concurrent=False):
+        form = self.factory.get_applier.return_value
+        form.errors = None
+        # another update of the object is committed between the checks of the request and the transaction
+        form.apply.side_effect = lambda: (self.obj.touch() if concurrent else None) or self.obj
+        view = CdmiView(self.obj)
+        view.store_object = Mock()
+        view.add_log_event = Mock()
+        request = FakeRequest(method='PUT', request_headers={'content-type': 'text/plain', 'if-match': if_match})
+        request.path = '/storage/container/object'
+        request.content = io.BytesIO('data')
+
+        with patch('stoxy.server.endpoint.cdmi.view.get_object_by_oid', lambda oid: self.obj):
+            view.render_put(request)
+        return request, view.store_object
+
+    def testConditionalUpdate(self):
+        request, store_object = self.update(CdmiView(self.obj).entity_tag(self.obj, False))
+
+        self.assertEqual(200, request.code)
+        self.assertTrue(store_object.called)
+
+    def testConcurrentUpdateFailsTheConditionalOne(self):
+        request, store_object = self.update(CdmiView(self.obj).entity_tag(self.obj, False), concurrent=True)
+
+        self.assertEqual(412, request.code)
+        self.assertTrue(request.finished)
+        self.assertFalse(store_object.called)
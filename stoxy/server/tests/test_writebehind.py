@@ -0,0 +1,274 @@
+import io
+import os
+import shutil
+import tempfile
+import unittest
+
+from mock import Mock
+from mock import patch
+from twisted.internet import defer
+from twisted.internet import task
+
+from stoxy.server.backend import writebehind
+from stoxy.server.backend.writebehind import COMPLETE
+from stoxy.server.backend.writebehind import SpoolStore
+from stoxy.server.backend.writebehind import WriteBehindQueue
+from stoxy.server.backend.writebehind import WriteBehindDataStore
+from stoxy.server.backend.writebehind import is_write_behind
+
+
+class FakeContainer(object):
+
+    def __init__(self, metadata):
+        self.metadata = metadata
+
+
+class FakeStore(object):
+    context = None
+
+    def __init__(self, data=None):
+        self.data = data
+
+    def load(self, credentials=None):
+        if self.data is None:
+            raise IOError('Not uploaded')
+        return io.BytesIO(self.data)
+
+    def save(self, datastream, encoding, credentials=None):
+        self.data = datastream.read()
+
+    def delete(self, credentials=None):
+        if self.data is None:
+            raise OSError('Not uploaded')
+        self.data = None
+
+
+class WriteBehindTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix='stoxy-spool-test-')
+        self.spool = SpoolStore(None, os.path.join(self.directory, 'oid'))
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def testContainerOptIn(self):
+        self.assertTrue(is_write_behind(FakeContainer({'stoxy_write_behind': 'yes'})))
+        self.assertTrue(is_write_behind(FakeContainer({'stoxy_write_behind': 'True'})))
+        self.assertFalse(is_write_behind(FakeContainer({'stoxy_write_behind': 'no'})))
+        self.assertFalse(is_write_behind(FakeContainer({})))
+
+    def testReadsAreServedFromSpoolUntilUploaded(self):
+        self.spool.save(io.BytesIO('spooled'), 'utf-8')
+        store = WriteBehindDataStore(FakeStore(), self.spool)
+        self.assertEqual('spooled', store.load().read())
+        self.assertEqual(['oid'], os.listdir(self.directory))
+
+        self.spool.delete()
+        store.store.data = 'uploaded'
+        self.assertEqual('uploaded', store.load().read())
+
+    def testDeleteBeforeUpload(self):
+        self.spool.save(io.BytesIO('spooled'), 'utf-8')
+        store = WriteBehindDataStore(FakeStore(), self.spool)
+
+        store.delete()
+
+        self.assertEqual([], os.listdir(self.directory))
+
+
+class FakeObject(object):
+
+    def __init__(self, oid, version=1, parent=None, name=None, value=None):
+        self.oid = oid
+        self.version = version
+        self.__parent__ = parent
+        self.__name__ = name
+        self.value = value
+        self.completion_status = writebehind.PROCESSING
+
+
+class FakeFactory(object):
+
+    def get_backend(self):
+        return 'file'
+
+
+class FakeStorageContainer(object):
+
+    def __init__(self, oid):
+        self.oid = oid
+        self.children = {}
+
+    def __getitem__(self, name):
+        return self.children.get(name)
+
+
+class FakeUploadedStore(object):
+
+    def __init__(self, failures=0):
+        self.failures = failures
+        self.saves = 0
+        self.deleted = False
+
+    def save(self, datastream, encoding, credentials=None):
+        self.saves += 1
+        if self.saves <= self.failures:
+            raise IOError('Backend unavailable')
+
+    def delete(self, credentials=None):
+        self.deleted = True
+
+
+class WriteBehindQueueTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix='stoxy-spool-test-')
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.clock = task.Clock()
+        self.queue = WriteBehindQueue(self.directory, 2, 3, 1, 3)
+        self.container = FakeStorageContainer(u'container')
+        self.objects = {u'container': self.container}
+        self.store = FakeUploadedStore()
+
+        for target, value in (('reactor', self.clock),
+                              ('defer_to_backend', lambda backend, f, *args: defer.maybeDeferred(f, *args)),
+                              ('get_object_by_oid', self.objects.get),
+                              ('get_write_behind_queue', lambda: self.queue),
+                              ('getAdapter', self.get_adapter),
+                              ('instrument', lambda store, backend: store),
+                              ('time_commit', lambda: None)):
+            patcher = patch('stoxy.server.backend.writebehind.' + target, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def get_adapter(self, obj, interface, name=None):
+        return FakeFactory() if name is None else self.store
+
+    def spool(self, oid, version=1):
+        obj = self.objects[oid] = FakeObject(oid, version, self.container, oid, 'file+file:///data/%s' % oid)
+        with open(self.queue.spool_path(oid, version), 'w') as f:
+            f.write('data')
+        return obj
+
+    def testUpload(self):
+        obj = self.spool(u'a')
+
+        self.queue.enqueue(u'a', 1, 'token')
+
+        self.assertEqual(1, self.store.saves)
+        self.assertEqual(COMPLETE, obj.completion_status)
+        self.assertEqual([], os.listdir(self.directory))
+        self.assertEqual(0, self.queue.pending)
+
+    def testRetriesWithExponentialBackoff(self):
+        self.store.failures = 3
+        obj = self.spool(u'a')
+
+        self.queue.enqueue(u'a', 1, 'token')
+        self.assertEqual(1, self.store.saves)
+
+        # delays of 1 and 2 seconds, then capped at max_retry_delay
+        for delay, saves in ((1, 2), (2, 3), (3, 4)):
+            self.clock.advance(delay - 0.1)
+            self.assertEqual(saves - 1, self.store.saves)
+            self.clock.advance(0.1)
+            self.assertEqual(saves, self.store.saves)
+
+        self.assertEqual(COMPLETE, obj.completion_status)
+        self.assertEqual(0, self.queue.pending)
+
+    def testGivesUpAfterMaxRetries(self):
+        self.store.failures = 10
+        obj = self.spool(u'a')
+
+        self.queue.enqueue(u'a', 1, 'token')
+        self.clock.pump([1, 2, 3, 3])
+
+        self.assertEqual(4, self.store.saves)
+        self.assertEqual('Error: Backend unavailable', obj.completion_status)
+        self.assertEqual([], self.clock.getDelayedCalls())
+        self.assertEqual(0, self.queue.pending)
+
+    def testFailureToRecordTheErrorIsLogged(self):
+        self.store.failures = 10
+        self.spool(u'a')
+
+        with patch('stoxy.server.backend.writebehind.finish_upload',
+                   lambda *args: defer.fail(RuntimeError('Database unavailable'))):
+            with patch('stoxy.server.backend.writebehind.log') as log:
+                self.queue.enqueue(u'a', 1, 'token')
+                self.clock.pump([1, 2, 3, 3])
+
+        self.assertEqual('Could not record the failed upload of %s: %s: %s', log.error.call_args[0][0])
+
+    def testSupersededVersionIsSkipped(self):
+        obj = self.spool(u'a', version=2)
+
+        self.queue.enqueue(u'a', 1, 'token')
+
+        self.assertEqual(0, self.store.saves)
+        self.assertEqual(writebehind.PROCESSING, obj.completion_status)
+        self.assertEqual(0, self.queue.pending)
+        self.assertEqual(['a.2'], os.listdir(self.directory))
+
+    def testSpoolOfSupersededVersionIsRemoved(self):
+        self.spool(u'a', version=1)
+        self.objects[u'a'].version = 2
+
+        self.queue.enqueue(u'a', 1, 'token')
+
+        self.assertEqual(0, self.store.saves)
+        self.assertEqual([], os.listdir(self.directory))
+
+    def testSpoolOfNewerVersionIsKept(self):
+        self.spool(u'a', version=1)
+
+        def update(datastream, encoding, credentials):
+            # a new version is spooled while the previous one is being uploaded
+            self.spool(u'a', version=2)
+        self.store.save = update
+
+        self.queue.enqueue(u'a', 1, 'token')
+
+        self.assertEqual(['a.2'], os.listdir(self.directory))
+        self.assertEqual(writebehind.PROCESSING, self.objects[u'a'].completion_status)
+
+    def testDataOfObjectDeletedDuringUploadIsRemoved(self):
+        self.spool(u'a')
+        self.store.save = lambda datastream, encoding, credentials: self.objects.pop(u'a')
+
+        self.queue.enqueue(u'a', 1, 'token')
+
+        self.assertTrue(self.store.deleted)
+
+    def testDataOfReplacedObjectIsKept(self):
+        self.spool(u'a')
+
+        def replace(datastream, encoding, credentials):
+            # deleted and created again under the same name and data location
+            del self.objects[u'a']
+            self.container.children[u'a'] = FakeObject(u'new', value='file+file:///data/a')
+        self.store.save = replace
+
+        self.queue.enqueue(u'a', 1, 'token')
+
+        self.assertFalse(self.store.deleted)
+
+    def testResume(self):
+        self.spool(u'a', version=3)
+        open(os.path.join(self.directory, 'tmp123'), 'w').close()
+        open(os.path.join(self.directory, 'unknown'), 'w').close()
+
+        self.queue.resume()
+
+        self.assertEqual(1, self.store.saves)
+        self.assertEqual(['unknown'], os.listdir(self.directory))
+
+    def testUploadsAreResumedOnStart(self):
+        reactor = Mock()
+        with patch('stoxy.server.backend.writebehind.reactor', reactor):
+            writebehind.start()
+
+        reactor.callWhenRunning.assert_called_once_with(self.queue.resume)
+